@@ -54,8 +54,18 @@ class ComposteClient(QtCore.QObject):
         self.__version_handshake()
 
         self.__project = None
+        # Handed out by the server when we register or log in, and sent
+        # instead of a username from then on
+        self.__token = None
+        # How many operations into the project's history we are
+        self.__version = 0
+        # (project id, [ update ]) while updates are being saved up
+        self.__batch = None
         self.__editor = None
 
+        # cookie -> project id, for projects joined through subscribe
+        self.__subscriptions = {}
+
         self.__tts = False
 
         espeak = subprocess.check_output("which espeak | cat -",
@@ -115,6 +125,7 @@ class ComposteClient(QtCore.QObject):
 
         rpc_funs = {
             "update": self.__do_update,
+            "update_batch": self.__do_update_batch,
         }
 
         rpc = client.deserialize(rpc)
@@ -138,11 +149,19 @@ class ComposteClient(QtCore.QObject):
                                 shell=True)
             return
 
+        # Anything from before our version is already in our copy
+        version = rpc.get("version", None)
+        if version is not None and version <= self.__version:
+            return
+
         do_rpc = rpc_funs.get(f, fail)
         try:
             (status, other) = do_rpc(*rpc['args'])
             if status == 'ok':
-                startOffset, endOffset = other
+                if version is not None:
+                    self.__version = version
+                # The server knows best what an update changed
+                startOffset, endOffset = rpc.get("span", other)
                 self.__updateGui(startOffset, endOffset)
         except Exception as e:
             print(e)
@@ -158,6 +177,16 @@ class ComposteClient(QtCore.QObject):
             print(traceback.format_exc())
             return ('fail', 'error')
 
+    def __do_update_batch(self, pid, updates):
+        updates = json.loads(updates)
+        for update in updates:
+            (status, other) = self.__do_update(pid, *update)
+            if status != 'ok':
+                print("Failed to apply {}: {}".format(update, other))
+
+        # Batches can be all over the place, so redraw everything
+        return ('ok', (0.0, float("inf")))
+
     def __version_handshake(self):
         """
         Perform a version handshake with the remote Composte server
@@ -180,12 +209,11 @@ class ComposteClient(QtCore.QObject):
         msg = client.serialize("register", uname, pword, email)
         reply = self.__client.send(msg)
         if DEBUG: print(reply)
-        return server.deserialize(reply)
+        reply = server.deserialize(reply)
+        if reply[0] == 'ok':
+            self.__token = reply[1][0]
+        return reply
 
-    # We probably need cookies for login too, otherwise people can request
-    # project listings (and thus projects) and subscribe to projects they
-    # shouldn't be able to. This isn't an issue for the minimum deliverable
-    # for the course, but it is an issue in the long run
     def login(self, uname, pword):
         """
         login username password
@@ -196,27 +224,47 @@ class ComposteClient(QtCore.QObject):
         reply = self.__client.send(msg)
         # status, reason = reply
         if DEBUG: print(reply)
+        reply = server.deserialize(reply)
+        if reply[0] == 'ok':
+            self.__token = reply[1][1]
+        return reply
+
+    def logout(self):
+        """
+        logout
+
+        End the session we got from logging in
+        """
+        reply = self.__send_authenticated("logout")
+        self.__token = None
+        return reply
+
+    def __send_authenticated(self, fname, *args):
+        """
+        Send a request on behalf of whoever we're logged in as
+        """
+        if self.__token is None:
+            return ("fail", "Log in first")
+        msg = client.serialize(fname, self.__token, *args)
+        reply = self.__client.send(msg)
+        if DEBUG: print(reply)
         return server.deserialize(reply)
 
-    def create_project(self, uname, pname, metadata):
+    def create_project(self, pname, metadata):
         """
-        create-project username project-name metadata
+        create-project project-name metadata
 
         Attempt to create a project. Metdata must have the form of a json
-        object, eg "{ "owner": username }"
+        object, eg "{ "composer": name }"
         """
         if type(metadata) == str:
             metadata = json.loads(metadata)
-        metadata["owner"] = uname
         metadata["name"] = pname
         metadata = json.dumps(metadata)
-        msg = client.serialize("create_project", uname, pname, metadata)
-        reply = self.__client.send(msg)
-        if DEBUG: print(reply)
         try:
-            return server.deserialize(reply)
+            return self.__send_authenticated("create_project", pname,
+                    metadata)
         except:
-            print(reply)
             return ("fail", "Mangled reply")
 
     def share(self, pid, new_contributor):
@@ -225,20 +273,26 @@ class ComposteClient(QtCore.QObject):
 
         Allow another person to contribute to your project
         """
-        msg = client.serialize("share", pid, new_contributor)
+        return self.__send_authenticated("share", pid, new_contributor)
+
+    def stats(self):
+        """
+        server-stats
+
+        Get some numbers describing how the server is doing
+        """
+        msg = client.serialize("stats")
         reply = self.__client.send(msg)
         if DEBUG: print(reply)
         return server.deserialize(reply)
 
-    def retrieve_project_listings_for(self, uname):
+    def retrieve_project_listings(self):
         """
-        list-projects username
+        list-projects
 
-        Get a list of all projects this user is a collaborator on
+        Get a list of all projects we are a collaborator on
         """
-        msg = client.serialize("list_projects", uname)
-        reply = self.__client.send(msg)
-        return server.deserialize(reply)
+        return self.__send_authenticated("list_projects")
 
     def get_project(self, pid):
         """
@@ -246,30 +300,100 @@ class ComposteClient(QtCore.QObject):
 
         Given a uuid, get the project to work on
         """
-        msg = client.serialize("get_project", pid)
-        reply = server.deserialize(self.__client.send(msg))
-        if DEBUG: print(reply)
-        status, ret = reply
-        if status == 'ok':
-            print(type(ret))
-            realProj = json.loads(ret[0])
-            self.__project = util.composteProject.deserializeProject(realProj)
+        # Listen before asking, so that nothing published between the
+        # snapshot and the subscription goes missing. Whatever arrives
+        # meanwhile waits until we have the snapshot, and anything it already
+        # has is skipped by version
+        self.pause_updates()
+        try:
+            listening = self.__listening_to(pid)
+            self.__client.subscribe(str(pid))
+
+            msg = client.serialize("get_project", pid)
+            reply = server.deserialize(self.__client.send(msg))
+            if DEBUG: print(reply)
+            status, ret = reply
+            if status == 'ok':
+                print(type(ret))
+                realProj = json.loads(ret[0])
+                self.__stop_listening_to_current(pid)
+                self.__project = \
+                        util.composteProject.deserializeProject(realProj)
+                self.__version = int(ret[1]) if len(ret) > 1 else 0
+            elif not listening:
+                self.__client.unsubscribe(str(pid))
+        finally:
+            self.resume_update()
         return reply
 
-    # Realistically, we send a login cookie and the server determines the user
-    # from that, but we don't have that yet
-    def subscribe(self, uname, pid):
+    def sync(self, pid):
         """
-        subscribe username project-id
+        sync project-id
+
+        Catch up on everything that happened to a project while we weren't
+        listening, fetching only what changed where possible
+        """
+        if self.__project is None or \
+           str(self.__project.projectID) != str(pid):
+            return self.get_project(pid)
+
+        # Broadcasts would otherwise race us to apply the same updates
+        self.pause_updates()
+        try:
+            msg = client.serialize("sync", pid, self.__version)
+            reply = server.deserialize(self.__client.send(msg))
+            if DEBUG: print(reply)
+            status, ret = reply
+            if status != 'ok':
+                return reply
+
+            caughtUp = json.loads(ret[0])
+            if "project" in caughtUp:
+                self.__project = util.composteProject.deserializeProject(
+                        json.loads(caughtUp["project"]))
+            else:
+                for (_, operation) in caughtUp["operations"]:
+                    self.__do_update(str(pid), *operation)
+            self.__version = caughtUp["version"]
+        finally:
+            self.resume_update()
+
+        self.__updateGui(0.0, float("inf"))
+        return ("ok", self.__version)
+
+    def __listening_to(self, pid):
+        """
+        Whether we already receive broadcasts for pid, because we are working
+        on it or joined it through subscribe
+        """
+        pid = str(pid)
+        return pid in self.__subscriptions.values() or \
+               (self.__project is not None and
+                str(self.__project.projectID) == pid)
+
+    def __stop_listening_to_current(self, pid):
+        """
+        Stop receiving broadcasts for the project we were working on, now
+        that we are working on pid, unless we joined it through subscribe
+        """
+        if self.__project is None:
+            return
+        old = str(self.__project.projectID)
+        if old != str(pid) and old not in self.__subscriptions.values():
+            self.__client.unsubscribe(old)
+
+    def subscribe(self, pid):
+        """
+        subscribe project-id
 
         Subscribe to updates to a project
         """
-        msg = client.serialize("subscribe", uname, pid)
-        reply = self.__client.send(msg)
-        # print(reply)
-        j = json.loads(reply)
-        if DEBUG: print(j[1][0])
-        return server.deserialize(reply)
+        reply = self.__send_authenticated("subscribe", pid)
+        status, ret = reply
+        if status == 'ok':
+            self.__subscriptions[ret[0]] = str(pid)
+            self.__client.subscribe(str(pid))
+        return reply
 
     def unsubscribe(self, cookie):
         """
@@ -278,7 +402,15 @@ class ComposteClient(QtCore.QObject):
         msg = client.serialize("unsubscribe", cookie)
         reply = self.__client.send(msg)
         if DEBUG: print(reply)
-        return server.deserialize(reply)
+        reply = server.deserialize(reply)
+        pid = self.__subscriptions.pop(cookie, None)
+        if reply[0] == 'ok' and pid is not None:
+            # Keep listening if we're still using it or joined it twice
+            current = None if self.__project is None \
+                    else str(self.__project.projectID)
+            if pid != current and pid not in self.__subscriptions.values():
+                self.__client.unsubscribe(pid)
+        return reply
 
     # There's nothing here yet b/c we don't know what anything look like
     def update(self, pid, fname, args, partIndex = None, offset = None):
@@ -289,11 +421,53 @@ class ComposteClient(QtCore.QObject):
         a tuple of arguments
         """
         args = json.dumps(args)
+        if self.__batch is not None and fname != "chat" and \
+                str(self.__batch[0]) == str(pid):
+            self.__batch[1].append([fname, args, partIndex, offset])
+            return ("ok", "Saved for later")
         msg = client.serialize("update", pid, fname, args, partIndex, offset)
         reply = self.__client.send(msg)
         if DEBUG: print(reply)
         return server.deserialize(reply)
 
+    def update_batch(self, pid, updates):
+        """
+        Send several music related updates to one project in a single
+        request. updates is a list of [ update-type, args, partIndex, offset ],
+        where args is serialized as json. The server replies with the reply to
+        each update
+        """
+        msg = client.serialize("update_batch", pid, json.dumps(updates))
+        reply = self.__client.send(msg)
+        if DEBUG: print(reply)
+        return server.deserialize(reply)
+
+    def begin_batch(self, pid):
+        """
+        begin-batch project-id
+
+        Save up updates to a project instead of sending them, until end-batch
+        """
+        if self.__batch is not None:
+            return ("fail", "Already saving updates for {}"
+                    .format(self.__batch[0]))
+        self.__batch = (pid, [])
+        return ("ok", "")
+
+    def end_batch(self):
+        """
+        end-batch
+
+        Send every update saved up since begin-batch in one go
+        """
+        if self.__batch is None:
+            return ("fail", "No batch to send")
+        (pid, updates) = self.__batch
+        self.__batch = None
+        if len(updates) == 0:
+            return ("ok", "[]")
+        return self.update_batch(pid, updates)
+
     def chat(self, pid, from_, *message_parts):
         """
         chat project-id sender [message-parts]
@@ -346,6 +520,21 @@ class ComposteClient(QtCore.QObject):
                            "insertNote", (offset, partIndex, pitch, duration),
                            partIndex, offset)
 
+    def insertNotes(self, pid, partIndex, *notes):
+        """
+        insert-notes project-id partIndex [offset pitch duration]...
+
+        Insert several notes into the same part of the score in one go
+        """
+        if len(notes) % 3 != 0:
+            return ("fail", "Notes need an offset, a pitch and a duration")
+        updates = [ ["insertNote",
+                     json.dumps((notes[i], partIndex, notes[i + 1],
+                                 notes[i + 2])),
+                     partIndex, notes[i]]
+                    for i in range(0, len(notes), 3) ]
+        return self.update_batch(pid, updates)
+
     def removeNote(self, pid, offset, partIndex, removedNoteName):
         """
         remove-note project-id offset partIndex removedNoteName
@@ -376,15 +565,18 @@ class ComposteClient(QtCore.QObject):
                            "removeMetronomeMark", (offset,),
                            None, offset)
 
-    def transpose(self, pid, partIndex, semitones):
+    def transpose(self, pid, partIndex, semitones, startOffset = None,
+                  endOffset = None):
         """
-        transpose project-id partIndex semitones
-
+        transpose project-id partIndex semitones [startOffset endOffset]
 
+        Transpose the notes of a part that start between startOffset and
+        endOffset, or the whole part
         """
         return self.update(pid,
-                           "transpose", (partIndex, semitones),
-                           partIndex, None)
+                           "transpose", (partIndex, semitones, startOffset,
+                                         endOffset),
+                           partIndex, startOffset)
 
     def insertClef(self, pid, offset, partIndex, clefStr):
         """
@@ -459,6 +651,53 @@ class ComposteClient(QtCore.QObject):
                            "addLyric", (offset, partIndex, lyric),
                            partIndex, offset)
 
+    def deleteRange(self, pid, startOffset, partIndex, endOffset):
+        """
+        delete-range project-id startOffset partIndex endOffset
+
+        Delete the notes and dynamics between startOffset and endOffset, in
+        one part, or with a partIndex of None, in every part
+        """
+        return self.update(pid,
+                           "deleteRange", (startOffset, partIndex, endOffset),
+                           partIndex, startOffset)
+
+    def copyRange(self, pid, startOffset, partIndex, endOffset, destination):
+        """
+        copy-range project-id startOffset partIndex endOffset destination
+
+        Copy the notes and dynamics between startOffset and endOffset over
+        whatever is at destination
+        """
+        return self.update(pid,
+                           "copyRange", (startOffset, partIndex, endOffset,
+                                         destination),
+                           partIndex, startOffset)
+
+    def moveRange(self, pid, startOffset, partIndex, endOffset, destination):
+        """
+        move-range project-id startOffset partIndex endOffset destination
+
+        Move the notes and dynamics between startOffset and endOffset over
+        whatever is at destination
+        """
+        return self.update(pid,
+                           "moveRange", (startOffset, partIndex, endOffset,
+                                         destination),
+                           partIndex, startOffset)
+
+    def duplicateRange(self, pid, startOffset, partIndex, endOffset):
+        """
+        duplicate-range project-id startOffset partIndex endOffset
+
+        Repeat the notes and dynamics between startOffset and endOffset right
+        after endOffset, making room for them
+        """
+        return self.update(pid,
+                           "duplicateRange", (startOffset, partIndex,
+                                              endOffset),
+                           partIndex, startOffset)
+
     def startEditor(self):
         """
         start-editor
@@ -536,15 +775,21 @@ if __name__ == "__main__":
             # Supporting/Utility routines
             "register": c.register,
             "login": c.login,
-            "list-projects": c.retrieve_project_listings_for,
+            "logout": c.logout,
+            "list-projects": c.retrieve_project_listings,
             "create-project": c.create_project,
             "get-project": c.get_project,
+            "sync": c.sync,
             "subscribe": c.subscribe,
             "unsubscribe": c.unsubscribe,
             "share": c.share,
+            "server-stats": c.stats,
+            "begin-batch": c.begin_batch,
+            "end-batch": c.end_batch,
             # Music updates
             "change-key-signature": c.changeKeySignature,
             "insert-note": c.insertNote,
+            "insert-notes": c.insertNotes,
             "remove-note": c.removeNote,
             "insert-metronome-mark": c.insertMetronomeMark,
             "remove-metronome-mark": c.removeMetronomeMark,
@@ -557,6 +802,10 @@ if __name__ == "__main__":
             "add-dynamic": c.addDynamic,
             "remove-dynamic": c.removeDynamic,
             "add-lyric": c.addLyric,
+            "delete-range": c.deleteRange,
+            "copy-range": c.copyRange,
+            "move-range": c.moveRange,
+            "duplicate-range": c.duplicateRange,
             # Client exclusive updates
             "start-editor": c.startEditor,
             "playback": c.playback,
@@ -2,8 +2,6 @@
 
 # Things that should probably be a thing:
 # * Login cookies alongside project subscription cookies
-# * Separation of broadcasts per project (regardless of encryption)
-#       Would require moving from single broadcast to some other strategy
 
 from network.server import Server as NetworkServer
 from network.fake.security import Encryption
@@ -16,6 +14,13 @@ from auth import auth
 from database import driver
 
 from util import musicWrapper, bookkeeping, composteProject, timer, misc
+from util import oplog, flyweight
+
+try:
+    from util import arrayScore
+except ImportError as e:
+    # NumPy is only needed for --score-engine numpy
+    arrayScore = None
 
 from threading import Thread, Lock
 import uuid
@@ -23,56 +28,113 @@ import json
 import os
 import sqlite3
 import logging
+import time
 import traceback
 
 class ComposteServer:
     __project_extension = ".heap"
     __metadata_extension = ".meta"
+    __log_extension = ".log"
 
     # I'm so sorry
     __register_lock = Lock()
 
     def __init__(self, interactive_port, broadcast_port,
-            logger, encryption_scheme, data_root = "data/"):
+            logger, encryption_scheme, data_root = "data/", workers = 4,
+            flush_interval = 10, flush_budget = 4 * 1024 * 1024,
+            compact_size = 256 * 1024, score_engine = "music21",
+            hash_workers = 2, logins_per_source = 2,
+            session_lifetime = 60 * 60, sweep_interval = 60,
+            idle_timeout = 60):
         """
         Start a Composte Server listening on interactive_port and broadcasting
         on broadcast_port. Logs are directed to logger, messages are
         transparently encrypted with encryption_scheme.encrypt() and
         encryption_scheme.decrypt(), and data is stored in the directory
-        data_root.
+        data_root. Up to workers requests are handled concurrently.
+        Every update is appended to its project's operation log. Every
+        flush_interval seconds, the logs are synced, and projects whose logs
+        have grown past compact_size bytes are rewritten as fresh snapshots
+        until about flush_budget bytes have been written.
+        Open projects are kept as music21 streams, or with score_engine
+        "numpy", as util.arrayScore's ArrayParts where possible.
+        Passwords are hashed and checked in hash_workers processes, with at
+        most logins_per_source registrations and logins from any one address
+        in progress at once.
+        Logging in hands out a session token that stays good until
+        session_lifetime seconds after it was last used. Expired tokens are
+        swept out every sweep_interval seconds.
+        Projects nobody has used for idle_timeout seconds are written out and
+        let go of at the next flush.
         """
 
-        self.__server = NetworkServer(interactive_port, broadcast_port,
-                logger, encryption_scheme)
+        if score_engine not in ("music21", "numpy"):
+            raise ValueError("Unknown score engine {}".format(score_engine))
 
-        self.__server.start_background(self.__handle, self.__preprocess,
-                self.__postprocess)
+        self.__server = NetworkServer(interactive_port, broadcast_port,
+                logger, encryption_scheme, workers)
 
         self.__users        = None
         self.__projects     = None
         self.__contributors = None
+        # Requests are handled on several threads now, and each of them gets
+        # its own connection out of here
+        self.__db_pool = None
+        self.__db_lock = Lock()
+
+        # Hashing passwords takes long enough on purpose that doing it on a
+        # worker would stall updates whenever a class logs in at once
+        self.__passwords = auth.Hasher(hash_workers, logins_per_source)
+        # Once somebody has logged in, they never need their password again
+        self.__sessions = auth.Sessions(session_lifetime)
 
         self.version = misc.get_version()
         self.__server.info("Composte server version {}".format(self.version))
 
+        # How parts are thawed decides what they're kept as in memory
+        self.__thaw = composteProject.thawPart
+        if score_engine == "numpy":
+            if arrayScore is None:
+                self.__server.warn("NumPy is not available, so projects "
+                        "will be kept as music21 streams")
+            else:
+                self.__thaw = arrayScore.thawPart
+
         self.__data_root = data_root
         self.__project_root = os.path.join(self.__data_root, "users")
 
         self.__dlock = Lock()
         self.__done = False
 
+        # Nothing here ever renders a score, which is what changes music21
+        # objects behind our backs, so they can be shared between projects
+        flyweight.share()
+
         self.__pool = bookkeeping.ProjectPool()
-        # A better solution would have a lock for every project, but in a
-        # classroom demo this won't be an issue
-        self.__flushing = Lock()
+        # Updates and flushes only wait on others touching the same project,
+        # and for updates confined to one part, the same part
+        self.__locks = bookkeeping.ProjectLocks()
 
         def is_done(self):
             with self.__dlock:
                 return not self.__done
 
-        self.__timer = timer.every(300, 2,
-                lambda: self.__pool.map(self.flush_project),
-                lambda: is_done(self))
+        # Trickle writes out a few at a time instead of all at once
+        self.__flush_budget = flush_budget
+        self.__compact_size = compact_size
+        # pid -> util.oplog.OperationLog, for every project we've loaded
+        self.__logs = {}
+        self.__logs_lock = Lock()
+        # pid -> when the last use of a project was given back, for projects
+        # the server holds on to in case somebody comes back for them. Each
+        # of them holds one use of its project
+        self.__idle = {}
+        self.__idle_lock = Lock()
+        self.__idle_timeout = idle_timeout
+        self.__timer = timer.every(flush_interval, 2,
+                lambda: self.__tick(), lambda: is_done(self))
+        self.__sweeper = timer.every(sweep_interval, 2,
+                self.__sessions.sweep, lambda: is_done(self))
 
         try:
             os.makedirs(self.__project_root)
@@ -81,21 +143,144 @@ class ComposteServer:
 
         self.sessions = {}
 
-    def flush_project(self, project, count):
+        # pid -> (serialized project, version), so that a crowd opening the
+        # same project only serializes it once. Updates throw it away
+        self.__snapshots = {}
+        self.__snapshot_lock = Lock()
+        self.__snapshot_hits = 0
+        self.__snapshot_misses = 0
+
+        # cost class -> how many updates of that kind have been applied
+        self.__applied = {}
+        self.__applied_lock = Lock()
+
+        # Only start taking requests once everything above exists
+        self.__server.start_background(self.__handle, self.__preprocess,
+                self.__postprocess)
+
+    def flush_project(self, project, count = None):
+        """
+        Flush project to backing storage as a snapshot, emptying its operation
+        log. Returns the number of bytes written
+        """
+        pid = str(project.projectID)
+        with self.__locks.project(pid):
+            # A copy that has left the pool may be behind one loaded since,
+            # and writing it out would throw away whatever that one has
+            # logged
+            if self.__pool.peek(pid) is not project:
+                return 0
+            return self.__snapshot(project)
+
+    def __snapshot(self, project):
+        """
+        Write project out as a snapshot and empty its operation log. The
+        caller must hold the project's lock and know that project is the live
+        copy. Returns the number of bytes written
+        """
+        pid = str(project.projectID)
+        # Nobody can modify the project while we hold its lock
+        version = self.__pool.version(pid)
+        log = self.__log_for(project)
+        with self.__locks.files(pid):
+            written = self.write_project(project, log.sequence())
+            log.truncate()
+        self.__pool.mark_clean(pid, version)
+        return written
+
+    def __evict(self, project):
+        """
+        Write out a project that is leaving the pool, if its log has anything
+        its snapshot doesn't. The caller must hold the project's lock from
+        before the project left the pool, so that nobody loads and updates a
+        fresh copy in the meantime
+        """
+        # Projects that failed to load are kept as the reason why
+        if type(project) == str:
+            return
+        pid = str(project.projectID)
+        self.invalidate_snapshot(pid)
+        if self.__log_for(project).size() > 0:
+            self.__snapshot(project)
+        # Loading it again opens a fresh one
+        with self.__logs_lock:
+            log = self.__logs.pop(pid, None)
+        if log is not None:
+            log.close()
+
+    def __tick(self):
+        """
+        Everything that happens every flush_interval
+        """
+        self.flush_dirty(self.__flush_budget, self.__compact_size)
+        self.evict_idle(self.__idle_timeout)
+
+    def evict_idle(self, timeout = 0):
+        """
+        Write out and let go of every project nobody has used for timeout
+        seconds. Returns how many there were
         """
-        Flush project to backing storage
+        now = time.monotonic()
+        with self.__idle_lock:
+            idle = [ pid for (pid, since) in self.__idle.items()
+                    if now - since >= timeout ]
+
+        evicted = 0
+        for pid in idle:
+            # Nobody can take a use of the project while we hold its lock
+            with self.__locks.project(pid):
+                with self.__idle_lock:
+                    since = self.__idle.get(pid, None)
+                    if since is None or now - since < timeout:
+                        continue
+                    # Somebody's subscribed, and giving that back will
+                    # start the clock again
+                    if self.__pool.uses(pid) > 1:
+                        continue
+                    del self.__idle[pid]
+                    self.__pool.remove(pid, self.__evict)
+                    evicted += 1
+        return evicted
+
+    def flush_dirty(self, budget = None, compact_size = 0):
         """
-        with self.__flushing:
-            self.write_project(project)
+        Sync every operation log, then snapshot projects that have been
+        modified since they were last written and whose logs have reached
+        compact_size bytes, longest-neglected first. Stops snapshotting once
+        budget bytes have been written; the rest wait for the next round
+        """
+        with self.__logs_lock:
+            logs = list(self.__logs.values())
+        for log in logs:
+            log.sync()
+
+        written = 0
+        for (pid, project) in self.__pool.dirty():
+            if budget is not None and written >= budget:
+                break
+            if self.__log_for(project).size() < compact_size:
+                continue
+            written += self.flush_project(project)
+        return written
 
     # Database interactions
 
     def register(self, uname, pword, email):
         """
         Register a new user. Username must be unique per user database.
+        The password is hashed in the background, so the reply is a Future,
+        of a session token for the new user
         """
-        hash_ = auth.hash(pword)
+        hashing = self.__passwords.hash(pword, self.__server.source(),
+                then = lambda hash_: self.__register(uname, hash_, email))
+        if hashing is None:
+            return ("fail", "Too many attempts at once, try again shortly")
+        return hashing
 
+    def __register(self, uname, hash_, email):
+        """
+        The rest of register, once the password is hashed
+        """
         with ComposteServer.__register_lock:
             hopefully_None = self.__users.get(uname)
             if hopefully_None.uname is not None:
@@ -115,29 +300,54 @@ class ComposteServer:
         except FileExistsError as e:
             pass
 
-        return ("ok", "")
+        return ("ok", self.__sessions.issue(uname))
 
     def login(self, uname, pword):
         """
-        Log a user in
+        Log a user in. The password is checked in the background, so the
+        reply is a Future, of the projects the user contributes to and a
+        session token for them
         """
         record = self.__users.get(uname)
         if record.hash is None:
             return ("fail", "failed to login")
 
-        success = auth.verify(pword, record.hash)
+        checking = self.__passwords.verify(pword, record.hash,
+                self.__server.source(),
+                then = lambda success: self.__login(uname, success))
+        if checking is None:
+            return ("fail", "Too many attempts at once, try again shortly")
+        return checking
+
+    def __login(self, uname, success):
+        """
+        The rest of login, once the password is checked
+        """
         if success:
             uuids = self.__contributors.get_projects(uname)
             project_ids = [ str(uuid_) for uuid_ in uuids ]
-            return ("ok", json.dumps(project_ids))
+            return ("ok", json.dumps(project_ids),
+                    self.__sessions.issue(uname))
         else:
             return ("fail", "failed to login")
 
-    def create_project(self, uname, pname, metadata):
+    def logout(self, token):
         """
-        Create a new Composte project. Projects are given unique identifiers,
-        so project names need not be unique.
+        End a session
         """
+        if not self.__sessions.revoke(token):
+            return ("fail", "Who are you")
+        return ("ok", "")
+
+    def create_project(self, token, pname, metadata):
+        """
+        Create a new Composte project, owned by whoever holds token. Projects
+        are given unique identifiers, so project names need not be unique.
+        """
+        uname = self.__sessions.user(token)
+        if uname is None:
+            return ("fail", "Who are you")
+
         metadata = json.loads(metadata)
         metadata["name"] = pname
         metadata["owner"] = uname
@@ -174,16 +384,144 @@ class ComposteServer:
 
     def get_project_over_the_wire(self, pid):
         """
-        Retrieve the serialized form of a project for transmission. Currently
-        only used during the initial handshake.
+        Retrieve the serialized form of a project for transmission, along with
+        the version it is at. Currently only used during the initial handshake.
         """
-        proj = self.__pool.put(pid, lambda: self.get_project(pid)[1])
-        self.__pool.remove(pid)
+        # Keep using it until it's serialized, so that it can't be swapped
+        # out for a newer copy underneath us
+        proj = self.__use(pid)
+        try:
+            if type(proj) == str:
+                return ("fail", "What even is that")
+
+            # Every update throws the cached copy away, so anything still
+            # here is what we'd produce anyway
+            with self.__snapshot_lock:
+                cached = self.__snapshots.get(pid, None)
+                if cached is not None:
+                    self.__snapshot_hits += 1
+                    return ("ok",) + cached
+                self.__snapshot_misses += 1
+
+            with self.__locks.project(pid):
+                cached = (json.dumps(proj.serialize()),
+                        self.__log_for(proj).sequence())
+                with self.__snapshot_lock:
+                    # Only the live copy's snapshot is worth handing out
+                    if self.__pool.peek(pid) is proj:
+                        self.__snapshots[pid] = cached
+
+            return ("ok",) + cached
+        finally:
+            self.__give_back(pid)
+
+    def sync(self, pid, version):
+        """
+        Catch a client holding version of a project up to the present.
+        Replies with a json object holding the current version and either the
+        operations applied since version, as [ sequence, operation ], or, if
+        we no longer remember them all, the whole serialized project
+        """
+        try:
+            version = int(version)
+        except ValueError as e:
+            return ("fail", "That doesn't look like a version")
+
+        proj = self.__use(pid)
+        try:
+            if type(proj) == str:
+                return ("fail", "What even is that")
+
+            log = self.__log_for(proj)
+            with self.__locks.project(pid):
+                # Snapshots eat the history they cover
+                if log.base() <= version <= log.sequence():
+                    return ("ok", json.dumps({
+                        "version": log.sequence(),
+                        "operations": log.entries(since = version),
+                    }))
+        finally:
+            self.__give_back(pid)
+
+        reply = self.get_project_over_the_wire(pid)
+        if reply[0] != "ok":
+            return reply
+        (_, snapshot, current) = reply
+        return ("ok", json.dumps({
+            "version": current,
+            "project": snapshot,
+        }))
 
-        if type(proj) == str:
-            return ("fail", "What even is that")
+    def __use(self, pid):
+        """
+        Take a use of a project, loading it if need be. Projects are only
+        written out and let go of under their lock, so holding it while
+        loading keeps us from reading the files just before that and
+        putting a stale copy in the pool after. Don't call while holding the
+        project's lock
+        """
+        with self.__locks.shared(pid):
+            return self.__pool.put(pid, lambda: self.get_project(pid)[1])
+
+    def __give_back(self, pid):
+        """
+        Give back a use of a project. The last use is kept by the server
+        instead, so that a client editing without subscribing doesn't have
+        the project loaded and written out again for every update.
+        evict_idle lets go of it once nobody has come back for a while
+        """
+        with self.__idle_lock:
+            if self.__pool.release(pid):
+                if pid in self.__idle:
+                    self.__idle[pid] = time.monotonic()
+                return
+            # The last use is ours, so it's the server's now
+            self.__idle[pid] = time.monotonic()
+
+    def invalidate_snapshot(self, pid):
+        """
+        Forget the cached serialized form of a project
+        """
+        with self.__snapshot_lock:
+            self.__snapshots.pop(pid, None)
+
+    def get_stats(self):
+        """
+        Retrieve some numbers describing how the server is doing
+        """
+        with self.__snapshot_lock:
+            hits = self.__snapshot_hits
+            misses = self.__snapshot_misses
+            entries = len(self.__snapshots)
+
+        stats = {
+            "snapshot_cache": {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+                "entries": entries,
+            },
+            "flyweights": flyweight.stats(),
+            "updates": self.__applied_counts(),
+            "passwords": self.__passwords.stats(),
+            "sessions": self.__sessions.stats(),
+            "database": self.__db_pool.stats(),
+        }
+        return ("ok", json.dumps(stats))
+
+    def __count_applied(self, fname):
+        """
+        Count an applied update against its operation's cost class
+        """
+        op = musicWrapper.operation(fname)
+        if op is None:
+            return
+        with self.__applied_lock:
+            self.__applied[op.cost] = self.__applied.get(op.cost, 0) + 1
 
-        return ("ok", json.dumps(proj.serialize()))
+    def __applied_counts(self):
+        with self.__applied_lock:
+            return dict(self.__applied)
 
     def get_project(self, pid):
         """
@@ -201,10 +539,15 @@ class ComposteServer:
 
         return ("ok", proj)
 
-    def list_projects_by_user(self, uname):
+    def list_projects_by_user(self, token):
         """
-        Retrieve a list of projects that a user is a collaborator on
+        Retrieve a list of projects that whoever holds token is a
+        collaborator on
         """
+        uname = self.__sessions.user(token)
+        if uname is None:
+            return ("fail", "Who are you")
+
         listings = self.__contributors.get(username = uname)
         listings = [ str(project) for project in listings ]
         return ("ok", json.dumps(listings))
@@ -233,49 +576,96 @@ class ComposteServer:
 
     # Utility
 
-    def write_project(self, project):
+    def __base_path(self, owner, pid):
+        """
+        Where a project's files live, minus the extension
+        """
+        return os.path.join(self.__project_root, owner, str(pid))
+
+    def __log_for(self, project, base = 0):
+        """
+        Fetch the operation log of a project, opening it if need be. base is
+        the sequence number of the snapshot the project was loaded from
+        """
+        pid = str(project.projectID)
+        with self.__logs_lock:
+            log = self.__logs.get(pid, None)
+            if log is None:
+                path = self.__base_path(project.metadata["owner"], pid)
+                log = oplog.OperationLog(path + self.__log_extension, base)
+                self.__logs[pid] = log
+            return log
+
+    def write_project(self, project, sequence = 0):
         """
         I'm going to cheat for now and dump to the filesystem. Ideally we
         write to a database, but that requires more work. Either way, that can
-        be hidden in this function
+        be hidden in this function.
+        The snapshot remembers sequence, the last operation log entry it
+        covers. Files are replaced atomically, so a crash leaves either the
+        old snapshot or the new one
         """
         user = project.metadata["owner"]
         id_ = str(project.projectID)
 
         (metadata, parts, _) = project.serialize()
+        heap = json.dumps({ "sequence": sequence, "parts": parts })
 
-        base_path = os.path.join(self.__project_root, user)
-        base_path = os.path.join(base_path, id_)
-        with open(base_path + self.__metadata_extension, "w") as f:
-            f.write(metadata)
+        base_path = self.__base_path(user, id_)
+        for (extension, contents) in [ (self.__metadata_extension, metadata),
+                (self.__project_extension, heap) ]:
+            with open(base_path + extension + ".tmp", "w") as f:
+                f.write(contents)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(base_path + extension + ".tmp", base_path + extension)
 
-        with open(base_path + self.__project_extension, "w") as f:
-            f.write(parts)
+        return len(metadata) + len(heap)
 
     def read_project(self, pid):
         """
         We've cheated and the projects live on the filesystem. Ideally we want
         them in a database, but that's work. Either way, we hide the true
         locations of projects inside of this function.
+        A project is its last snapshot plus whatever its operation log says
+        happened since
         """
 
         owner = self.__projects.get(pid).owner
+        base_path = self.__base_path(owner, pid)
+
+        # The snapshot and the log have to agree on where one stops and the
+        # other starts
+        with self.__locks.files(pid):
+            with open(base_path + self.__metadata_extension, "r") as f:
+                metadata = f.read()
+
+            with open(base_path + self.__project_extension, "r") as f:
+                heap = json.loads(f.read())
+
+            # Snapshots from before operation logs are bare lists of parts
+            if type(heap) == dict:
+                sequence = heap["sequence"]
+                parts = heap["parts"]
+            else:
+                sequence = 0
+                parts = json.dumps(heap)
+
+            project = composteProject.deserializeProject(
+                (metadata, parts, pid), thaw = self.__thaw
+            )
+
+            log = self.__log_for(project, sequence)
+            entries = log.entries(since = sequence)
+
+        for (seq, operation) in entries:
+            try:
+                musicWrapper.performMusicFun(pid, *operation,
+                        fetchProject = lambda _: project)
+            except:
+                self.__server.error("Failed to replay {} for {}: {}"
+                        .format(seq, pid, traceback.format_exc()))
 
-        filename = pid + self.__metadata_extension
-        relpath = os.path.join(owner, filename)
-        fullpath = os.path.join(self.__project_root, relpath)
-        with open(fullpath, "r") as f:
-            metadata = f.read()
-
-        filename = pid + self.__project_extension
-        relpath = os.path.join(owner, filename)
-        fullpath = os.path.join(self.__project_root, relpath)
-        with open(fullpath, "r") as f:
-            parts = f.read()
-
-        project = composteProject.deserializeProject(
-            (metadata, parts, pid)
-        )
         # Don't put it into the pool yet, because then we end up with a
         # use count that will never be 0 again
         return project
@@ -330,7 +720,7 @@ class ComposteServer:
         """
 
         # Use this function to get a project
-        pid_ = None
+        fetched = []
         def get_fun(pid):
             """
             Fetch a project from the cache
@@ -338,35 +728,155 @@ class ComposteServer:
             # The client musicfuns shouldn't have to worry about how the
             # server manages the lifetimes of project objects
             proj = self.__pool.put(pid, lambda: self.get_project(pid)[1])
-            # We need to steal the pid to release it later
-            pid_ = pid
+            fetched.append((pid, proj))
             return proj
 
-        with self.__flushing:
-            try:
-                # We still need to provide a way to get the project
-                reply = musicWrapper.performMusicFun(*args,
-                        fetchProject = get_fun)
-            except:
-                print(traceback.format_exc())
-                return ("fail", "Internal Server Error")
+        try:
+            with self.__lock_for(*args):
+                return self.__apply_update(args, get_fun, fetched)
+        finally:
+            # Only once the part lock is gone, because letting go of the last
+            # use needs the whole project
+            for (pid, _) in fetched:
+                self.__give_back(pid)
+
+    def __apply_update(self, args, get_fun, fetched):
+        """
+        The body of do_update, run under the lock that covers the update
+        """
+        try:
+            # We still need to provide a way to get the project
+            reply = musicWrapper.performMusicFun(*args,
+                    fetchProject = get_fun)
+        except:
+            self.__server.error(traceback.format_exc())
+            return ("fail", "Internal Server Error")
+
+        if reply[0] != "ok":
+            return reply
+
+        # Chatter doesn't need to be written out
+        if args[1] == "chat":
+            self.__broadcast_update("update", args)
             return reply
 
-            # We can't decrement the refcount before now, because we could
-            # cause an early flush otherwise, and then serverside persistence
-            # is breaks.
-            self.__pool.remove(pid_, self.write_project)
+        # performMusicFun already worked out everything the update could
+        # have changed
+        span = reply[1]
+        # Everything but the project id. Broadcasting from inside the
+        # log keeps broadcasts in version order
+        self.__log_for(fetched[0][1]).append(list(args[1:]),
+                then = lambda seq: self.__broadcast_update("update", args,
+                    seq, span))
+        self.__pool.touch(args[0])
+        self.invalidate_snapshot(args[0])
+        self.__count_applied(args[1])
+        return reply
+
+    def do_update_batch(self, pid, updates):
+        """
+        Perform several music-related updates to one project under a single
+        lock acquisition. updates is a json list of
+            [ update-type, args, partIndex, offset ]
+        Replies with a json list holding the reply to each update. Updates
+        that fail don't stop the rest, and those that succeed are broadcast
+        together
+        """
+        try:
+            updates = json.loads(updates)
+        except ValueError as e:
+            return ("fail", "That doesn't look like a list of updates")
+        if type(updates) != list or \
+                any(type(update) != list for update in updates):
+            return ("fail", "That doesn't look like a list of updates")
+
+        # Make them look like they came in one at a time
+        updates = [ [ str(arg) for arg in update ] for update in updates ]
+
+        replies = []
+        applied = []
+        spans = []
+        with self.__locks.project(pid):
+            proj = self.__pool.put(pid, lambda: self.get_project(pid)[1])
+            if type(proj) == str:
+                self.__give_back(pid)
+                return ("fail", "What even is that")
+
+            try:
+                for update in updates:
+                    if update[0] == "chat":
+                        replies.append(("fail",
+                            "Chat doesn't come in batches"))
+                        continue
+                    try:
+                        reply = musicWrapper.performMusicFun(pid, *update,
+                                fetchProject = lambda _: proj)
+                    except:
+                        self.__server.error(traceback.format_exc())
+                        reply = ("fail", "Internal Server Error")
+                    replies.append(reply)
+                    if reply[0] == "ok":
+                        applied.append(update)
+                        spans.append(reply[1])
+                        self.__count_applied(update[0])
+
+                if len(applied) != 0:
+                    # Nobody else can append while we hold the project lock,
+                    # so the batch gets consecutive versions and one
+                    # broadcast
+                    log = self.__log_for(proj)
+                    for update in applied[:-1]:
+                        log.append(update)
+                    span = [ min(start for (start, _) in spans),
+                             max(end for (_, end) in spans) ]
+                    log.append(applied[-1], then = lambda seq:
+                            self.__broadcast_update("update_batch",
+                                [ pid, json.dumps(applied) ], seq, span))
+                    self.__pool.touch(pid)
+                    self.invalidate_snapshot(pid)
+            finally:
+                self.__give_back(pid)
+
+        return ("ok", json.dumps(replies))
+
+    def __broadcast_update(self, fname, args, version = None, span = None):
+        """
+        Tell everybody interested in a project about an update to it, the
+        version of the project it produced, and the offsets it changed
+        """
+        self.__server.broadcast(client.serialize(fname, *args,
+            version = version, span = span), topic = str(args[0]))
 
-    def subscribe(self, username, pid):
+    def __lock_for(self, pid, fname, args, partIndex = None, offset = None):
         """
-        Subscribe a client to updates for a project. Pins the project in the
-        cache
+        Pick the narrowest lock that covers a music-related update
+        """
+        try:
+            index = int(partIndex)
+        except (TypeError, ValueError):
+            # No particular part, so it could touch any of them
+            return self.__locks.project(pid)
+        # Parts can be counted from the end too, and then the same part
+        # would go by two names. musicWrapper turns those away, but they get
+        # the whole project in the meantime
+        if index < 0:
+            return self.__locks.project(pid)
+        return self.__locks.part(pid, index)
+
+    def subscribe(self, token, pid):
         """
+        Subscribe whoever holds token to updates for a project. Pins the
+        project in the cache
+        """
+        username = self.__sessions.user(token)
+        if username is None:
+            return ("fail", "Who are you")
+
         # Assert permission
         contributors = self.__contributors.get(project_id = pid)
         contributors = [ user.uname for user in contributors ]
         if username in contributors:
-            self.__pool.put(pid, lambda: self.get_project(pid)[1])
+            self.__use(pid)
             cookie = self.generate_cookie_for(username, pid)
             return ("ok", str(cookie))
         else:
@@ -387,10 +897,8 @@ class ComposteServer:
         (status, reason) = self.remove_cookie(cookie)
 
         if status == "ok":
-            project = self.__pool.put(project_id,
-                    lambda x: self.get_project(x)[1])
-            pid = project.projectID
-            self.__pool.remove(pid, lambda x: self.write_project(x))
+            # Give back the use subscribe took
+            self.__give_back(project_id)
 
         return (status, reason)
 
@@ -401,21 +909,34 @@ class ComposteServer:
         """
         dbname = "data/composte.db"
 
-        if self.__users is None:
-            self.__users = driver.Auth(dbname)
+        with self.__db_lock:
+            if self.__db_pool is None:
+                self.__db_pool = driver.Pool(dbname)
+
+            if self.__users is None:
+                self.__users = driver.Auth(dbname, self.__db_pool)
 
-        if self.__projects is None:
-            self.__projects = driver.Projects(dbname)
+            if self.__projects is None:
+                self.__projects = driver.Projects(dbname, self.__db_pool)
 
-        if self.__contributors is None:
-            self.__contributors = driver.Contributors(dbname)
+            if self.__contributors is None:
+                self.__contributors = driver.Contributors(dbname,
+                        self.__db_pool)
 
-    def share(self, pid, new_contributor):
+    def share(self, token, pid, new_contributor):
         """
-        Add a new user to the list of contributors to a project
+        Add a new user to the list of contributors to a project. Only
+        contributors may share a project
         """
+        uname = self.__sessions.user(token)
+        if uname is None:
+            return ("fail", "Who are you")
 
         contributors = self.__contributors.get(project_id = pid)
+        contributors = [ user.uname for user in contributors ]
+        if uname not in contributors:
+            return ("fail", "That's not yours to share")
+
         user = self.__users.get(new_contributor)
 
         # If that's not a known user, fail
@@ -449,14 +970,18 @@ class ComposteServer:
         rpc_funs = {
             "register": self.register,
             "login": self.login,
+            "logout": self.logout,
             "create_project": self.create_project,
             "list_projects": self.list_projects_by_user,
             "get_project": self.get_project_over_the_wire,
             "subscribe": self.subscribe,
             "unsubscribe": self.unsubscribe,
             "update": self.do_update,
+            "update_batch": self.do_update_batch,
             "handshake": self.compare_versions,
             "share": self.share,
+            "stats": self.get_stats,
+            "sync": self.sync,
         }
 
         self.__server.debug(rpc)
@@ -465,21 +990,15 @@ class ComposteServer:
         do_rpc = rpc_funs.get(f, fail)
 
         try:
-            # This is expected to be a tuple of things to send back
-            (status, other) = do_rpc(*rpc["args"])
+            # This is expected to be a tuple of things to send back, status
+            # first. Successful updates broadcast themselves
+            return do_rpc(*rpc["args"])
         except GenericError as e:
             return ("fail", "Internal server error")
         except:
             self.__server.error(traceback.format_exc())
             return ("fail", "Internal server error (Developer error)")
 
-        # Only broadcast successful updates
-        if f == "update" and status == "ok":
-            self.__server.broadcast(client.serialize(rpc["fName"],
-                *rpc["args"]))
-
-        return (status, other)
-
     def __preprocess(self, message):
         """
         Deserialize messages for consumption by __handle
@@ -502,10 +1021,23 @@ class ComposteServer:
         with self.__dlock:
             self.__done = True
 
+        # Logins still in flight reply through the network server, so they
+        # go first, and nothing may update a project once its log is closed,
+        # so the network server goes before anything gets written out
+        self.__passwords.shutdown()
+        self.__server.stop()
+
         self.__timer.join()
-        self.__pool.map(self.flush_project)
+        self.__sweeper.join()
+        self.flush_dirty()
 
-        self.__server.stop()
+        with self.__logs_lock:
+            for log in self.__logs.values():
+                log.close()
+
+        with self.__db_lock:
+            if self.__db_pool is not None:
+                self.__db_pool.close()
 
 def stop_server(sig, frame, server):
     """
@@ -525,6 +1057,24 @@ if __name__ == "__main__":
             type = int)
     parser.add_argument("-b", "--broadcast-port", default = 5001,
             type = int)
+    parser.add_argument("-w", "--workers", default = 4,
+            type = int)
+    parser.add_argument("-f", "--flush-interval", default = 10,
+            type = int)
+    parser.add_argument("--flush-budget", default = 4 * 1024 * 1024,
+            type = int)
+    parser.add_argument("--compact-size", default = 256 * 1024,
+            type = int)
+    parser.add_argument("--score-engine", default = "music21",
+            choices = [ "music21", "numpy" ])
+    parser.add_argument("--hash-workers", default = 2,
+            type = int)
+    parser.add_argument("--logins-per-source", default = 2,
+            type = int)
+    parser.add_argument("--session-lifetime", default = 60 * 60,
+            type = int)
+    parser.add_argument("--idle-timeout", default = 60,
+            type = int)
 
     args = parser.parse_args()
 
@@ -536,7 +1086,15 @@ if __name__ == "__main__":
     real_log = Combined((log, StdErr))
 
     s = ComposteServer("tcp://*:{}".format(args.interactive_port),
-            "tcp://*:{}".format(args.broadcast_port), real_log, Encryption())
+            "tcp://*:{}".format(args.broadcast_port), real_log, Encryption(),
+            workers = args.workers, flush_interval = args.flush_interval,
+            flush_budget = args.flush_budget,
+            compact_size = args.compact_size,
+            score_engine = args.score_engine,
+            hash_workers = args.hash_workers,
+            logins_per_source = args.logins_per_source,
+            session_lifetime = args.session_lifetime,
+            idle_timeout = args.idle_timeout)
 
     signal.signal(signal.SIGINT , lambda sig, f: stop_server(sig, f, s))
     signal.signal(signal.SIGQUIT, lambda sig, f: stop_server(sig, f, s))
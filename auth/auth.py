@@ -1,6 +1,13 @@
 
 from passlib.hash import pbkdf2_sha256
 
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Lock
+import hashlib
+import multiprocessing
+import secrets
+import time
+
 def hash(hashable):
     """
     Create a hash
@@ -15,3 +22,150 @@ def verify(candidate, record):
     """
     return pbkdf2_sha256.verify(candidate, record)
 
+class Hasher:
+    """
+    Runs hash and verify in a pool of processes, so that a crowd logging in
+    doesn't hold up everybody else. At most per_source jobs may be in flight
+    for any one source, and at most pending in all
+    """
+    def __init__(self, processes = 2, per_source = 2, pending = 64):
+        # Forking a process full of threads and ØMQ sockets is asking for it
+        self.__pool = ProcessPoolExecutor(processes,
+                mp_context = multiprocessing.get_context("spawn"))
+        self.__per_source = per_source
+        self.__max_pending = pending
+
+        self.__lock = Lock()
+        # source -> jobs in flight
+        self.__busy = {}
+        self.__pending = 0
+        self.__refused = 0
+
+    def hash(self, hashable, source = None, then = lambda record: record):
+        """
+        A Future of then(hash(hashable)), or None if source has too much in
+        flight already
+        """
+        return self.__submit(source, then, hash, hashable)
+
+    def verify(self, candidate, record, source = None,
+            then = lambda success: success):
+        """
+        A Future of then(verify(candidate, record)), or None if source has too
+        much in flight already
+        """
+        return self.__submit(source, then, verify, candidate, record)
+
+    def __submit(self, source, then, fun, *args):
+        with self.__lock:
+            if self.__pending >= self.__max_pending or \
+                    self.__busy.get(source, 0) >= self.__per_source:
+                self.__refused += 1
+                return None
+            self.__busy[source] = self.__busy.get(source, 0) + 1
+            self.__pending += 1
+
+        done = Future()
+        def finish(work):
+            with self.__lock:
+                self.__pending -= 1
+                self.__busy[source] -= 1
+                if self.__busy[source] == 0:
+                    del self.__busy[source]
+            try:
+                done.set_result(then(work.result()))
+            except BaseException as e:
+                done.set_exception(e)
+
+        try:
+            self.__pool.submit(fun, *args).add_done_callback(finish)
+        except RuntimeError as e:
+            # Shut down already
+            finish_now = Future()
+            finish_now.set_exception(e)
+            finish(finish_now)
+        return done
+
+    def stats(self):
+        """
+        How many jobs are in flight, from how many sources, and how many have
+        been turned away
+        """
+        with self.__lock:
+            return { "pending": self.__pending, "sources": len(self.__busy),
+                     "refused": self.__refused }
+
+    def shutdown(self):
+        """
+        Finish whatever is in flight and stop the pool
+        """
+        self.__pool.shutdown(wait = True)
+
+def _digest(token):
+    return hashlib.sha256(str(token).encode()).digest()
+
+class Sessions:
+    """
+    Session tokens handed out at login, each good until lifetime seconds
+    after it was last used
+    """
+    def __init__(self, lifetime = 60 * 60):
+        self.__lifetime = lifetime
+        self.__lock = Lock()
+        # Tokens are kept by digest, so that how long a lookup takes says
+        # nothing about how close a guess came
+        # digest -> [ username, expiry ]
+        self.__sessions = {}
+
+    def issue(self, uname):
+        """
+        A new token for uname
+        """
+        token = secrets.token_urlsafe(32)
+        with self.__lock:
+            self.__sessions[_digest(token)] = [ uname,
+                    time.monotonic() + self.__lifetime ]
+        return token
+
+    def user(self, token):
+        """
+        The user token was issued to, or None if it's not a token we know or
+        it has expired. Using a token keeps it alive
+        """
+        key = _digest(token)
+        now = time.monotonic()
+        with self.__lock:
+            session = self.__sessions.get(key, None)
+            if session is None:
+                return None
+            if session[1] <= now:
+                del self.__sessions[key]
+                return None
+            session[1] = now + self.__lifetime
+            return session[0]
+
+    def revoke(self, token):
+        """
+        Forget a token. Returns whether there was one to forget
+        """
+        with self.__lock:
+            return self.__sessions.pop(_digest(token), None) is not None
+
+    def sweep(self):
+        """
+        Forget every expired token. Returns how many there were
+        """
+        now = time.monotonic()
+        with self.__lock:
+            expired = [ key for (key, (_, expiry)) in self.__sessions.items()
+                    if expiry <= now ]
+            for key in expired:
+                del self.__sessions[key]
+        return len(expired)
+
+    def stats(self):
+        """
+        How many sessions are open
+        """
+        with self.__lock:
+            return { "sessions": len(self.__sessions) }
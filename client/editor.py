@@ -197,7 +197,8 @@ class Editor(QtWidgets.QMainWindow):
         """
         if fn is None:
             msg = ('help/?       --  Display this help message\n'
-                   'CMD1 ; CMD2  --  Execute CMD1 followed by CMD2')
+                   'CMD1 ; CMD2  --  Execute CMD1 followed by CMD2, sending '
+                   'their updates together')
             self.__debugConsoleWrite(msg)
         if fn == 'clear' or fn is None:
             msg = 'clear        --  Clear the debug console history'
@@ -310,9 +311,23 @@ class Editor(QtWidgets.QMainWindow):
         self.__ui_debugConsole_input.clear()
         if not text:
             return
-        cmdstrs = map(str.strip, text.split(';'))
-        for cmdstr in cmdstrs:
-            self.__processDebugCommand(cmdstr)
+        cmdstrs = list(map(str.strip, text.split(';')))
+        if len(cmdstrs) == 1:
+            self.__processDebugCommand(cmdstrs[0])
+            return
+
+        # Send all of the updates together, rather than one at a time. If
+        # somebody else is already batching, their batch takes ours too
+        batching = self.__client.begin_batch(
+                self.__client.project().projectID)[0] == 'ok'
+        try:
+            for cmdstr in cmdstrs:
+                self.__processDebugCommand(cmdstr)
+        finally:
+            if batching:
+                reply = self.__client.end_batch()
+                if reply[0] != 'ok':
+                    self.__debugConsoleWrite('Batch failed: ' + str(reply[1]))
 
     def __processDebugCommand(self, cmdstr):
         """
@@ -3,23 +3,117 @@
 
 import sqlite3
 import json
-from threading import Lock
+from threading import Lock, local
 
 # We are inspired by Django, but we're not that good at
 # introspection/reflection
 
 # ._.
-def get_connection(dbname):
+def get_connection(dbname, cache_kib = 8 * 1024, statements = 64,
+        timeout = 5.0):
     """
     Open a databse connection and make sure that foreign key constraints are
     enabled for every connection, because they aren't by default and for some
     reason that can be changed _per connection_.
+    The database is put in write-ahead log mode, so that readers don't wait on
+    writers or the other way around, and only syncs at checkpoints, which in
+    WAL mode still can't corrupt it. Each connection keeps up to cache_kib KiB
+    of pages and statements prepared statements around, and waits up to
+    timeout seconds for somebody else's write to finish before giving up
     """
-    conn = sqlite3.connect(dbname)
+    # check_same_thread only so that Pool.close can close everything from
+    # wherever it's called. Nothing else ever shares a connection
+    conn = sqlite3.connect(dbname, timeout = timeout,
+            cached_statements = statements, check_same_thread = False)
     conn.execute("PRAGMA foreign_keys = \"1\"") # ಠ_ಠ
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = {}".format(-int(cache_kib)))
+    conn.execute("PRAGMA temp_store = MEMORY")
     conn.commit()
     return conn
 
+class Pool:
+    """
+    One connection to a database per thread, opened the first time a thread
+    asks for one. Reads go through the calling thread's own connection and
+    never wait on each other. Writes are serialized here, so that they queue
+    up on a lock instead of spinning on a busy database
+    """
+    def __init__(self, dbname, cache_kib = 8 * 1024, statements = 64):
+        self.__dbname = dbname
+        self.__cache_kib = cache_kib
+        self.__statements = statements
+
+        self.__local = local()
+        self.__lock = Lock()
+        # Every connection handed out, so that they can all be closed
+        self.__conns = []
+        self.__closed = False
+
+        self.__wlock = Lock()
+
+    def connection(self):
+        """
+        The calling thread's connection
+        """
+        conn = getattr(self.__local, "conn", None)
+        if conn is not None:
+            return conn
+
+        with self.__lock:
+            if self.__closed:
+                raise sqlite3.ProgrammingError("The pool is closed")
+            conn = get_connection(self.__dbname, self.__cache_kib,
+                    self.__statements)
+            self.__conns.append(conn)
+        self.__local.conn = conn
+        return conn
+
+    # The SQL passed in should be the same string every time for the same
+    # query, because that's what sqlite3 caches prepared statements by
+    def fetchone(self, sql, args = ()):
+        """
+        The first row sql produces, or None
+        """
+        return self.connection().execute(sql, args).fetchone()
+
+    def fetchall(self, sql, args = ()):
+        """
+        Every row sql produces
+        """
+        return self.connection().execute(sql, args).fetchall()
+
+    def write(self, sql, args = ()):
+        """
+        Run and commit a single write. Rolls back on failure
+        """
+        conn = self.connection()
+        with self.__wlock:
+            # As a context manager, the connection commits or rolls back
+            with conn:
+                conn.execute(sql, args)
+
+    def stats(self):
+        """
+        How many connections are open
+        """
+        with self.__lock:
+            return { "connections": len(self.__conns) }
+
+    def close(self):
+        """
+        Close every connection. Threads that ask for another afterwards get a
+        ProgrammingError
+        """
+        with self.__lock:
+            self.__closed = True
+            conns = self.__conns
+            self.__conns = []
+        with self.__wlock:
+            for conn in conns:
+                conn.close()
+
 class User:
     """
     POD class representing users
@@ -45,38 +139,35 @@ class Auth:
     # We're so bad at CRUD that we only bother to do half of it
     __blueprint = ("username", "hash", "email")
 
-    def __init__(self, dbname):
-        self.__conn = get_connection(dbname)
-        self.__cursor = self.__conn.cursor()
+    __insert = """
+            INSERT INTO auth (username, hash, email)
+            VALUES (?, ?, ?)
+            """
+    __select = """
+            SELECT * FROM auth WHERE username=?
+            """
+
+    def __init__(self, dbname, pool = None):
+        self.__pool = pool if pool is not None else Pool(dbname)
 
-        self.__cursor.execute(""" CREATE TABLE IF NOT EXISTS auth
+        self.__pool.write(""" CREATE TABLE IF NOT EXISTS auth
                 ( username TEXT PRIMARY KEY NOT NULL,
                   hash TEXT NOT NULL,
                   email TEXT)""")
-        self.__conn.commit()
-        self.__lock = Lock()
 
     # Create
     def put(self, username, hash_, email = "null"):
         """
         Create a new auth record
         """
-        with self.__lock:
-            self.__cursor.execute("""
-                    INSERT INTO auth (username, hash, email)
-                    VALUES (?, ?, ?)
-                    """, (username, hash_, email))
-            self.__conn.commit()
+        self.__pool.write(self.__insert, (username, hash_, email))
 
     # Retrieve
     def get(self, username):
         """
         Attempt to retrieve an existing auth record
         """
-        self.__cursor.execute("""
-                SELECT * FROM auth WHERE username=?
-                """, (username,))
-        tup = self.__cursor.fetchone()
+        tup = self.__pool.fetchone(self.__select, (username,))
         if tup is None:
             return User(None, None, None)
         return User(*tup)
@@ -110,39 +201,34 @@ class Projects:
     """
     __blueprint = ("id", "name", "owner")
 
-    def __init__(self, dbname):
-        self.__conn = get_connection(dbname)
-        self.__cursor = self.__conn.cursor()
+    __insert = """
+            INSERT INTO projects (id, name, owner)
+            VALUES (?, ?, ?)
+            """
+    __select = """
+            SELECT * FROM projects WHERE id=?
+            """
+
+    def __init__(self, dbname, pool = None):
+        self.__pool = pool if pool is not None else Pool(dbname)
 
-        self.__cursor.execute("""
+        self.__pool.write("""
                 CREATE TABLE IF NOT EXISTS projects
                 ( id TEXT PRIMARY KEY NOT NULL,
                   name TEXT NOT NULL,
                   owner TEXT NOT NULL REFERENCES auth(username))""")
 
-        self.__conn.commit()
-
-        self.__lock = Lock()
-
     def put(self, id_, name, owner):
         """
         Insert a project record
         """
-        with self.__lock:
-            self.__cursor.execute("""
-                    INSERT INTO projects (id, name, owner)
-                    VALUES (?, ?, ?)
-                    """, (id_, name, owner))
-            self.__conn.commit()
+        self.__pool.write(self.__insert, (id_, name, owner))
 
     def get(self, id_):
         """
         Retrieve a project record
         """
-        self.__cursor.execute("""
-                SELECT * FROM projects WHERE id=?
-                """, (id_,))
-        tup = self.__cursor.fetchone()
+        tup = self.__pool.fetchone(self.__select, (id_,))
         if tup is None:
             return Project(None, None, None)
         return Project(*tup)
@@ -151,18 +237,29 @@ class Contributors:
     """
     CRU̶D̶ wrapper around contributor relationships between Users and Projects
     """
-    def __init__(self, dbname):
-        self.__conn = get_connection(dbname)
-        self.__cursor = self.__conn.cursor()
-
-        self.__cursor.execute("""
+    __insert = """
+            INSERT INTO contributors (username, project_id)
+            VALUES (?, ?)
+            """
+    __select_users = """
+            SELECT username FROM contributors
+            WHERE project_id=?
+            """
+    __select_projects = """
+            SELECT projects.id, projects.name, projects.owner
+            FROM projects INNER JOIN contributors
+                ON projects.id = contributors.project_id
+            WHERE contributors.username = ?
+            """
+
+    def __init__(self, dbname, pool = None):
+        self.__pool = pool if pool is not None else Pool(dbname)
+
+        self.__pool.write("""
                 CREATE TABLE IF NOT EXISTS contributors (
                     username TEXT NOT NULL REFERENCES auth(username),
                     project_id TEXT NOT NULL REFERENCES projects(id),
                     PRIMARY KEY (username, project_id)) """)
-        self.__conn.commit()
-
-        self.__lock = Lock()
 
     def put(self, username, project_id):
         """
@@ -170,11 +267,7 @@ class Contributors:
         Or equivalently,
         Declare that username is a contributor to project_id
         """
-        self.__cursor.execute("""
-                INSERT INTO contributors (username, project_id)
-                VALUES (?, ?)
-                """, (username, project_id))
-        self.__conn.commit()
+        self.__pool.write(self.__insert, (username, project_id))
 
     def get(self, username = None, project_id = None):
         """
@@ -198,27 +291,15 @@ class Contributors:
         """
         Retrieve users who are contributors to the project
         """
-        with self.__lock:
-            self.__cursor.execute("""
-                    SELECT username FROM contributors
-                    WHERE project_id=?
-                    """, (project_id,))
-            users = self.__cursor.fetchall()
-            return [ User(*user) for user in users ]
+        users = self.__pool.fetchall(self.__select_users, (project_id,))
+        return [ User(*user) for user in users ]
 
     def get_projects(self, username):
         """
         Retrieve projects that the user can contribute to
         """
-        with self.__lock:
-            self.__cursor.execute("""
-                    SELECT projects.id, projects.name, projects.owner
-                    FROM projects INNER JOIN contributors
-                        ON projects.id = contributors.project_id
-                    WHERE contributors.username = ?
-                    """, (username,))
-            projects = self.__cursor.fetchall()
-            return [ Project(*project) for project in projects ]
+        projects = self.__pool.fetchall(self.__select_projects, (username,))
+        return [ Project(*project) for project in projects ]
 
 if __name__ == "__main__":
     import os
@@ -228,9 +309,10 @@ if __name__ == "__main__":
     except:
         pass
 
-    auth  = Auth("compose.db")
-    proj = Projects("composte.db")
-    own = Contributors("composte.db")
+    pool = Pool("composte.db")
+    auth  = Auth("composte.db", pool)
+    proj = Projects("composte.db", pool)
+    own = Contributors("composte.db", pool)
 
     auth.put("shark meldon", "there", "hello@composte.me")
     auth.put("save me", "whee", "saveme@composte.me")
@@ -242,4 +324,3 @@ if __name__ == "__main__":
     own.put("shark meldon", "2")
 
     # own.put("not", "real")
-
@@ -23,12 +23,33 @@ class Subscription(Loggable):
         # Subscription to remote broadcasts
         self.__addr = remote_address
         self.__socket = self.__context.socket(zmq.SUB)
-        self.__socket.setsockopt_string(zmq.SUBSCRIBE, "")
         self.__socket.connect(self.__addr)
+        # Nothing gets through until somebody asks for a topic
+        self.__topics = set()
 
         self.__backlog = Queue(1024)
         self.__lock = Lock()
 
+    def subscribe(self, topic):
+        """
+        Subscription.subscribe(self, topic)
+        Start receiving broadcasts published under topic
+        """
+        with self.__lock:
+            if topic in self.__topics: return
+            self.__socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+            self.__topics.add(topic)
+
+    def unsubscribe(self, topic):
+        """
+        Subscription.unsubscribe(self, topic)
+        Stop receiving broadcasts published under topic
+        """
+        with self.__lock:
+            if topic not in self.__topics: return
+            self.__socket.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+            self.__topics.remove(topic)
+
     def recv(self, poll_timeout = 500):
         """
         Subscription.recv(self, poll_timeout = 500)
@@ -48,7 +69,9 @@ class Subscription(Loggable):
                     msg = None
                     return msg
                 for i in range(nmsg):
-                    self.__backlog.put(self.__socket.recv_string())
+                    # [ topic, message ]
+                    parts = self.__socket.recv_multipart()
+                    self.__backlog.put(parts[-1].decode())
                 msg = self.__backlog.get()
 
         return msg
@@ -116,6 +139,20 @@ class Client(Loggable):
                 raise e
             return msg
 
+    def subscribe(self, topic):
+        """
+        Client.subscribe(self, topic)
+        Receive broadcasts published under topic
+        """
+        self.__listener.subscribe(topic)
+
+    def unsubscribe(self, topic):
+        """
+        Client.unsubscribe(self, topic)
+        Stop receiving broadcasts published under topic
+        """
+        self.__listener.unsubscribe(topic)
+
     def pause_background(self):
         self.__background_lock.acquire()
 
@@ -209,6 +246,9 @@ if __name__ == "__main__":
     s2 = Client("tcp://127.0.0.1:5000", "tcp://127.0.0.1:5001", DevNull,
             Encryption())
 
+    s1.subscribe("")
+    s2.subscribe("")
+
     # Start broadcast handlers
     s1.start_background(echo, lambda m: id("1: ", m), 500)
     s2.start_background(echo, lambda m: id("2: ", m), 500)
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
 import zmq
-# A REP socket replies to the client who sent the last message. This means
-# that we can't really get away with worker threads here, as
-# REQ/Processing/REP must be serialized as a cohesive unit. This problem seems
-# to be generally tractable though, per
-# https://stackoverflow.com/questions/29420666/zmq-multiple-request-reply-pairs
+# A REP socket replies to the client who sent the last message, so a single
+# REP socket can't really get away with worker threads, as REQ/Processing/REP
+# must be serialized as a cohesive unit. Instead, clients talk to a ROUTER,
+# which hands requests off to a pool of workers through a DEALER. The
+# routing envelope rides along with each request, so replies still find their
+# way home. Per the ØMQ guide's multithreaded server,
+# http://zguide.zeromq.org/page:all#Multithreading-with-ZeroMQ
+#
+# Workers are DEALERs rather than REPs, and keep hold of the envelope
+# themselves, so that a handler can hand back a Future instead of a reply and
+# get on with the next request. Whoever finishes the Future sends the reply
+# home through the replies socket.
 
 from network.fake.security import Encryption, Log
 from network.base.exceptions import DecryptError, EncryptError, GenericError
@@ -13,7 +20,8 @@ from network.base.loggable import Loggable, StdErr
 from network.conf import logging as log
 
 import logging
-from threading import Lock, Thread
+from concurrent.futures import Future
+from threading import Lock, Thread, local
 
 # Need signal handlers to properly run as daemon
 import signal
@@ -23,28 +31,46 @@ import traceback
 DEBUG = False
 
 # Broadcast socket   -> Publish/Subscribe
-# Interactive socket -> Request/Reply
+# Interactive socket -> Router/Dealer -> Dealer (per worker)
 class Server(Loggable):
     __context = zmq.Context()
     def __init__(self, interactive_address, broadcast_address,
-            logger, encryption_scheme = Encryption()):
+            logger, encryption_scheme = Encryption(), workers = 4):
         """
         Server.__init__(self, interactive_address, broadcast_address,
-            logger, encryption_scheme = Encryption(), logger = None)
+            logger, encryption_scheme = Encryption(), workers = 4)
         The network server for Composte.
         interactive_address and broadcast_address must be available for this
         application to bind to.
         encryption_scheme must provide encrypt and decrypt methods
         logger must support at least the methods of base.loggable.Loggable
+        workers controls how many requests may be processed concurrently
         """
         super(Server, self).__init__(logger)
 
         self.__translator = encryption_scheme
 
         self.__iaddr = interactive_address
-        self.__isocket = self.__context.socket(zmq.REP)
+        self.__isocket = self.__context.socket(zmq.ROUTER)
         self.__isocket.bind(self.__iaddr)
 
+        # Workers pick up requests from here
+        self.__waddr = "inproc://composte-workers-{}".format(id(self))
+        self.__wsocket = self.__context.socket(zmq.DEALER)
+        self.__wsocket.bind(self.__waddr)
+        self.__nworkers = max(1, int(workers))
+
+        # Replies to requests whose handlers returned a Future come back here
+        self.__raddr = "inproc://composte-replies-{}".format(id(self))
+        self.__rsocket = self.__context.socket(zmq.PULL)
+        self.__rsocket.bind(self.__raddr)
+        self.__later = self.__context.socket(zmq.PUSH)
+        self.__later.connect(self.__raddr)
+        self.__llock = Lock()
+
+        # Where the request each worker is handling came from
+        self.__current = local()
+
         self.__baddr = broadcast_address
         self.__bsocket = self.__context.socket(zmq.PUB)
         self.__bsocket.bind(self.__baddr)
@@ -52,110 +78,248 @@ class Server(Loggable):
         self.__dlock = Lock()
         self.__done = False
 
-        self.__ilock = Lock()
         self.__block = Lock();
 
         self.__listen_thread = None
+        self.__workers = []
 
         # self.info("Bound to {} and {}".format(self.__iaddr, self.__baddr))
 
-    def broadcast(self, message):
+    def broadcast(self, message, topic = ""):
         """
-        Server.broadcast(self, message)
-        Broadcast a message to all subscribed clients
+        Server.broadcast(self, message, topic = "")
+        Broadcast a message to all clients subscribed to topic. Clients
+        filter on their end, so only those that asked for topic get it
         """
-        self.info("Broadcasting {}".format(message))
+        self.info("Broadcasting {} to {}".format(message, repr(topic)))
         with self.__block:
-            self.__bsocket.send_string(message)
+            self.__bsocket.send_multipart([topic.encode(), message.encode()])
+
+    def source(self):
+        """
+        Server.source(self)
+        Where the request being handled by the calling thread came from, as
+        the peer's address where ØMQ knows it. None outside of a handler
+        """
+        return getattr(self.__current, "source", None)
 
     def fail(self, message, reason):
         """
         Server.fail(self, message, reason)
-        Send a failure message to a client
+        Log a failure and produce the failure message to send to a client
         """
         # Probably need a better generic failure message format, but eh
         self.error("Failure ({}): {}".format(message, reason))
-        self.__isocket.send_string("Failure ({}): {}".format(reason,
-            message))
+        return "Failure ({}): {}".format(reason, message)
 
     def start_background(self, handler = lambda x: x,
             preprocess = lambda x: x, postprocess = lambda msg: msg,
             poll_timeout = 2000):
         """
         Server.start_background
-        Starts Server.__listen_almost_forever in a background thread,
-        forwarding arguments. For further details, see
-        Server.__listen_almost_forever
+        Starts Server.__listen_almost_forever in a background thread and
+        Server.__work_almost_forever in each worker thread, forwarding
+        arguments. For further details, see Server.__listen_almost_forever and
+        Server.__work_almost_forever
         """
         if self.__listen_thread != None: return
+
+        for i in range(self.__nworkers):
+            worker = Thread(target = self.__work_almost_forever,
+                    args = (handler, preprocess, postprocess, poll_timeout))
+            worker.start()
+            self.__workers.append(worker)
+
         self.__listen_thread = Thread(target = self.__listen_almost_forever,
-                args = (handler, preprocess, postprocess, poll_timeout))
+                args = (poll_timeout,))
         self.__listen_thread.start()
 
-    def __listen_almost_forever(self, handler = lambda x: x,
+    def __is_done(self):
+        with self.__dlock:
+            return self.__done
+
+    def __listen_almost_forever(self, poll_timeout = 2000):
+        """
+        Server.__listen_almost_forever(self, poll_timeout = 2000)
+        Shuttles messages between the interactive socket and the workers until
+        the server is stopped. poll_timeout controls how long a poll operation
+        will wait before failing.
+        """
+        poller = zmq.Poller()
+        poller.register(self.__isocket, zmq.POLLIN)
+        poller.register(self.__wsocket, zmq.POLLIN)
+        poller.register(self.__rsocket, zmq.POLLIN)
+
+        try:
+            while not self.__is_done():
+                ready = dict(poller.poll(poll_timeout))
+
+                # Multipart, so that the routing envelope survives the trip.
+                # Where the request came from rides along in front of it
+                if ready.get(self.__isocket) == zmq.POLLIN:
+                    frames = self.__isocket.recv_multipart(copy = False)
+                    self.__wsocket.send_multipart([ self.__source_of(frames) ]
+                            + frames)
+
+                if ready.get(self.__wsocket) == zmq.POLLIN:
+                    self.__isocket.send_multipart(
+                            self.__wsocket.recv_multipart())
+
+                if ready.get(self.__rsocket) == zmq.POLLIN:
+                    self.__isocket.send_multipart(
+                            self.__rsocket.recv_multipart())
+        except KeyboardInterrupt as e:
+            self.stop()
+
+        iaddr = self.__isocket.last_endpoint.decode()
+        self.info("Unbinding interactive socket from {}".format(iaddr))
+        self.__isocket.unbind(iaddr)
+        self.__isocket.close(linger = 0)
+        self.__wsocket.close(linger = 0)
+        self.__rsocket.close(linger = 0)
+
+    def __source_of(self, frames):
+        """
+        Server.__source_of(self, frames)
+        The peer address a request arrived from, or failing that, the identity
+        of the connection it arrived on
+        """
+        try:
+            return frames[-1].get("Peer-Address").encode()
+        except (zmq.ZMQError, AttributeError):
+            return frames[0].bytes
+
+    def __work_almost_forever(self, handler = lambda x: x,
             preprocess = lambda x: x, postprocess = lambda msg: msg,
             poll_timeout = 2000):
         """
-        Server.__listen_almost_forever(self, handler = lambda msg: msg,
-            preprocess = lambda msg: msg, poll_timeout = 2000)
-        Polls for messages on the interactive socket until the server is
-        stopped. poll_timeout controls how long a poll operation will wait
-        before failing.
+        Server.__work_almost_forever(self, handler = lambda msg: msg,
+            preprocess = lambda msg: msg, postprocess = lambda msg: msg,
+            poll_timeout = 2000)
+        Polls for requests handed off by the interactive socket until the
+        server is stopped. poll_timeout controls how long a poll operation
+        will wait before failing.
         Messages are pushed through the pipeline preprocess -> handler ->
-        postprocess, and the result is sent back to as a client
+        postprocess, and the result is sent back to the client.
+        handler may be invoked from several workers at once. If it returns a
+        Future, the reply goes out once the Future is done, and the worker
+        moves on without waiting for it.
         """
+        socket = self.__context.socket(zmq.DEALER)
+        socket.connect(self.__waddr)
+
         try:
-            while True:
-                with self.__dlock:
-                    if self.__done: break
-
-                with self.__ilock:
-                    nmsg = self.__isocket.poll(poll_timeout)
-                    if nmsg == 0:
-                        continue
-                    message =  self.__isocket.recv_string()
-                    # Unconditionally catch and ignore _all_ unexpected
-                    # exceptions during the invocations of client-provided
-                    # functions
-                    try:
-                        try:
-                            message = self.__translator.decrypt(message)
-                        except DecryptError as e:
-                            self.fail(message, "Decryption failure")
-                            continue
-
-                        try:
-                            message = preprocess(message)
-                        except GenericError as e:
-                            self.fail(message, "Internal server error")
-                            continue
-
-                        try:
-                            reply = handler(self, message)
-                        except GenericError as e:
-                            self.fail(message, "Internal server error")
-                            continue
-
-                        try:
-                            reply = postprocess(reply)
-                        except GenericError as e:
-                            self.fail(message, "Internal server error")
-                            continue
-
-                        try:
-                            reply = self.__translator.encrypt(reply)
-                        except EncryptError as e:
-                            self.fail(message, "Encryption failure")
-                            continue
-                    except:
-                        self.fail(message, "Malformed message")
-                        self.error("Uncaught exception: {}"
-                                .format(traceback.format_exc()))
-                        continue
-
-                    self.__isocket.send_string(reply)
-        except KeyboardInterrupt as e:
-            self.stop()
+            while not self.__is_done():
+                nmsg = socket.poll(poll_timeout)
+                if nmsg == 0:
+                    continue
+                frames = socket.recv_multipart()
+                (source, envelope) = (frames[0].decode(errors = "replace"),
+                        frames[1:-1])
+                try:
+                    message = frames[-1].decode()
+                except UnicodeDecodeError as e:
+                    # Nothing we can do with it, but the client still
+                    # deserves an answer
+                    reply = self.fail(frames[-1].decode(errors = "replace"),
+                            "Malformed message")
+                    socket.send_multipart(envelope + [ reply.encode() ])
+                    continue
+
+                self.__current.source = source
+                try:
+                    reply = self.__process(message, handler, preprocess,
+                            postprocess)
+                finally:
+                    self.__current.source = None
+
+                if isinstance(reply, Future):
+                    reply.add_done_callback(lambda done, envelope = envelope:
+                            self.__reply_later(envelope, done.result()))
+                    continue
+                socket.send_multipart(envelope + [ reply.encode() ])
+        finally:
+            socket.close(linger = 0)
+
+    def __reply_later(self, envelope, reply):
+        """
+        Server.__reply_later(self, envelope, reply)
+        Send the reply to a request whose handler returned a Future
+        """
+        with self.__llock:
+            self.__later.send_multipart(envelope + [ reply.encode() ])
+
+    def __process(self, message, handler, preprocess, postprocess):
+        """
+        Server.__process(self, message, handler, preprocess, postprocess)
+        Push a single message through the pipeline, producing the reply to
+        send back to the client
+        """
+        # Unconditionally catch and ignore _all_ unexpected exceptions during
+        # the invocations of client-provided functions
+        try:
+            try:
+                message = self.__translator.decrypt(message)
+            except DecryptError as e:
+                return self.fail(message, "Decryption failure")
+
+            try:
+                message = preprocess(message)
+            except GenericError as e:
+                return self.fail(message, "Internal server error")
+
+            try:
+                reply = handler(self, message)
+            except GenericError as e:
+                return self.fail(message, "Internal server error")
+        except:
+            self.error("Uncaught exception: {}"
+                    .format(traceback.format_exc()))
+            return self.fail(message, "Malformed message")
+
+        if not isinstance(reply, Future):
+            return self.__finish(message, reply, postprocess)
+
+        # The rest of the pipeline happens when the reply is ready
+        finished = Future()
+        def finish(done):
+            try:
+                reply = done.result()
+            except GenericError as e:
+                finished.set_result(self.fail(message,
+                    "Internal server error"))
+            except:
+                self.error("Uncaught exception: {}"
+                        .format(traceback.format_exc()))
+                finished.set_result(self.fail(message, "Malformed message"))
+            else:
+                finished.set_result(self.__finish(message, reply,
+                    postprocess))
+        reply.add_done_callback(finish)
+        return finished
+
+    def __finish(self, message, reply, postprocess):
+        """
+        Server.__finish(self, message, reply, postprocess)
+        The tail end of the pipeline, from what handler produced to the reply
+        to send back to the client
+        """
+        try:
+            try:
+                reply = postprocess(reply)
+            except GenericError as e:
+                return self.fail(message, "Internal server error")
+
+            try:
+                reply = self.__translator.encrypt(reply)
+            except EncryptError as e:
+                return self.fail(message, "Encryption failure")
+        except:
+            self.error("Uncaught exception: {}"
+                    .format(traceback.format_exc()))
+            return self.fail(message, "Malformed message")
+
+        return reply
 
     def stop(self):
         """
@@ -167,17 +331,19 @@ class Server(Loggable):
             self.info("Stopping polling")
             self.__done = True
 
-        with self.__ilock:
-            iaddr = self.__isocket.last_endpoint.decode()
-            self.info("Unbinding interactive socket from {}".format(iaddr))
-            self.__isocket.unbind(iaddr)
+        for worker in self.__workers:
+            worker.join()
+        self.__workers = []
+
+        self.__listen_thread.join()
 
         with self.__block:
             baddr = self.__bsocket.last_endpoint.decode()
             self.info("Unbinding broadcast socket from {}".format(baddr))
             self.__bsocket.unbind(baddr)
 
-        self.__listen_thread.join()
+        with self.__llock:
+            self.__later.close(linger = 0)
 
         self.info("Server stopped")
 
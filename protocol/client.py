@@ -5,18 +5,24 @@ import music21
 
 from protocol.base.exceptions import DeserializationFailure
 
-def serialize(function_name, *args):
+def serialize(function_name, *args, version = None, span = None):
     """
     Serialize a message to be sent from client to server
 
     function_name =:= type(str)
     args =:= type(list of str)
+    version =:= type(int), the project version an update produced, if any
+    span =:= type([float, float]), the offsets an update changed, if any
     """
 
     rpc = {
         "fName": function_name,
         "args": [str(arg) for arg in args],
     }
+    if version is not None:
+        rpc["version"] = version
+    if span is not None:
+        rpc["span"] = [float(offset) for offset in span]
 
     return json.dumps(rpc)
 
@@ -26,7 +32,9 @@ def deserialize(msg):
 
     {
         "function_name": str(),
-        "args": [str()]
+        "args": [str()],
+        "version": int(), for broadcast updates only
+        "span": [float(), float()], for broadcast updates only
     }
     """
     pythonObject = json.loads(msg)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Stress test for per-project locking in ComposteServer. Hammers a server with
+# note insertions spread over a varying number of projects while a flusher
+# keeps writing projects back to disk, and reports update throughput for each
+# project count. Afterwards, every project is read back from disk and has to
+# hold exactly the notes that were inserted. Run from the repository root:
+#
+#   PYTHONPATH=. python3 test/UT_ComposteServer_locking.py [threads] [updates]
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from threading import Thread
+
+from ComposteServer import ComposteServer
+from network.base.loggable import DevNull
+from network.fake.security import Encryption
+
+THREADS = 8
+UPDATES = 100
+PROJECT_COUNTS = [1, 2, 4, 8]
+
+def hammer(server, pids, threads, updates, inserted):
+    """
+    Spread threads * updates insertions across pids, one thread per slice,
+    while one more thread flushes projects as fast as it can. Every offset
+    a note goes in at is added to inserted[pid]. Returns updates per second.
+    """
+    done = [False]
+
+    def flusher():
+        while not done[0]:
+            # Compact every log, however short
+            server.flush_dirty(compact_size = 0)
+
+    def worker(n):
+        pid = pids[n % len(pids)]
+        for i in range(updates):
+            offset = float((n * updates + i) % 64)
+            args = json.dumps([offset, 0, "C4", 1.0])
+            (status, _) = server.do_update(pid, "insertNote", args, 0,
+                    offset)
+            assert status == "ok", status
+            # Sets don't mind being added to from several threads
+            inserted[pid].add(offset)
+
+    background = Thread(target = flusher)
+    background.start()
+
+    workers = [ Thread(target = worker, args = (n,))
+            for n in range(threads) ]
+
+    start = time.perf_counter()
+    for w in workers: w.start()
+    for w in workers: w.join()
+    elapsed = time.perf_counter() - start
+
+    done[0] = True
+    background.join()
+
+    return threads * updates / elapsed
+
+def check(server, pid, offsets):
+    """
+    Read a project back from disk and make sure it holds exactly one C4 at
+    each of offsets, and nothing else
+    """
+    project = server.get_project(pid)[1]
+    notes = sorted((note.offset, note.nameWithOctave)
+            for note in project.parts[0].recurse().notes)
+    expected = [ (offset, "C4") for offset in sorted(offsets) ]
+    assert notes == expected, "{}: {} != {}".format(pid, notes, expected)
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else THREADS
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else UPDATES
+
+    here = os.getcwd()
+    root = tempfile.mkdtemp()
+    os.chdir(root)
+    os.makedirs("data")
+
+    server = ComposteServer("tcp://127.0.0.1:15100", "tcp://127.0.0.1:15101",
+            DevNull, Encryption(), data_root = "data/", workers = 1)
+    try:
+        server.get_db_connections()
+        (_, token) = server.register("stress", "stress",
+                "stress@composte.me").result()
+
+        pids = [ server.create_project(token, "p{}".format(i), "{}")[1]
+                for i in range(max(PROJECT_COUNTS)) ]
+
+        inserted = { pid: set() for pid in pids }
+
+        print("{} threads x {} updates".format(threads, updates))
+        for count in PROJECT_COUNTS:
+            rate = hammer(server, pids[:count], threads, updates, inserted)
+            print("{:>3} projects: {:>8.1f} updates/s".format(count, rate))
+
+        for pid in pids:
+            check(server, pid, inserted[pid])
+        print("All projects read back intact")
+    finally:
+        server.stop()
+        os.chdir(here)
+        shutil.rmtree(root)
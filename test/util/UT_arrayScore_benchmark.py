@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Memory and edit-time comparison between the two score engines the server
+# can run: music21 streams edited by util.musicFuns, and util.arrayScore's
+# ArrayParts. Run from the repository root:
+#
+#   PYTHONPATH=. python3 test/util/UT_arrayScore_benchmark.py [notes]
+
+import sys
+import time
+import random
+import tracemalloc
+
+from util import arrayScore, composteProject, musicFuns
+
+NOTES = 2000
+PITCHES = [ "C4", "E-4", "G4", "B-4", "D#5", "F#4" ]
+
+def empty(engine):
+    """
+    The single part of a new project, as engine would keep it
+    """
+    part = composteProject.ComposteProject({ "owner": "benchmark" }).parts[0]
+    if engine is arrayScore:
+        return arrayScore.ArrayPart.fromStream(part)
+    return part
+
+def fill(engine, count):
+    """
+    A part with count notes end to end and a lyric every few notes. Returns
+    the part and the milliseconds per insert
+    """
+    part = empty(engine)
+    start = time.perf_counter()
+    for i in range(count):
+        engine.insertNote(float(i), part, PITCHES[i % len(PITCHES)], 1.0)
+        if i % 7 == 0:
+            engine.addLyric(float(i), part, "la")
+    return (part, 1000 * (time.perf_counter() - start) / count)
+
+def footprint(engine, count):
+    """
+    Bytes held by a part of count notes
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    (part, _) = fill(engine, count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before
+
+def timed(fun, repeats):
+    """
+    Milliseconds per call of fun, over repeats calls
+    """
+    start = time.perf_counter()
+    for i in range(repeats):
+        fun(i)
+    return 1000 * (time.perf_counter() - start) / repeats
+
+def report(name, engine, count):
+    (part, insert) = fill(engine, count)
+    # Neighbouring notes differ in pitch, so this only measures the search
+    tie = timed(lambda i: engine.updateTieStatus(float(i), part,
+            PITCHES[i % len(PITCHES)]), 100)
+    random.seed(50)
+    overwrite = timed(lambda i: engine.insertNote(
+            float(random.randrange(count * 2)) / 2, part,
+            PITCHES[i % len(PITCHES)], 1.0), 100)
+    transpose = timed(lambda i: engine.transpose(part, 1 - 2 * (i % 2)), 10)
+    measures = timed(lambda i: engine.insertMeasures(4.0, part, 4.0), 10)
+    freeze = timed(lambda i: composteProject.freezePart(part), 10)
+    memory = footprint(engine, count)
+    print("{:<8} {:>6} notes  {:>9.1f} KiB   insert {:>6.3f} ms   "
+            "overwrite {:>6.3f} ms   tie {:>6.3f} ms   transpose {:>7.3f} ms   "
+            "insertMeasures {:>7.3f} ms   freeze {:>7.3f} ms".format(name,
+                count, memory / 1024, insert, overwrite, tie, transpose,
+                measures, freeze))
+
+if __name__ == '__main__':
+    notes = int(sys.argv[1]) if len(sys.argv) > 1 else NOTES
+    report("music21", musicFuns, notes)
+    report("arrays", arrayScore, notes)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# How long musicFuns.insertNote takes as a part grows, against the linear scan
+# it used to do. The scan is quadratic overall, so it only gets a fraction of
+# the notes. Also how long inserting measures near the start of a long score
+# takes. Run from the repository root:
+#
+#   PYTHONPATH=. python3 test/util/UT_musicFuns_benchmark.py [notes]
+
+import sys
+import time
+import random
+
+import music21
+
+from util import musicFuns
+
+NOTES = 10000
+LINEAR_NOTES = 2000
+PITCHES = [ "C4", "E-4", "G4", "B-4", "D#5", "F#4" ]
+MEASURES = 500
+PARTS = 4
+
+def linearInsertNote(offset, part, pitchStr, duration):
+    """
+    insertNote as it was before parts were indexed
+    """
+    newNote = musicFuns.createNote(pitchStr, duration)
+    bounds = (offset, offset + duration)
+    for note in part.notes:
+        limits = (note.offset, note.duration.quarterLength + note.offset)
+        if bounds[0] < limits[1] and limits[0] < bounds[1]:
+            part.remove(note)
+    part.insert(offset, newNote)
+
+def fill(insert, count):
+    """
+    Insert count notes end to end, then overwrite count // 10 of them at
+    random. Returns the milliseconds per insert for the first and last
+    tenth of the fill, and for the overwrites
+    """
+    part = music21.stream.Part()
+    tenth = max(count // 10, 1)
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        insert(float(i), part, PITCHES[i % len(PITCHES)], 1.0)
+        times.append(time.perf_counter() - start)
+
+    random.seed(50)
+    start = time.perf_counter()
+    for i in range(tenth):
+        insert(float(random.randrange(count * 2)) / 2, part,
+                PITCHES[i % len(PITCHES)], 1.0)
+    overwrites = (time.perf_counter() - start) / tenth
+
+    assert len(part.notes) >= count - tenth
+    return [ 1000 * t for t in
+            (sum(times[:tenth]) / tenth, sum(times[-tenth:]) / tenth,
+                overwrites) ]
+
+def report(name, count, insert):
+    (first, last, overwrite) = fill(insert, count)
+    print("{:<8} {:>6} notes   first {:>7.3f} ms   last {:>7.3f} ms   "
+            "overwrite {:>7.3f} ms".format(name, count, first, last,
+                overwrite))
+
+def measures():
+    """
+    Milliseconds to insert a measure of 4/4 near the start of a score of
+    PARTS parts with MEASURES measures of quarter notes, in one part and in
+    all of them
+    """
+    parts = []
+    for p in range(PARTS):
+        part = music21.stream.Part()
+        part.insert(0.0, music21.clef.TrebleClef())
+        part.insert(0.0, music21.meter.TimeSignature("4/4"))
+        for i in range(MEASURES * 4):
+            musicFuns.insertNote(float(i), part, PITCHES[i % len(PITCHES)],
+                    1.0)
+        parts.append(part)
+
+    times = []
+    for which in [ parts[0], parts ]:
+        start = time.perf_counter()
+        musicFuns.insertMeasures(4.0, which, 4.0)
+        times.append(1000 * (time.perf_counter() - start))
+    print("insertMeasures, {} measures   one part {:>7.3f} ms   "
+            "{} parts {:>7.3f} ms".format(MEASURES, times[0], PARTS,
+                times[1]))
+
+if __name__ == '__main__':
+    notes = int(sys.argv[1]) if len(sys.argv) > 1 else NOTES
+    measures()
+    report("indexed", notes, musicFuns.insertNote)
+    report("linear", min(notes, LINEAR_NOTES), linearInsertNote)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Size and load-time comparison between music21 pickles (what .heap files
+# used to hold) and util.scoreFormat. Give it .heap files to measure real
+# projects, or nothing to measure a generated score. Run from the repository
+# root:
+#
+#   PYTHONPATH=. python3 test/util/UT_scoreFormat_benchmark.py [heap files]
+
+import sys
+import json
+import time
+import base64
+
+import music21
+
+from util import composteProject, musicFuns, scoreFormat
+
+NOTES = 2000
+REPEATS = 5
+
+def generated():
+    """
+    A single part with NOTES notes and a marking every few measures
+    """
+    project = composteProject.ComposteProject({ "owner": "benchmark" })
+    part = project.parts[0]
+    pitches = [ "C4", "E-4", "G4", "B-4", "D#5", "F#4" ]
+    for i in range(NOTES):
+        musicFuns.insertNote(float(i), part, pitches[i % len(pitches)], 1.0)
+        if i % 16 == 0:
+            musicFuns.addDynamic(float(i), part, [ "p", "mf", "ff" ][i % 3])
+        if i % 7 == 0:
+            musicFuns.addLyric(float(i), part, "la")
+    for i in range(0, NOTES - 1, 32):
+        musicFuns.updateTieStatus(float(i), part,
+                part.getElementsByOffset(float(i)).notes[0]
+                .pitch.nameWithOctave)
+    return project.parts
+
+def from_heap(path):
+    """
+    The parts stored in a .heap file, whichever format it is in
+    """
+    with open(path, "r") as f:
+        heap = json.loads(f.read())
+    if type(heap) == dict:
+        heap = json.loads(heap["parts"])
+    bits = [ base64.b64decode(bit.encode()) for bit in heap ]
+    return [ composteProject.thawPart(bit) for bit in bits ]
+
+def best_of(fun):
+    """
+    Fastest of REPEATS runs, in milliseconds
+    """
+    times = []
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+def compare(name, parts):
+    pickles = [ music21.converter.freezeStr(part) for part in parts ]
+    try:
+        packed = [ scoreFormat.packPart(part) for part in parts ]
+    except scoreFormat.FormatError as e:
+        print("{}: not packable ({})".format(name, e))
+        return
+
+    print(name)
+    print("    size  pickle {:>10} B   packed {:>10} B   ({:.1f}x)".format(
+        sum(map(len, pickles)), sum(map(len, packed)),
+        sum(map(len, pickles)) / sum(map(len, packed))))
+
+    thaw = best_of(lambda: [ music21.converter.thawStr(p) for p in pickles ])
+    unpack = best_of(lambda: [ scoreFormat.unpackPart(p) for p in packed ])
+    print("    load  pickle {:>10.1f} ms  packed {:>10.1f} ms  ({:.1f}x)"
+            .format(thaw, unpack, thaw / unpack))
+
+    freeze = best_of(lambda: [ music21.converter.freezeStr(p)
+        for p in parts ])
+    pack = best_of(lambda: [ scoreFormat.packPart(p) for p in parts ])
+    print("    save  pickle {:>10.1f} ms  packed {:>10.1f} ms  ({:.1f}x)"
+            .format(freeze, pack, freeze / pack))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            compare(path, from_heap(path))
+    else:
+        compare("generated, {} notes".format(NOTES), generated())
@@ -0,0 +1,797 @@
+# An optional score engine for the server, which keeps each part in NumPy
+# arrays instead of a music21 stream.
+#
+# The server never renders anything, so all it needs from a part is to
+# apply updates to it and hand it out again. An ArrayPart holds its notes as
+# one row each of a structured array, sorted by offset, and its markings in
+# small tables on the side, laid out like the columns of util.scoreFormat.
+# So parts go to and from storage and the wire without music21 ever making a
+# stream; only toStream() does that, for whoever wants to export one.
+#
+# The functions at the bottom take the same arguments as their namesakes in
+# musicFuns, with ArrayParts where those take streams, and report the same
+# update offsets, so musicWrapper can hand an update to either.
+
+import bisect
+import functools
+import math
+from array import array
+
+import music21
+import numpy
+
+from util import composteProject, flyweight, musicFuns, scoreFormat
+from util.scoreFormat import NO_PARTNER, SPELLING_INFERRED, \
+        HAS_TIE_PARTNERS, TIE_SHIFT, TIE_MASK, TIE_TYPES, STEPS, STEP_CLASSES
+
+# Note table columns, as in scoreFormat, except that tie partners are note
+# ids rather than row numbers, because rows move about as notes come and go
+_NUMPY_TYPES = { "d": "f8", "h": "i2", "B": "u1", "b": "i1", "i": "i4" }
+NOTE_DTYPE = numpy.dtype([ (column, _NUMPY_TYPES[typecode])
+        for (column, typecode) in scoreFormat.NOTE_COLUMNS ] + [ ("id", "i4") ])
+
+MARKINGS = [ table for (table, _) in scoreFormat.TABLES
+        if table != "lyrics" ]
+
+# Spell each pitch class as musicFuns does, as (step, alter)
+def _spellings(names):
+    return (numpy.array([ STEPS.index(name[0]) for name in names ], "u1"),
+            numpy.array([ name.count("#") - name.count("-")
+                          for name in names ], "i1"))
+(_SHARP_STEPS, _SHARP_ALTERS) = _spellings(musicFuns.SHARP_NAMES)
+(_FLAT_STEPS, _FLAT_ALTERS) = _spellings(musicFuns.FLAT_NAMES)
+
+# What musicFuns.makeTieUpdate does to each pair of tie types, as the new
+# types and whether the notes end up tied. Pairs it trips over are
+# _UNTIEABLE, and anything else it leaves alone
+_TIE_UPDATES = {
+    (None, None):             ("start",    "stop",     True),
+    ("stop", None):           ("continue", "stop",     True),
+    ("stop", "start"):        ("continue", "continue", True),
+    ("start", "stop"):        (None,       None,       False),
+    ("start", "continue"):    (None,       "start",    False),
+    ("continue", "continue"): ("stop",     "start",    False),
+    ("continue", "stop"):     ("stop",     None,       False),
+}
+_UNTIEABLE = [ ("start", None), ("continue", None) ] + \
+        [ (None, tie) for tie in TIE_TYPES if tie is not None ]
+
+@functools.lru_cache(maxsize = 256)
+def _parsePitch(pitchStr):
+    """
+    (step, alter, midi) of a pitch name like "E-4". Names without an
+    octave are in octave 4, like music21 assumes
+    """
+    pitch = music21.pitch.Pitch(pitchStr)
+    if pitch.microtone.cents != 0 or pitch.alter != int(pitch.alter):
+        raise music21.pitch.PitchException(
+                "Can't store {}".format(pitchStr))
+    return (STEPS.index(pitch.step), int(pitch.alter), pitch.midi)
+
+class ArrayPart:
+    """
+    One part of a score, in arrays
+    """
+    def __init__(self, streamClass = "Stream"):
+        self.streamClass = streamClass
+        # Rows past __count are spare room, so inserts don't reallocate
+        self.__buffer = numpy.zeros(16, NOTE_DTYPE)
+        self.__count = 0
+        self.__nextId = 0
+        # Nothing that starts further back than this can reach a given offset
+        self.__longest = 0.0
+        # note id -> [ lyric ]
+        self.__lyrics = {}
+        # table -> [ (offset, ...) ] in order, with columns as in scoreFormat
+        self.__markings = { table: [] for table in MARKINGS }
+
+    @classmethod
+    def fromBytes(cls, data):
+        """
+        The ArrayPart of a part packed by scoreFormat
+        """
+        (version, streamClass, columns, tables) = scoreFormat.readColumns(data)
+        if version != scoreFormat.VERSION:
+            # Ties by offset, which are music21's problem to sort out
+            return cls.fromStream(scoreFormat.unpackPart(data))
+
+        part = cls(streamClass)
+        count = len(columns["offset"])
+        notes = numpy.zeros(max(count, 16), NOTE_DTYPE)
+        for (column, typecode) in scoreFormat.NOTE_COLUMNS:
+            if count:
+                notes[column][:count] = numpy.frombuffer(columns[column],
+                        "=" + _NUMPY_TYPES[typecode])
+        # Row numbers make fine ids, and are what the partners refer to
+        notes["id"][:count] = numpy.arange(count)
+        order = numpy.argsort(notes["offset"][:count], kind = "stable")
+        notes[:count] = notes[:count][order]
+        part.__buffer = notes
+        part.__count = count
+        part.__nextId = count
+        if count:
+            part.__longest = float(notes["ql"][:count].max())
+
+        for (index, text) in zip(*tables["lyrics"]):
+            part.__lyrics.setdefault(index, []).append(text)
+        for table in MARKINGS:
+            rows = list(zip(*tables[table]))
+            rows.sort(key = lambda row: row[0])
+            part.__markings[table] = rows
+        return part
+
+    @classmethod
+    def fromStream(cls, stream):
+        """
+        The ArrayPart of a music21 stream. Raises scoreFormat.FormatError if
+        the stream holds anything an ArrayPart can't
+        """
+        return cls.fromBytes(scoreFormat.packPart(stream))
+
+    def toBytes(self):
+        """
+        Pack the part in scoreFormat, as packPart would the same part as a
+        music21 stream
+        """
+        notes = self.__notes()
+        ids = notes["id"]
+        order = numpy.argsort(ids)
+        sortedIds = ids[order]
+
+        def rowsOf(partners):
+            if len(ids) == 0:
+                return partners
+            at = numpy.minimum(numpy.searchsorted(sortedIds, partners),
+                    len(ids) - 1)
+            found = (partners != NO_PARTNER) & (sortedIds[at] == partners)
+            return numpy.where(found, order[at], NO_PARTNER)
+
+        columns = {}
+        for (column, typecode) in scoreFormat.NOTE_COLUMNS:
+            values = notes[column]
+            if column in ("prev", "next"):
+                values = rowsOf(values)
+            columns[column] = array(typecode, numpy.ascontiguousarray(values,
+                    "=" + _NUMPY_TYPES[typecode]).tobytes())
+
+        lyrics = ([], [])
+        for row in sorted(order[numpy.searchsorted(sortedIds, noteId)]
+                for noteId in self.__lyrics):
+            for text in self.__lyrics[int(ids[row])]:
+                lyrics[0].append(int(row))
+                lyrics[1].append(text)
+
+        tables = { "lyrics": lyrics }
+        for (table, typecodes) in scoreFormat.TABLES:
+            if table != "lyrics":
+                rows = self.__markings[table]
+                tables[table] = tuple(zip(*rows)) if len(rows) \
+                        else tuple([] for _ in typecodes)
+        return scoreFormat.writeColumns(self.streamClass, columns, tables)
+
+    def toStream(self):
+        """
+        The part as a music21 stream
+        """
+        return scoreFormat.unpackPart(self.toBytes())
+
+    def __len__(self):
+        return self.__count
+
+    def __notes(self):
+        return self.__buffer[:self.__count]
+
+    def __insertRow(self, row):
+        """
+        Make room for a note at row, returning the new row
+        """
+        if self.__count == len(self.__buffer):
+            grown = numpy.zeros(2 * len(self.__buffer), NOTE_DTYPE)
+            grown[:self.__count] = self.__notes()
+            self.__buffer = grown
+        self.__buffer[row + 1:self.__count + 1] = \
+                self.__buffer[row:self.__count]
+        self.__count += 1
+        return self.__buffer[row]
+
+    def __deleteRow(self, row):
+        self.__lyrics.pop(int(self.__buffer["id"][row]), None)
+        self.__buffer[row:self.__count - 1] = \
+                self.__buffer[row + 1:self.__count]
+        self.__count -= 1
+
+    def __rowsAt(self, offset):
+        """
+        (first, last + 1) of the rows that start at offset
+        """
+        offsets = self.__notes()["offset"]
+        lo = numpy.searchsorted(offsets, offset, "left")
+        return (int(lo), int(numpy.searchsorted(offsets, offset, "right")))
+
+    def __rowOf(self, noteId):
+        """
+        The row of the note with id noteId, if it's still here
+        """
+        rows = numpy.flatnonzero(self.__notes()["id"] == noteId)
+        return int(rows[0]) if len(rows) else None
+
+    def __find(self, offset, noteName):
+        """
+        The first row at offset whose pitch is named noteName, if any
+        """
+        try:
+            (step, alter, midi) = _parsePitch(noteName)
+        except music21.exceptions21.Music21Exception:
+            return None
+        (lo, hi) = self.__rowsAt(offset)
+        notes = self.__buffer
+        for row in range(lo, hi):
+            if notes["midi"][row] == midi and notes["step"][row] == step \
+                    and notes["alter"][row] == alter:
+                return row
+        return None
+
+    def __tie(self, row):
+        return TIE_TYPES[(int(self.__buffer["flags"][row]) & TIE_MASK)
+                >> TIE_SHIFT]
+
+    def __setTie(self, row, tie):
+        flags = int(self.__buffer["flags"][row]) & ~TIE_MASK
+        self.__buffer["flags"][row] = flags | \
+                (TIE_TYPES.index(tie) << TIE_SHIFT) | HAS_TIE_PARTNERS
+
+    def __tieUpdate(self, first, second):
+        """
+        musicFuns.makeTieUpdate, on rows
+        """
+        ties = (self.__tie(first), self.__tie(second))
+        if ties in _UNTIEABLE:
+            raise music21.exceptions21.Music21Exception(
+                    "Can't tie {} to {}".format(*ties))
+        if ties not in _TIE_UPDATES:
+            return
+        (firstTie, secondTie, tied) = _TIE_UPDATES[ties]
+        notes = self.__buffer
+        (firstId, secondId) = (notes["id"][first], notes["id"][second])
+        if tied:
+            notes["next"][first] = secondId
+            notes["prev"][second] = firstId
+        else:
+            if notes["next"][first] == secondId:
+                notes["next"][first] = NO_PARTNER
+            if notes["prev"][second] == firstId:
+                notes["prev"][second] = NO_PARTNER
+        self.__setTie(first, firstTie)
+        self.__setTie(second, secondTie)
+
+    def __respell(self, lo, hi, midis, hasSharps):
+        """
+        Spell the notes in rows [lo, hi) as the MIDI numbers in midis, with
+        sharps where hasSharps and flats elsewhere, leaving notes that are
+        already spelled right alone
+        """
+        notes = self.__buffer[lo:hi]
+        classes = midis % 12
+        steps = numpy.where(hasSharps, _SHARP_STEPS[classes],
+                _FLAT_STEPS[classes])
+        alters = numpy.where(hasSharps, _SHARP_ALTERS[classes],
+                _FLAT_ALTERS[classes])
+        changed = (notes["step"] != steps) | (notes["alter"] != alters) | \
+                (notes["midi"] != midis)
+        notes["step"][changed] = steps[changed]
+        notes["alter"][changed] = alters[changed]
+        notes["midi"][changed] = midis[changed]
+        notes["flags"][changed] &= numpy.uint8(0xff ^ SPELLING_INFERRED)
+
+    def __sharpsAt(self, offsets):
+        """
+        Sharps in the key signature in effect at each of offsets
+        """
+        keys = self.__markings["keys"]
+        if len(keys) == 0:
+            return numpy.zeros(len(offsets), "i1")
+        at = numpy.searchsorted([ key[0] for key in keys ], offsets,
+                "right") - 1
+        sharps = numpy.array([ key[1] for key in keys ], "i1")
+        return numpy.where(at < 0, 0, sharps[numpy.maximum(at, 0)])
+
+    def __mark(self, table, row):
+        """
+        Put a marking in a table, replacing whatever was at its offset
+        """
+        rows = self.__markings[table]
+        for i in range(len(rows)):
+            if rows[i][0] == row[0]:
+                rows[i] = row
+                return
+        i = bisect.bisect_right([ mark[0] for mark in rows ], row[0])
+        rows.insert(i, row)
+
+    def __unmark(self, table, offset):
+        """
+        Take the marking at offset out of a table, if there is one. Returns
+        whether there was
+        """
+        rows = self.__markings[table]
+        for i in range(len(rows)):
+            if rows[i][0] == offset:
+                del rows[i]
+                return True
+        return False
+
+    def markings(self, table):
+        """
+        The rows of one of the marking tables of scoreFormat, in order
+        """
+        return list(self.__markings[table])
+
+    def highestTime(self):
+        """
+        Where the part ends, like music21's Stream.highestTime
+        """
+        notes = self.__notes()
+        end = float((notes["offset"] + notes["ql"]).max()) \
+                if len(notes) else 0.0
+        for rows in self.__markings.values():
+            if len(rows):
+                end = max(end, rows[-1][0])
+        return end
+
+    def insertNote(self, offset, pitchStr, duration):
+        (step, alter, midi) = _parsePitch(pitchStr)
+        bounds = (offset, offset + duration)
+        notes = self.__notes()
+        lo = numpy.searchsorted(notes["offset"], offset - self.__longest,
+                "right")
+        hi = numpy.searchsorted(notes["offset"], bounds[1], "left")
+        overlapping = notes[lo:hi]
+        overlapping = overlapping[overlapping["offset"] +
+                overlapping["ql"] > offset]
+
+        maxLims = list(bounds)
+        for (start, length, noteId) in zip(overlapping["offset"].tolist(),
+                overlapping["ql"].tolist(), overlapping["id"].tolist()):
+            self.__removeRow(self.__rowOf(noteId))
+            maxLims = [min(maxLims[0], start), max(maxLims[1], start + length)]
+
+        row = int(numpy.searchsorted(self.__notes()["offset"], offset,
+                "right"))
+        note = self.__insertRow(row)
+        note["offset"] = offset
+        note["ql"] = duration
+        note["midi"] = midi
+        note["step"] = step
+        note["alter"] = alter
+        note["flags"] = HAS_TIE_PARTNERS
+        note["prev"] = NO_PARTNER
+        note["next"] = NO_PARTNER
+        note["id"] = self.__nextId
+        self.__nextId += 1
+        self.__longest = max(self.__longest, duration)
+        return maxLims
+
+    def __removeRow(self, row):
+        """
+        Remove the note at row, cutting its ties. Returns the offsets of the
+        notes it was tied to
+        """
+        notes = self.__buffer
+        offset = float(notes["offset"][row])
+        limits = [offset, offset]
+        previous = self.__rowOf(notes["prev"][row])
+        if previous is not None:
+            limits[0] = float(notes["offset"][previous])
+            self.__tieUpdate(previous, row)
+        next_ = self.__rowOf(notes["next"][row])
+        if next_ is not None:
+            limits[1] = float(notes["offset"][next_])
+            self.__tieUpdate(row, next_)
+        self.__deleteRow(row)
+        return limits
+
+    def removeNote(self, offset, removedNoteName):
+        row = self.__find(offset, removedNoteName)
+        if row is None:
+            return [offset, offset]
+        return self.__removeRow(row)
+
+    def updateTieStatus(self, offset, noteName):
+        row = self.__find(offset, noteName)
+        if row is None:
+            return [offset, offset]
+        end = offset + float(self.__buffer["ql"][row])
+        (step, alter, midi) = _parsePitch(noteName)
+        (lo, hi) = self.__rowsAt(end)
+        notes = self.__buffer
+        for candidate in range(lo, hi):
+            if notes["midi"][candidate] == midi and \
+                    notes["step"][candidate] == step and \
+                    notes["alter"][candidate] == alter:
+                self.__tieUpdate(row, candidate)
+        return [offset, end]
+
+    def addLyric(self, offset, lyric):
+        (lo, hi) = self.__rowsAt(offset)
+        if lo < hi:
+            noteId = int(self.__buffer["id"][lo])
+            self.__lyrics.setdefault(noteId, []).append(lyric)
+        return [offset, offset]
+
+    def changeKeySignature(self, offset, newSigSharps):
+        sharps = music21.key.KeySignature(newSigSharps).sharps
+        self.__mark("keys", (offset, sharps))
+        after = [ key[0] for key in self.__markings["keys"]
+                if key[0] > offset ]
+        nextOffset = after[0] if len(after) else None
+
+        offsets = self.__notes()["offset"]
+        lo = int(numpy.searchsorted(offsets, offset, "left"))
+        hi = self.__count if nextOffset is None else \
+                int(numpy.searchsorted(offsets, nextOffset, "left"))
+        self.__respell(lo, hi, self.__buffer["midi"][lo:hi].copy(),
+                0 < sharps)
+        if nextOffset is None:
+            return [offset, self.highestTime()]
+        return [offset, nextOffset]
+
+    def transpose(self, semitones, startOffset = None, endOffset = None):
+        start = 0.0 if startOffset is None else startOffset
+        offsets = self.__notes()["offset"]
+        lo = int(numpy.searchsorted(offsets, start, "left"))
+        hi = self.__count if endOffset is None else \
+                int(numpy.searchsorted(offsets, endOffset, "left"))
+        if lo >= hi:
+            return [start, start]
+        notes = self.__buffer[lo:hi]
+        midis = notes["midi"].astype("i4") + semitones
+        if midis.min() < 0 or 127 < midis.max():
+            raise music21.pitch.PitchException("Can't transpose out of range")
+        self.__respell(lo, hi, midis.astype("i2"),
+                0 < self.__sharpsAt(notes["offset"]))
+        return [float(notes["offset"][0]),
+                float((notes["offset"] + notes["ql"]).max())]
+
+    def insertMeasures(self, insertionOffset, insertedQLs):
+        """
+        Move every note from insertionOffset on, and every marking after
+        it, later by insertedQLs
+        """
+        notes = self.__notes()
+        lo = numpy.searchsorted(notes["offset"], insertionOffset, "left")
+        notes["offset"][lo:] += insertedQLs
+        for (table, rows) in self.__markings.items():
+            self.__markings[table] = [ row if row[0] <= insertionOffset
+                    else (row[0] + insertedQLs,) + row[1:] for row in rows ]
+
+    def insertMetronomeMark(self, offset, bpm):
+        mark = music21.tempo.MetronomeMark("", bpm, 1.0)
+        self.__mark("tempos", (offset, float(mark.number),
+                float(mark.referent.quarterLength),
+                None if mark.textImplicit else mark.text))
+
+    def removeMetronomeMark(self, offset):
+        if offset != 0.0:
+            self.__unmark("tempos", offset)
+
+    def insertClef(self, offset, clefStr):
+        clef = flyweight.clef(clefStr)
+        self.__mark("clefs", (offset, type(clef).__name__))
+        return [offset, offset]
+
+    def removeClef(self, offset):
+        if offset != 0.0:
+            self.__unmark("clefs", offset)
+        return [offset, offset]
+
+    def addInstrument(self, offset, instrumentStr):
+        instrument = flyweight.instrument(instrumentStr)
+        self.__mark("instruments", (offset, type(instrument).__name__,
+                instrument.instrumentName))
+        return [offset, offset]
+
+    def removeInstrument(self, offset):
+        if offset != 0.0:
+            self.__unmark("instruments", offset)
+        return [offset, offset]
+
+    def addDynamic(self, offset, dynamicStr):
+        dynamic = music21.dynamics.Dynamic(dynamicStr)
+        self.__mark("dynamics", (offset, dynamic.value))
+        return [offset, offset]
+
+    def removeDynamic(self, offset):
+        self.__unmark("dynamics", offset)
+        return [offset, offset]
+
+    def __checkRange(self, startOffset, endOffset):
+        if endOffset <= startOffset:
+            raise music21.exceptions21.StreamException(
+                "A range has to end after it starts")
+
+    def __rowsWithin(self, startOffset, endOffset):
+        """
+        (first, last + 1) of the rows that start in [startOffset, endOffset)
+        """
+        offsets = self.__notes()["offset"]
+        return (int(numpy.searchsorted(offsets, startOffset, "left")),
+                int(numpy.searchsorted(offsets, endOffset, "left")))
+
+    def __dynamicsWithin(self, startOffset, endOffset):
+        return [ row for row in self.__markings["dynamics"]
+                if startOffset <= row[0] < endOffset ]
+
+    def __removeRows(self, rows):
+        """
+        Remove the notes at rows all at once, cutting their ties to the
+        notes that stay. Returns the [start, end] of what changed, or None if
+        nothing did
+        """
+        if len(rows) == 0:
+            return None
+        notes = self.__buffer
+        limits = [math.inf, -math.inf]
+        for row in rows:
+            offset = float(notes["offset"][row])
+            limits = [min(limits[0], offset),
+                    max(limits[1], offset + float(notes["ql"][row]))]
+            previous = self.__rowOf(notes["prev"][row])
+            if previous is not None:
+                limits[0] = min(limits[0], float(notes["offset"][previous]))
+                self.__tieUpdate(previous, row)
+            next_ = self.__rowOf(notes["next"][row])
+            if next_ is not None:
+                limits[1] = max(limits[1], float(notes["offset"][next_]))
+                self.__tieUpdate(row, next_)
+        keep = numpy.ones(self.__count, bool)
+        keep[rows] = False
+        for noteId in self.__notes()["id"][~keep].tolist():
+            self.__lyrics.pop(noteId, None)
+        kept = self.__notes()[keep]
+        self.__count = len(kept)
+        self.__buffer[:self.__count] = kept
+        return limits
+
+    def __clear(self, startOffset, endOffset):
+        """
+        Remove the notes and dynamics that start in [startOffset, endOffset)
+        """
+        (lo, hi) = self.__rowsWithin(startOffset, endOffset)
+        self.__markings["dynamics"] = [ row for row
+                in self.__markings["dynamics"]
+                if not startOffset <= row[0] < endOffset ]
+        return self.__removeRows(list(range(lo, hi)))
+
+    def __copyRows(self, startOffset, endOffset, moveBy):
+        """
+        Copies of the notes and dynamics that start in [startOffset,
+        endOffset), moveBy QLs later, tied to each other like
+        musicFuns.copyRange ties them. Returns (notes, dynamics)
+        """
+        (lo, hi) = self.__rowsWithin(startOffset, endOffset)
+        copies = self.__buffer[lo:hi].copy()
+        ids = copies["id"].tolist()
+        newIds = dict(zip(ids, range(self.__nextId, self.__nextId + len(ids))))
+        self.__nextId += len(ids)
+        copies["id"] = [ newIds[noteId] for noteId in ids ]
+        for column in ("prev", "next"):
+            copies[column] = [ newIds.get(partner, NO_PARTNER)
+                    for partner in copies[column].tolist() ]
+        # Tied both ways is "continue", only to the next note "start", and
+        # only to the previous note "stop"
+        ties = (copies["next"] != NO_PARTNER).astype("u1") + \
+                2 * (copies["prev"] != NO_PARTNER).astype("u1")
+        copies["flags"] = (copies["flags"] & numpy.uint8(0xff ^ TIE_MASK)) | \
+                (ties << TIE_SHIFT) | HAS_TIE_PARTNERS
+        copies["offset"] += moveBy
+        for (oldId, newId) in newIds.items():
+            if oldId in self.__lyrics:
+                self.__lyrics[newId] = list(self.__lyrics[oldId])
+        dynamics = [ (row[0] + moveBy,) + row[1:]
+                for row in self.__dynamicsWithin(startOffset, endOffset) ]
+        return (copies, dynamics)
+
+    def __paste(self, copies, destination, length):
+        """
+        Put copies, as __copyRows makes them, in place of the region of
+        length QLs at destination. Copied notes replace anything they
+        overlap, like insertNote. Returns the [start, end] of what changed
+        """
+        (notes, dynamics) = copies
+        starts = self.__notes()["offset"]
+        ends = starts + self.__notes()["ql"]
+        doomed = (destination <= starts) & (starts < destination + length)
+        for (start, end) in zip(notes["offset"].tolist(),
+                (notes["offset"] + notes["ql"]).tolist()):
+            doomed |= (starts < end) & (start < ends)
+        limits = self.__removeRows(numpy.flatnonzero(doomed).tolist())
+        self.__markings["dynamics"] = [ row for row
+                in self.__markings["dynamics"]
+                if not destination <= row[0] < destination + length ]
+
+        merged = numpy.concatenate([ self.__notes(), notes ])
+        merged = merged[numpy.argsort(merged["offset"], kind = "stable")]
+        if len(merged) > len(self.__buffer):
+            self.__buffer = numpy.zeros(2 * len(merged), NOTE_DTYPE)
+        self.__buffer[:len(merged)] = merged
+        self.__count = len(merged)
+        if len(notes):
+            self.__longest = max(self.__longest, float(notes["ql"].max()))
+        for row in dynamics:
+            self.__mark("dynamics", row)
+        return _span([destination, destination + length], limits,
+                *[ [start, start + length] for (start, length)
+                   in zip(notes["offset"].tolist(), notes["ql"].tolist()) ])
+
+    def deleteRange(self, startOffset, endOffset):
+        self.__checkRange(startOffset, endOffset)
+        return _span([startOffset, endOffset],
+                self.__clear(startOffset, endOffset))
+
+    def copyRange(self, startOffset, endOffset, destination):
+        self.__checkRange(startOffset, endOffset)
+        copies = self.__copyRows(startOffset, endOffset,
+                destination - startOffset)
+        return self.__paste(copies, destination, endOffset - startOffset)
+
+    def moveRange(self, startOffset, endOffset, destination):
+        self.__checkRange(startOffset, endOffset)
+        copies = self.__copyRows(startOffset, endOffset,
+                destination - startOffset)
+        cleared = self.__clear(startOffset, endOffset)
+        return _span([startOffset, endOffset], cleared,
+                self.__paste(copies, destination, endOffset - startOffset))
+
+    def duplicateRange(self, startOffset, endOffset):
+        self.__checkRange(startOffset, endOffset)
+        length = endOffset - startOffset
+        copies = self.__copyRows(startOffset, endOffset, length)
+        self.insertMeasures(endOffset, length)
+        # Dynamics belong to the notes after them, unlike other markings.
+        # Everything else after endOffset moved past where these land
+        self.__markings["dynamics"] = [ (row[0] + length,) + row[1:]
+                if row[0] == endOffset else row
+                for row in self.__markings["dynamics"] ]
+        self.__paste(copies, endOffset, length)
+        return [float(endOffset), self.highestTime()]
+
+def _span(*spans):
+    """
+    The smallest [start, end] covering every one of spans that isn't None
+    """
+    spans = [ span for span in spans if span is not None ]
+    return [ float(min(span[0] for span in spans)),
+             float(max(span[1] for span in spans)) ]
+
+def handles(musicObject):
+    """ Whether musicObject is an ArrayPart, or a list of parts with
+        ArrayParts in it, or a project's parts that may thaw into
+        some. """
+    if isinstance(musicObject, ArrayPart):
+        return True
+    if isinstance(musicObject, music21.stream.Stream):
+        return False
+    if isinstance(musicObject, composteProject.LazyParts):
+        # Looking at every part would thaw them all. The functions here
+        # that take every part manage streams too, so parts that are
+        # still frozen can go either way
+        thawed = musicObject.thawed()
+        if len(thawed) < len(musicObject):
+            return True
+        musicObject = thawed
+    return any(isinstance(part, ArrayPart) for part in musicObject)
+
+def thawPart(bits):
+    """ composteProject.thawPart, but into an ArrayPart, unless the
+        part holds something only a music21 stream can. """
+    try:
+        if scoreFormat.isPacked(bits):
+            return ArrayPart.fromBytes(bits)
+        return ArrayPart.fromStream(composteProject.thawPart(bits))
+    except scoreFormat.FormatError:
+        return composteProject.thawPart(bits)
+
+# musicFuns, for ArrayParts
+
+def changeKeySignature(offset, part, newSigSharps):
+    return part.changeKeySignature(offset, newSigSharps)
+
+def insertNote(offset, part, pitchStr, duration):
+    return part.insertNote(offset, pitchStr, duration)
+
+def removeNote(offset, part, removedNoteName):
+    return part.removeNote(offset, removedNoteName)
+
+def updateTieStatus(offset, part, noteName):
+    return part.updateTieStatus(offset, noteName)
+
+def transpose(part, semitones, startOffset=None, endOffset=None):
+    return part.transpose(semitones, startOffset, endOffset)
+
+def insertClef(offset, part, clefStr):
+    return part.insertClef(offset, clefStr)
+
+def removeClef(offset, part):
+    return part.removeClef(offset)
+
+def addInstrument(offset, part, instrumentStr):
+    return part.addInstrument(offset, instrumentStr)
+
+def removeInstrument(offset, part):
+    return part.removeInstrument(offset)
+
+def addDynamic(offset, part, dynamicStr):
+    return part.addDynamic(offset, dynamicStr)
+
+def removeDynamic(offset, part):
+    return part.removeDynamic(offset)
+
+def addLyric(offset, part, lyric):
+    return part.addLyric(offset, lyric)
+
+# These take every part of a project, which may not all be ArrayParts
+
+def insertMetronomeMark(offset, parts, bpm):
+    for part in parts:
+        if isinstance(part, ArrayPart):
+            part.insertMetronomeMark(offset, bpm)
+        else:
+            musicFuns.insertMetronomeMark(offset, [part], bpm)
+    return [offset, offset]
+
+def removeMetronomeMark(offset, parts):
+    for part in parts:
+        if isinstance(part, ArrayPart):
+            part.removeMetronomeMark(offset)
+        else:
+            musicFuns.removeMetronomeMark(offset, [part])
+    return [offset, offset]
+
+def insertMeasures(insertionOffset, part, insertedQLs):
+    if insertedQLs <= 0:
+        raise music21.exceptions21.StreamException(
+            "Can only insert a positive number of QLs")
+    parts = [part] if isinstance(part, (ArrayPart, music21.stream.Stream)) \
+            else part
+    ends = []
+    for part in parts:
+        if isinstance(part, ArrayPart):
+            part.insertMeasures(insertionOffset, insertedQLs)
+            ends.append(part.highestTime())
+        else:
+            ends.append(musicFuns.insertMeasures(insertionOffset, part,
+                    insertedQLs)[1])
+    return [insertionOffset, max(ends)]
+
+def _eachPart(part, onArrays, onStream):
+    """
+    Apply an update to a part, or to every part of a list of parts, as
+    onArrays for ArrayParts and onStream for streams, and cover what
+    changed in all of them
+    """
+    parts = [part] if isinstance(part, (ArrayPart, music21.stream.Stream)) \
+            else part
+    return _span(*[ onArrays(part) if isinstance(part, ArrayPart)
+            else onStream(part) for part in parts ])
+
+def deleteRange(startOffset, part, endOffset):
+    return _eachPart(part,
+            lambda part: part.deleteRange(startOffset, endOffset),
+            lambda part: musicFuns.deleteRange(startOffset, part, endOffset))
+
+def copyRange(startOffset, part, endOffset, destination):
+    return _eachPart(part,
+            lambda part: part.copyRange(startOffset, endOffset, destination),
+            lambda part: musicFuns.copyRange(startOffset, part, endOffset,
+                destination))
+
+def moveRange(startOffset, part, endOffset, destination):
+    return _eachPart(part,
+            lambda part: part.moveRange(startOffset, endOffset, destination),
+            lambda part: musicFuns.moveRange(startOffset, part, endOffset,
+                destination))
+
+def duplicateRange(startOffset, part, endOffset):
+    return _eachPart(part,
+            lambda part: part.duplicateRange(startOffset, endOffset),
+            lambda part: musicFuns.duplicateRange(startOffset, part,
+                endOffset))
@@ -1,3 +1,6 @@
+from threading import Condition, Lock, RLock
+import time
+
 
 class Pool:
     """
@@ -40,9 +43,15 @@ class ProjectPool:
     """
     Pool Composte projects in memory
     uuid -> (project, count)
+    Also keeps track of which projects have changed since they were last
+    written out
+    uuid -> [version, flushed version, when it was first dirtied]
     """
 
     __objects = {}
+    __state = {}
+    # Pools may be poked at from several request handlers at once
+    __lock = RLock()
 
     def __init__(self):
         pass
@@ -52,42 +61,256 @@ class ProjectPool:
         Fetch a project and bump its refcount. When the requested project is
         not cached, invoke constructor if possible and cache the result.
         """
-        (proj, count) = ProjectPool.__objects.get(uuid, (None, 0))
+        with ProjectPool.__lock:
+            (proj, count) = ProjectPool.__objects.get(uuid, (None, 0))
+            if proj is not None:
+                ProjectPool.__objects[uuid] = (proj, count + 1)
+                return proj
+
+        if constructor is None:
+            # We don't have it and the client is going to go get it
+            return None
 
-        if proj is None:
-            if constructor is None:
-                # We don't have it and the client is going to go get it
-                return None
-            else:
-                # We don't have it but the client told us how to get it
-                proj = constructor()
+        # We don't have it but the client told us how to get it. Loading can
+        # be slow, so don't make everybody else wait on it
+        fresh = constructor()
 
-        ProjectPool.__objects[uuid] = (proj, count + 1)
-        return proj
+        with ProjectPool.__lock:
+            # Somebody may have beaten us to it, in which case theirs wins
+            (proj, count) = ProjectPool.__objects.get(uuid, (fresh, 0))
+            ProjectPool.__objects[uuid] = (proj, count + 1)
+            return proj
 
     def remove(self, uuid, on_removal = lambda x: x):
         """
         Un-use a project, running on_removal with the project as the only
         argumargument when the reference is removed
         """
-        (proj, count) = ProjectPool.__objects.get(uuid, (None, 0))
+        with ProjectPool.__lock:
+            (proj, count) = ProjectPool.__objects.get(uuid, (None, 0))
 
-        if count is None:
-            return
+            if count is None:
+                return
 
-        if count > 1:
-            ProjectPool.__objects[uuid] = (proj, count - 1)
-        elif count == 1:
+            if count > 1:
+                ProjectPool.__objects[uuid] = (proj, count - 1)
+            elif count == 1:
+                del ProjectPool.__objects[uuid]
+                ProjectPool.__state.pop(uuid, None)
+
+        # on_removal is usually a write, which shouldn't hold up the pool
+        if count == 1:
             on_removal(proj)
-            del ProjectPool.__objects[uuid]
 
         return count - 1
 
+    def release(self, uuid):
+        """
+        Un-use a project, unless this is its last use, in which case nothing
+        happens. Returns whether the use was given back
+        """
+        with ProjectPool.__lock:
+            (proj, count) = ProjectPool.__objects.get(uuid, (None, 0))
+            if count <= 1:
+                return False
+            ProjectPool.__objects[uuid] = (proj, count - 1)
+            return True
+
+    def uses(self, uuid):
+        """
+        How many uses of a project there are
+        """
+        with ProjectPool.__lock:
+            return ProjectPool.__objects.get(uuid, (None, 0))[1]
+
+    def peek(self, uuid):
+        """
+        The cached copy of a project, without using it, or None
+        """
+        with ProjectPool.__lock:
+            return ProjectPool.__objects.get(uuid, (None, 0))[0]
+
+    def touch(self, uuid):
+        """
+        Record that a project has been modified, returning its new version
+        """
+        with ProjectPool.__lock:
+            state = ProjectPool.__state.get(uuid, None)
+            if state is None:
+                state = [0, 0, None]
+                ProjectPool.__state[uuid] = state
+            state[0] += 1
+            if state[2] is None:
+                state[2] = time.monotonic()
+            return state[0]
+
+    def version(self, uuid):
+        """
+        Current version of a project. Starts at 0 when it is loaded
+        """
+        with ProjectPool.__lock:
+            return ProjectPool.__state.get(uuid, [0])[0]
+
+    def is_dirty(self, uuid):
+        """
+        Whether a project has changed since it was last written out
+        """
+        with ProjectPool.__lock:
+            state = ProjectPool.__state.get(uuid, None)
+            return state is not None and state[0] != state[1]
+
+    def mark_clean(self, uuid, version):
+        """
+        Record that a project has been written out as of version. Changes
+        made after that version keep it dirty
+        """
+        with ProjectPool.__lock:
+            state = ProjectPool.__state.get(uuid, None)
+            if state is None or version <= state[1]:
+                return
+            state[1] = version
+            if state[0] == version:
+                state[2] = None
+
+    def dirty(self):
+        """
+        List the cached projects that need writing out as (uuid, project),
+        longest-neglected first
+        """
+        with ProjectPool.__lock:
+            stale = [ (state[2], uuid) for uuid, state in
+                    ProjectPool.__state.items() if state[0] != state[1]
+                    and uuid in ProjectPool.__objects ]
+            stale.sort()
+            return [ (uuid, ProjectPool.__objects[uuid][0])
+                    for (_, uuid) in stale ]
+
     def map(self, mapfun):
         """
-        Apply a function to all cached projects. Adding or removing projects
-        during this process results in undefined behavior.
+        Apply a function to all cached projects. Projects added or removed
+        during this process may or may not be visited.
         """
-        for pid, (proj, count) in ProjectPool.__objects.items():
+        with ProjectPool.__lock:
+            objects = list(ProjectPool.__objects.items())
+
+        for pid, (proj, count) in objects:
             mapfun(proj, count)
 
+class SharedLock:
+    """
+    A readers-writer lock. Any number of shared holders, or exactly one
+    exclusive holder. Not reentrant.
+    """
+
+    def __init__(self):
+        self.__cond = Condition(Lock())
+        self.__readers = 0
+        self.__writer = False
+        self.__waiting_writers = 0
+
+    def acquire_shared(self):
+        with self.__cond:
+            # Writers go first so that a steady trickle of readers can't
+            # starve them out
+            while self.__writer or self.__waiting_writers > 0:
+                self.__cond.wait()
+            self.__readers += 1
+
+    def release_shared(self):
+        with self.__cond:
+            self.__readers -= 1
+            if self.__readers == 0:
+                self.__cond.notify_all()
+
+    def acquire_exclusive(self):
+        with self.__cond:
+            self.__waiting_writers += 1
+            while self.__writer or self.__readers > 0:
+                self.__cond.wait()
+            self.__waiting_writers -= 1
+            self.__writer = True
+
+    def release_exclusive(self):
+        with self.__cond:
+            self.__writer = False
+            self.__cond.notify_all()
+
+class _Held:
+    """
+    Context manager that takes a list of (acquire, release) pairs in order and
+    gives them back in reverse
+    """
+
+    def __init__(self, steps):
+        self.__steps = steps
+
+    def __enter__(self):
+        for (acquire, _) in self.__steps:
+            acquire()
+        return self
+
+    def __exit__(self, *exc):
+        for (_, release) in reversed(self.__steps):
+            release()
+        return False
+
+class ProjectLocks:
+    """
+    Registry of locks keyed by project id, and within a project by part
+    index. Locking a part shares the project with other parts, while locking
+    the whole project excludes everybody else working on it. Nothing here
+    ever waits on a different project.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        # pid -> (SharedLock, { partIndex -> Lock }, Lock)
+        self.__locks = {}
+
+    def __entry(self, pid):
+        with self.__lock:
+            entry = self.__locks.get(pid, None)
+            if entry is None:
+                entry = (SharedLock(), {}, Lock())
+                self.__locks[pid] = entry
+            return entry
+
+    def project(self, pid):
+        """
+        Exclusive access to a whole project, eg. for flushing or updates that
+        span every part
+        """
+        (shared, _, _) = self.__entry(str(pid))
+        return _Held([(shared.acquire_exclusive, shared.release_exclusive)])
+
+    def shared(self, pid):
+        """
+        Access to a whole project alongside whoever else is only reading it
+        or working on single parts, eg. for loading it
+        """
+        (shared, _, _) = self.__entry(str(pid))
+        return _Held([(shared.acquire_shared, shared.release_shared)])
+
+    def files(self, pid):
+        """
+        Exclusive access to a project's snapshot and operation log on disk, so
+        that loading a project never sees a new snapshot with an old log or
+        the other way around. Taken last, and never held while waiting on the
+        others
+        """
+        (_, _, lock) = self.__entry(str(pid))
+        return _Held([(lock.acquire, lock.release)])
+
+    def part(self, pid, partIndex):
+        """
+        Exclusive access to one part of a project. Other parts of the same
+        project remain available
+        """
+        (shared, parts, _) = self.__entry(str(pid))
+        with self.__lock:
+            lock = parts.get(partIndex, None)
+            if lock is None:
+                lock = Lock()
+                parts[partIndex] = lock
+        return _Held([(shared.acquire_shared, shared.release_shared),
+            (lock.acquire, lock.release)])
@@ -2,9 +2,71 @@ import music21
 import uuid
 import json
 import base64
+from collections.abc import MutableSequence
+from threading import Lock
+from util import flyweight
+from util import scoreFormat
+from util import tieGraph
 from network.base.exceptions import GenericError
 # from copy import deepcopy
 
+class LazyParts(MutableSequence):
+    """ The parts of a project. Parts may be handed over still serialized,
+        in which case they stay that way until somebody actually looks at
+        them, and are written back out untouched if nobody ever does. """
+    def __init__(self, parts=(), frozen=(), thaw=None):
+        """ parts are music21 streams, frozen are parts as serialized by
+            freezePart. Thawed parts come first. Frozen parts are thawed
+            with thaw, thawPart by default. """
+        # [ stream or None, serialized bytes or None ]
+        self.__entries = [ [part, None] for part in parts ] + \
+                         [ [None, bits] for bits in frozen ]
+        self.__lock = Lock()
+        self.__thaw = thawPart if thaw is None else thaw
+
+    def __part(self, index):
+        entry = self.__entries[index]
+        if entry[0] is None:
+            with self.__lock:
+                if entry[0] is None:
+                    entry[0] = self.__thaw(entry[1])
+                    # It's fair game for updates now, so the bytes are stale
+                    entry[1] = None
+        return entry[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self.__part(i)
+                     for i in range(*index.indices(len(self))) ]
+        return self.__part(index)
+
+    def __setitem__(self, index, part):
+        self.__entries[index] = [part, None]
+
+    def __delitem__(self, index):
+        del self.__entries[index]
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def insert(self, index, part):
+        self.__entries.insert(index, [part, None])
+
+    def isThawed(self, index):
+        """ Whether a part has been deserialized yet. """
+        return self.__entries[index][0] is not None
+
+    def thawed(self):
+        """ The parts deserialized so far, leaving the rest alone. """
+        return [ part for [part, _] in list(self.__entries)
+                 if part is not None ]
+
+    def freeze(self):
+        """ Serialize every part, reusing the original bytes of parts that
+            were never thawed. """
+        return [ bits if part is None else freezePart(part)
+                 for [part, bits] in list(self.__entries) ]
+
 class ComposteProject:
     def __init__(self, metadata, parts=None, projectID=None):
         """ Initializes the Project with an empty stream,
@@ -12,16 +74,18 @@ class ComposteProject:
             and a dictionary of metadata about the score. """
         self.metadata = metadata
 
-        if parts is not None:
+        if isinstance(parts, LazyParts):
             self.parts = parts
+        elif parts is not None:
+            self.parts = LazyParts(parts)
         else:
             s = music21.stream.Stream()
             s.insert(0.0, music21.key.KeySignature(0))
-            s.insert(0.0, music21.meter.TimeSignature("4/4"))
+            s.insert(0.0, flyweight.timeSignature("4/4"))
             s.insert(0.0, music21.tempo.MetronomeMark("", 120, 1.0))
-            s.insert(0.0, music21.clef.clefFromString('treble'))
-            s.insert(0.0, music21.instrument.fromString('piano'))
-            self.parts = [s]
+            s.insert(0.0, flyweight.clef('treble'))
+            s.insert(0.0, flyweight.instrument('piano'))
+            self.parts = LazyParts([s])
         if projectID is not None:
             self.projectID = projectID
         else:
@@ -31,10 +95,10 @@ class ComposteProject:
         """ Adds a new part to a project. """
         s = music21.stream.Stream()
         s.insert(0.0, music21.key.keySignature(0))
-        s.insert(0.0, music21.meter.TimeSignature("4/4"))
+        s.insert(0.0, flyweight.timeSignature("4/4"))
         s.insert(0.0, music21.tempo.MetronomeMark("", 120, 1.0))
-        s.insert(0.0, music21.clef.clefFromString('treble'))
-        s.insert(0.0, music21.instrument.fromString('piano'))
+        s.insert(0.0, flyweight.clef('treble'))
+        s.insert(0.0, flyweight.instrument('piano'))
         self.parts.append(s)
 
     def updateMetadata(self, fieldName, fieldValue):
@@ -67,21 +131,39 @@ class ComposteProject:
             a ComposteProject. Intended to be stored in three
             discrete database fields. Returns a tuple containing the
             serialized JSON objects. """
-        bits = [ music21.converter.freezeStr(part) for part in self.parts ]
+        bits = self.parts.freeze()
         bytes_ = [ base64.b64encode(bit).decode() for bit in bits ]
         parts = json.dumps(bytes_)
         metadata = json.dumps(self.metadata)
         uuid = str(self.projectID)
         return (metadata, parts, uuid)
 
-def deserializeProject(serializedProject):
+def deserializeProject(serializedProject, thaw=None):
     """ Deserialize a serialized music21 composteProject
-        into a composteProject object. """
+        into a composteProject object. Parts are only thawed
+        once they are used, with thaw if given (see LazyParts). """
     (metadata, parts, id_) = serializedProject
     bits = json.loads(parts)
     bytes_ = [ base64.b64decode(bit.encode()) for bit in bits ]
-    parts = [ music21.converter.thawStr(byte) for byte in bytes_ ]
+    parts = LazyParts(frozen = bytes_, thaw = thaw)
     metadata = json.loads(metadata)
     id_ = uuid.UUID(id_)
     return ComposteProject(metadata, parts, id_)
 
+def freezePart(part):
+    """ Serialize a single part, in the compact format where possible and
+        as a music21 pickle otherwise. """
+    # Parts that aren't music21 streams know how to pack themselves
+    if hasattr(part, "toBytes"):
+        return part.toBytes()
+    try:
+        return scoreFormat.packPart(part)
+    except scoreFormat.FormatError:
+        return music21.converter.freezeStr(part)
+
+def thawPart(bits):
+    """ Deserialize a single part serialized by freezePart. """
+    if scoreFormat.isPacked(bits):
+        return scoreFormat.unpackPart(bits)
+    # Pickles from before ties linked notes together remember them by offset
+    return tieGraph.relink(music21.converter.thawStr(bits))
@@ -0,0 +1,100 @@
+# Interning for the music21 objects musicFuns makes over and over again.
+#
+# Values that nothing in Composte ever changes in place, like Durations, are
+# shared outright, so every quarter note in a score can hold the same one.
+# music21 itself does change durations in place when it tidies a score up for
+# playback or display, though, so sharing is off unless a process asks for it
+# with share(). The server never renders anything, so it does.
+#
+# Markings like clefs and time signatures can't be shared at all: an element
+# can only sit in a stream once, and keeps track of where it sits. The ones
+# that are slow to build from a string are built once as prototypes, and
+# handed out as copies.
+
+import copy
+import music21
+from threading import Lock
+
+# Past this many objects of a kind, anything new is made but not kept, so
+# that clients sending junk can't grow the tables forever
+MAX_OBJECTS = 256
+
+class _Interner:
+    """
+    One object per key, made on first use
+    """
+    def __init__(self, make):
+        self.__make = make
+        self.__objects = {}
+        self.__lock = Lock()
+        self.__uses = 0
+
+    def __call__(self, key):
+        with self.__lock:
+            self.__uses += 1
+            found = self.__objects.get(key, None)
+        if found is not None:
+            return found
+        made = self.__make(key)
+        with self.__lock:
+            if len(self.__objects) < MAX_OBJECTS:
+                made = self.__objects.setdefault(key, made)
+        return made
+
+    def stats(self):
+        """
+        How many objects are interned, and how many times they've been
+        asked for
+        """
+        with self.__lock:
+            return { "objects": len(self.__objects), "uses": self.__uses }
+
+_sharing = False
+
+_durations = _Interner(music21.duration.Duration)
+_clefs = _Interner(music21.clef.clefFromString)
+_timeSignatures = _Interner(music21.meter.TimeSignature)
+_instruments = _Interner(music21.instrument.fromString)
+
+def share(enabled = True):
+    """
+    Share values between everything that uses them, from now on
+    """
+    global _sharing
+    _sharing = enabled
+
+def duration(quarterLength):
+    """
+    A Duration of quarterLength, shared if sharing is on. Callers must never
+    change it
+    """
+    if not _sharing:
+        return music21.duration.Duration(quarterLength)
+    return _durations(music21.common.opFrac(quarterLength))
+
+def clef(clefStr):
+    """
+    music21.clef.clefFromString(clefStr), from a prototype
+    """
+    return copy.deepcopy(_clefs(clefStr))
+
+def timeSignature(ratioStr):
+    """
+    music21.meter.TimeSignature(ratioStr), from a prototype
+    """
+    return copy.deepcopy(_timeSignatures(ratioStr))
+
+def instrument(instrumentStr):
+    """
+    music21.instrument.fromString(instrumentStr), from a prototype
+    """
+    return copy.deepcopy(_instruments(instrumentStr))
+
+def stats():
+    """
+    For each kind of object, how many are interned and how many times
+    they've been asked for. Durations only count while sharing is on
+    """
+    return { "durations": _durations.stats(), "clefs": _clefs.stats(),
+             "timeSignatures": _timeSignatures.stats(),
+             "instruments": _instruments.stats() }
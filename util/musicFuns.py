@@ -1,4 +1,9 @@
 import music21
+import math
+from array import array
+from util import partIndex
+from util import tieGraph
+from util import flyweight
 
 # TODO FOR FUTURE SELVES BEYOND COMP50: 
 # Refactor projects and streams globally to obey a
@@ -26,81 +31,65 @@ import music21
 # Likewise, for this initial implemenation, articulations,
 # expressions, and repeats remain unimplemented.
 
+# How to spell each pitch class, in keys with sharps and in keys without
+SHARP_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+FLAT_NAMES = ['C', 'D-', 'D', 'E-', 'E', 'F', 'G-', 'G', 'A-', 'A', 'B-', 'B']
+
 def changeKeySignature(offset, part, newSigSharps):
     """ Changes the Key Signature at a given offset inside a part.
         Must provide the correct number of sharps in the key signature
         as an integer. Negative numbers correspond to the number of flats. """
     newKeySig = music21.key.KeySignature(newSigSharps)
-    oldKeySigs = part.getKeySignatures()
-    for i in range(len(oldKeySigs)):
-        if oldKeySigs[i].offset == offset:
-            part.replace(oldKeySigs[i], newKeySig)
-            if i + 1 == len(oldKeySigs):
-                renameNotes(offset, part, newKeySig)
-                return [offset, part.highestTime]
-            else:
-                renameNotes(offset, part, newKeySig, oldKeySigs[i + 1].offset)
-                return [offset, oldKeySigs[i + 1].offset]
-    part.insert(offset, newKeySig)
-    for oldKeySig in oldKeySigs:
-        # oldKeySigs is sorted, so this finds the first oldKeySig
-        # That's after the one that was just inserted
-        if offset < oldKeySig.offset:
-            renameNotes(offset, part, newKeySig, oldKeySig.offset)
-            return [offset, oldKeySig.offset]
-    renameNotes(offset, part, newKeySig)
-    return [offset, part.highestTime]
+    keySigs = partIndex.keySignatures(part)
+    oldKeySig = keySigs.at(offset)
+    if oldKeySig is not None:
+        partIndex.remove(part, oldKeySig)
+    partIndex.insert(part, offset, newKeySig)
+    nextOffset = keySigs.after(offset)
+    renameNotes(offset, part, newKeySig, nextOffset)
+    if nextOffset is None:
+        return [offset, part.highestTime]
+    return [offset, nextOffset]
 
 def renameNotes(startOffset, part, keySig, endOffset=None):
     """ Rename all notes affected by a key signature change
         intelligently so as to not have sharp accidentals
-        in a flat key signature. Diffs need to accumulate
-        while the renaming is in process. """
-    notes = part.notes
+        in a flat key signature. Only notes from startOffset
+        up to endOffset, where the next key signature takes
+        over, are respelled. """
+    end = math.inf if endOffset is None else endOffset
+    found = [(offset, note) for (offset, note)
+             in partIndex.intervals(part).startingWithin(startOffset, end)
+             if isinstance(note, music21.note.Note)]
+    midis = array('h', (note.pitch.midi for (_, note) in found))
     hasSharps = 0 < keySig.sharps
-    for note in notes:
-        offset = note.offset
-        if endOffset is None:
-            if startOffset <= offset:
-                part.replace(note, renameNote(note, hasSharps))
-        else:
-            if startOffset <= offset and offset <= endOffset:
-                part.replace(note, renameNote(note, hasSharps))
-
-def renameNote(note, hasSharps):
-    """ Rename a note intelligently within a key. """
-    # Have to create a NEW Note object to use replace. Reasons unclear.
-    name = note.name
-    octave = note.octave
-    duration = note.duration
-    if hasSharps:
-        if name[1] == '-':
-            noteName = name[0]
-            if noteName == 'A':
-                newName = 'G'
-            else:
-                newName = chr(ord(noteName) - 1)
-            newName += '#'
-        else:
-            newName = name
-    else:
-        if name[1] == '#':
-            noteName = name[0]
-            if noteName == 'G':
-                newName = 'A'
-            else:
-                newName = chr(ord(noteName) + 1)
-            newName += '-'
-        else:
-            newName = name
-    return createNote(newName + str(octave), duration.quarterLength)
+    respellNotes(part, found, midis, lambda offset: hasSharps)
+
+def respellNotes(part, found, midis, hasSharps):
+    """ Spell each (offset, note) in found as the MIDI number
+        beside it in midis, in place. hasSharps says whether
+        the key at an offset has sharps, which decides between
+        sharps and flats. Notes already spelled right are left
+        alone. """
+    lookup = partIndex.lookup(part)
+    for ((offset, note), midi) in zip(found, midis):
+        names = SHARP_NAMES if hasSharps(offset) else FLAT_NAMES
+        name = names[midi % 12]
+        octave = midi // 12 - 1
+        if note.pitch.name == name and note.pitch.octave == octave:
+            continue
+        lookup.discard(offset, note)
+        note.pitch.name = name
+        note.pitch.octave = octave
+        note.pitch.spellingIsInferred = False
+        lookup.add(offset, note)
 
 # NOT IN MINIMUM DELIVERABLE
 def changeTimeSignature(offset, part, newSigStr):
     """ Changes the Time Signature at a given offset inside a part.
         newTimeSig must be a string representing the new time signature,
         such as '4/4' or '6/8'. """
-    newTimeSig = music21.meter.TimeSignature(newSigStr)
+    newTimeSig = flyweight.timeSignature(newSigStr)
     oldTimeSigs = part.getTimeSignatures()
     for oldTimeSig in oldTimeSigs:
         if oldTimeSig.offset == offset:
@@ -119,34 +108,27 @@ def insertMetronomeMark(offset, parts, bpm):
         BPM (beats per minute). """
     mark = music21.tempo.MetronomeMark("", bpm, 1.0)
     for part in parts:
-        markings = part.metronomeMarkBoundaries()
-        markFound = False
-        for marking in markings:
-            # Marking already exists at that location, so update it
-            if marking[0] == offset:
-                markFound = True
-                part.replace(marking[2], mark)
-                break
-        if markFound: 
-            continue
-        part.insert(offset, mark)
+        # Marking already exists at that location, so update it
+        marking = partIndex.tempos(part).at(offset)
+        if marking is not None:
+            partIndex.remove(part, marking)
+        partIndex.insert(part, offset, mark)
     return [offset, offset]
 
 def removeMetronomeMark(offset, parts):
     """ Remove a metronome marking from each part in
         a list of parts at a given offset. """
     for part in parts:
-        markings = part.metronomeMarkBoundaries()
-        for marking in markings:
-            if marking[0] == offset and offset != 0.0:
-                part.remove(marking[2])
+        marking = partIndex.tempos(part).at(offset)
+        if marking is not None and offset != 0.0:
+            partIndex.remove(part, marking)
     return [offset, offset]
 
 def createNote(pitchName, durationInQLs):
     """ Creates a Note from the name of a pitch (as a string)
         and a duration in quarter lengths (as a float). """
-    note = music21.note.Note(pitchName)
-    note.duration = music21.duration.Duration(durationInQLs)
+    note = music21.note.Note(pitchName,
+                             duration=flyweight.duration(durationInQLs))
     note.pitch.spellingIsInferred = False
     # Needed in order to sever ties between notes
     note.tiePartners = [None, None]
@@ -156,7 +138,7 @@ def insertNote(offset, part, pitchStr, duration):
     """ Add a note at a given offset to a part. """
     newNote = createNote(pitchStr, duration)
     bounds = (offset, offset + duration) 
-    notes = part.notes
+    notes = partIndex.intervals(part).overlapping(*bounds)
     maxLims = [None, None]
     for note in notes: 
         limits = (note.offset, 
@@ -173,23 +155,24 @@ def insertNote(offset, part, pitchStr, duration):
     else: 
         maxLims = [min(maxLims[0], bounds[0]),
                    max(maxLims[1], bounds[1])]
-    part.insert(offset, newNote)
+    partIndex.insert(part, offset, newNote)
     return maxLims
 
 def removeNote(offset, part, removedNoteName):
     """ Remove a note at a given offset into a part. """
-    notes = part.notes
+    notes = partIndex.lookup(part).find(offset, removedNoteName)
     maxLims = [offset, offset]
     for note in notes:
         noteName = note.pitch.nameWithOctave
         if note.offset == offset and noteName == removedNoteName:
-            if note.tiePartners[0] is not None: 
-                maxLims[0] = note.tiePartners[0]
-                updateTieStatus(note.tiePartners[0], part, noteName)
-            if note.tiePartners[1] is not None: 
-                maxLims[1] = note.tiePartners[1]
-                updateTieStatus(offset, part, noteName)
-            part.remove(note)
+            (previous, next_) = tieGraph.partners(note)
+            if previous is not None: 
+                maxLims[0] = part.elementOffset(previous)
+                makeTieUpdate([previous, note])
+            if next_ is not None: 
+                maxLims[1] = part.elementOffset(next_)
+                makeTieUpdate([note, next_])
+            partIndex.remove(part, note)
             return maxLims
     return maxLims
 
@@ -199,12 +182,13 @@ def updateTieStatus(offset, part, noteName):
         this function MUST be the same as the offset of the
         FIRST note in a legally tie-able pair of notes (the notes
         must be the same pitch, and there must be no rests between them)."""
-    notes = part.notes
+    notes = partIndex.lookup(part).find(offset, noteName)
     for note in notes:
         pitchStr = note.pitch.nameWithOctave
         if note.offset == offset and pitchStr == noteName:
             qL = note.duration.quarterLength
-            tieCantidates = part.getElementsByOffset(note.offset + qL)
+            tieCantidates = partIndex.lookup(part).find(note.offset + qL,
+                                                        noteName)
             for cantidate in tieCantidates:
                 if cantidate.pitch.nameWithOctave == noteName:
                     makeTieUpdate([note, cantidate])
@@ -220,55 +204,65 @@ def makeTieUpdate(notes):
     [firstNote, secondNote] = notes
     # Add Ties
     if firstNote.tie is None and secondNote.tie is None:
-        firstNote.tiePartners[1] = secondNote.offset
-        secondNote.tiePartners[0] = firstNote.offset
+        tieGraph.link(firstNote, secondNote)
         firstNote.tie = music21.tie.Tie("start")
         secondNote.tie = music21.tie.Tie("stop")
     elif firstNote.tie.type == "stop" and secondNote.tie is None:
-        firstNote.tiePartners[1] = secondNote.offset
-        secondNote.tiePartners[0] = firstNote.offset
+        tieGraph.link(firstNote, secondNote)
         firstNote.tie.type = "continue"
         secondNote.tie = music21.tie.Tie("stop")
     elif firstNote.tie is None and secondNote.tie.type == "start":
-        firstNote.tiePartners[1] = secondNote.offset
-        secondNote.tiePartners[0] = firstNote.offset
+        tieGraph.link(firstNote, secondNote)
         firstNote.tie = music21.tie.Tie("start")
         secondNote.tie.type = "continue"
     elif firstNote.tie.type == "stop" and secondNote.tie.type == "start":
-        firstNote.tiePartners[1] = secondNote.offset
-        secondNote.tiePartners[0] = firstNote.offset
+        tieGraph.link(firstNote, secondNote)
         firstNote.tie.type = "continue"
         secondNote.tie.type = "continue"
     # Remove Ties
     elif firstNote.tie.type == "start" and secondNote.tie.type == "stop":
-        firstNote.tiePartners[1] = None
-        secondNote.tiePartners[0] = None
+        tieGraph.unlink(firstNote, secondNote)
         firstNote.tie = None
         secondNote.tie = None
     elif firstNote.tie.type == "start" and secondNote.tie.type == "continue":
-        firstNote.tiePartners[1] = None
-        secondNote.tiePartners[0] = None
+        tieGraph.unlink(firstNote, secondNote)
         firstNote.tie = None
         secondNote.tie.type = "start"
     elif firstNote.tie.type == "continue" and secondNote.tie.type == "continue":
-        firstNote.tiePartners[1] = None
-        secondNote.tiePartners[0] = None
+        tieGraph.unlink(firstNote, secondNote)
         firstNote.tie.type = "stop"
         secondNote.tie.type = "start"
     elif firstNote.tie.type == "continue" and secondNote.tie.type == "stop":
-        firstNote.tiePartners[1] = None
-        secondNote.tiePartners[0] = None
+        tieGraph.unlink(firstNote, secondNote)
         firstNote.tie.type = "stop"
         secondNote.tie = None
     # For completeness and defense against race conditions
     else:
         pass
 
-def transpose(part, semitones):
-    """ Transposes the whole part up or down
-        by an integer number of semitones. """
-    part = part.transpose(semitones)
-    return [0.0, part.highestTime]
+def transpose(part, semitones, startOffset=None, endOffset=None):
+    """ Transposes the notes of a part that start between startOffset
+        and endOffset up or down by an integer number of semitones,
+        in place. Without offsets, the whole part is transposed.
+        Accidentals follow the key signature in effect, like
+        renameNotes. """
+    start = 0.0 if startOffset is None else startOffset
+    end = math.inf if endOffset is None else endOffset
+    found = [(offset, note) for (offset, note)
+             in partIndex.intervals(part).startingWithin(start, end)
+             if isinstance(note, music21.note.Note)]
+    if len(found) == 0:
+        return [start, start]
+    # One pass over the MIDI numbers, and only then touch the notes
+    midis = array('h', (note.pitch.midi + semitones for (_, note) in found))
+    if min(midis) < 0 or 127 < max(midis):
+        raise music21.pitch.PitchException("Can't transpose out of range")
+    keySigs = partIndex.keySignatures(part)
+    respellNotes(part, found, midis,
+                 lambda offset: 0 < keySigs.sharpsAt(offset))
+    return [float(found[0][0]),
+            float(max(offset + note.duration.quarterLength
+                      for (offset, note) in found))]
 
 def insertClef(offset, part, clefStr):
     """ Inserts a new clef at a given offset in a given part.
@@ -277,7 +271,7 @@ def insertClef(offset, part, clefStr):
         'bass8vb', 'frenchviolin', 'alto', 'tenor', 'cbaritone',
         'fbaritone', 'gsoprano', 'mezzosoprano', 'soprano',
         'percussion', and 'tab'. """
-    newClef = music21.clef.clefFromString(clefStr)
+    newClef = flyweight.clef(clefStr)
     elems = part.getElementsByOffset(offset)
     # Only clef objects have an octaveChange field
     for elem in elems:
@@ -299,15 +293,183 @@ def removeClef(offset, part):
     return [offset, offset]
 
 def insertMeasures(insertionOffset, part, insertedQLs):
-    """ Insert measures in a part by moving the offsets of
-        portions of the score by a given number of QLs. """
-    return [insertionOffset, part.highestTime]
+    """ Insert measures in a part, or in every part of a list
+        of parts, by moving everything from insertionOffset on
+        later by a given number of QLs. Markings right at
+        insertionOffset stay put, so they cover the new measures. """
+    if insertedQLs <= 0:
+        raise music21.exceptions21.StreamException(
+            "Can only insert a positive number of QLs")
+    parts = _parts(part)
+    for part in parts:
+        partIndex.shift(part, insertionOffset, insertedQLs)
+    return [insertionOffset, max(part.highestTime for part in parts)]
+
+def _parts(part):
+    """ A part, or a list of parts, as a list of parts. """
+    return [part] if isinstance(part, music21.stream.Stream) else part
+
+def _checkRange(startOffset, endOffset):
+    if endOffset <= startOffset:
+        raise music21.exceptions21.StreamException(
+            "A range has to end after it starts")
+
+def _span(*spans):
+    """ The smallest [start, end] covering every one of spans
+        that isn't None. """
+    spans = [span for span in spans if span is not None]
+    return [float(min(span[0] for span in spans)),
+            float(max(span[1] for span in spans))]
+
+def _region(part, startOffset, endOffset):
+    """ The notes and dynamics of a part that start in
+        [startOffset, endOffset), in order, as (offset, element).
+        Clefs, keys and the like describe the part rather than the
+        music in it, so they stay out of it. """
+    return [(entry.offset, entry.element) for entry
+            in partIndex.elements(part).within(startOffset, endOffset)
+            if isinstance(entry.element, (music21.note.Note,
+                                          music21.dynamics.Dynamic))]
+
+# Which tie a note has, going by whether it's tied to a note before
+# and after it
+_TIES = {
+    (False, False): None,
+    (False, True):  "start",
+    (True, False):  "stop",
+    (True, True):   "continue",
+}
+
+def _copyRegion(region, moveBy):
+    """ Copies of the elements of a region, moveBy QLs later. Ties
+        between two notes of the region are copied too, and ties to
+        anything outside of it are dropped. """
+    copies = {}
+    for (offset, element) in region:
+        if isinstance(element, music21.dynamics.Dynamic):
+            copied = music21.dynamics.Dynamic(element.value)
+        else:
+            copied = createNote(element.pitch.nameWithOctave,
+                                element.duration.quarterLength)
+            copied.pitch.spellingIsInferred = \
+                element.pitch.spellingIsInferred
+            for lyric in element.lyrics:
+                copied.addLyric(lyric.text)
+        copies[id(element)] = (offset + moveBy, copied)
+    for (offset, element) in region:
+        (_, next_) = tieGraph.partners(element)
+        if next_ is not None and id(next_) in copies:
+            tieGraph.link(copies[id(element)][1], copies[id(next_)][1])
+    for (offset, copied) in copies.values():
+        if isinstance(copied, music21.note.Note):
+            tie = _TIES[tuple(partner is not None for partner
+                              in tieGraph.partners(copied))]
+            copied.tie = None if tie is None else music21.tie.Tie(tie)
+    return list(copies.values())
+
+def _clear(part, doomed):
+    """ Remove notes and dynamics from a part in one go, cutting
+        any ties to notes that stay. Returns the [start, end] of
+        what changed, or None if nothing did. """
+    if len(doomed) == 0:
+        return None
+    limits = [math.inf, -math.inf]
+    for element in doomed:
+        offset = part.elementOffset(element)
+        limits = [min(limits[0], offset),
+                  max(limits[1], offset + element.duration.quarterLength)]
+        if not isinstance(element, music21.note.Note):
+            continue
+        (previous, next_) = tieGraph.partners(element)
+        if previous is not None:
+            limits[0] = min(limits[0], part.elementOffset(previous))
+            makeTieUpdate([previous, element])
+        if next_ is not None:
+            limits[1] = max(limits[1], part.elementOffset(next_))
+            makeTieUpdate([element, next_])
+    partIndex.removeAll(part, doomed)
+    return limits
+
+def _paste(part, copies, destination, length):
+    """ Put copies, as _copyRegion makes them, into a part, in place
+        of the region of length QLs at destination. Copied notes
+        replace anything they overlap, like insertNote. Returns the
+        [start, end] of what changed. """
+    doomed = [element for (_, element)
+              in _region(part, destination, destination + length)]
+    for (offset, copied) in copies:
+        if isinstance(copied, music21.note.Note):
+            doomed.extend(partIndex.intervals(part).overlapping(
+                offset, offset + copied.duration.quarterLength))
+    doomed = list({id(element): element for element in doomed}.values())
+    limits = _clear(part, doomed)
+    for (offset, copied) in copies:
+        # Tied copies need each other's offsets, so keep them in order
+        partIndex.insert(part, offset, copied)
+    return _span([destination, destination + length], limits,
+                 *[[offset, offset + copied.duration.quarterLength]
+                   for (offset, copied) in copies])
+
+def deleteRange(startOffset, part, endOffset):
+    """ Delete the notes (with their lyrics) and dynamics that start
+        between startOffset and endOffset from a part, or from every
+        part of a list of parts. What comes after stays put. """
+    _checkRange(startOffset, endOffset)
+    spans = [[startOffset, endOffset]]
+    for part in _parts(part):
+        region = _region(part, startOffset, endOffset)
+        spans.append(_clear(part, [element for (_, element) in region]))
+    return _span(*spans)
+
+def copyRange(startOffset, part, endOffset, destination):
+    """ Copy the notes and dynamics that start between startOffset
+        and endOffset to destination, in a part, or in every part of
+        a list of parts. Whatever was there before is replaced. """
+    _checkRange(startOffset, endOffset)
+    length = endOffset - startOffset
+    spans = []
+    for part in _parts(part):
+        copies = _copyRegion(_region(part, startOffset, endOffset),
+                             destination - startOffset)
+        spans.append(_paste(part, copies, destination, length))
+    return _span(*spans)
+
+def moveRange(startOffset, part, endOffset, destination):
+    """ Like copyRange, except that the originals are deleted. """
+    _checkRange(startOffset, endOffset)
+    length = endOffset - startOffset
+    spans = [[startOffset, endOffset]]
+    for part in _parts(part):
+        region = _region(part, startOffset, endOffset)
+        copies = _copyRegion(region, destination - startOffset)
+        spans.append(_clear(part, [element for (_, element) in region]))
+        spans.append(_paste(part, copies, destination, length))
+    return _span(*spans)
+
+def duplicateRange(startOffset, part, endOffset):
+    """ Repeat the notes and dynamics that start between startOffset
+        and endOffset right after endOffset, moving everything from
+        there on later to make room, like insertMeasures. """
+    _checkRange(startOffset, endOffset)
+    length = endOffset - startOffset
+    parts = _parts(part)
+    for part in parts:
+        copies = _copyRegion(_region(part, startOffset, endOffset), length)
+        # Dynamics belong to the notes after them, unlike other markings
+        following = list(part.getElementsByOffset(endOffset)
+                         .getElementsByClass(music21.dynamics.Dynamic))
+        partIndex.shift(part, endOffset, length)
+        for dynamic in following:
+            partIndex.remove(part, dynamic)
+            partIndex.insert(part, endOffset + length, dynamic)
+        _paste(part, copies, endOffset, length)
+    return [float(endOffset), float(max(part.highestTime for part in parts))]
 
 def addInstrument(offset, part, instrumentStr):
     """ Given an instrument name, assigns that instrument
         to a part in the score. The number of instruments
         supported on the backend are much to numerous to name."""
-    instrument = music21.instrument.fromString(instrumentStr)
+    instrument = flyweight.instrument(instrumentStr)
     elems = part.getElementsByOffset(offset)
     for elem in elems:
         if hasattr(elem, 'instrumentName'):
@@ -350,7 +512,7 @@ def removeDynamic(offset, part):
 
 def addLyric(offset, part, lyric):
     """ Add lyrics to a given note in the score. """
-    notes = part.notes
+    notes = partIndex.intervals(part).startingAt(offset)
     for note in notes:
         if note.offset == offset:
             note.addLyric(lyric)
@@ -368,6 +530,6 @@ def boundedOffset(part, bounds):
         element is the music21 object to insert.
         offset is the insertion offset of the music21 object. 
         endTime is the termination offset of the music21 object. """
-    offs = part.offsetMap()
-    return [x for x in offs 
-            if bounds[0] <= x.offset and x.endTime < bounds[1]]
+    # Nothing that ends before bounds[1] can start any later
+    offs = partIndex.elements(part).within(bounds[0], bounds[1])
+    return [x for x in offs if x.endTime < bounds[1]]
@@ -11,6 +11,139 @@ from network.base.exceptions import GenericError
 import music21
 import json
 
+try:
+    from util import arrayScore
+except ImportError as e:
+    # Only servers running --score-engine numpy need it
+    arrayScore = None
+
+def engineFor(musicObject):
+    """ The module that edits musicObject: arrayScore for the
+        server's ArrayParts, and musicFuns for music21 streams. """
+    if arrayScore is not None and arrayScore.handles(musicObject):
+        return arrayScore
+    return musicFuns
+
+# How much work an operation is, roughly, so that whoever is counting or
+# rationing updates doesn't have to know about every one of them.
+# POINT edits a note or marking where it stands, RANGE may touch every note
+# in a stretch of a part, and SHIFT moves everything after a point
+POINT = "point"
+RANGE = "range"
+SHIFT = "shift"
+
+# Stands in for the part or parts an update applies to among the arguments
+# of an operation
+MUSIC = object()
+
+class InvalidArgument(Exception):
+    """ An argument that converts fine but still makes no sense. The
+        message goes back to the client as is. """
+    pass
+
+LEGAL_LENGTHS = [4.0, 3.0, 2.0, 1.5, 1.0, 0.75, 0.5, 0.375, 0.25]
+
+def noteLength(value):
+    """ A note length in quarterLengths, if it's one we can draw. """
+    length = float(value)
+    if length not in LEGAL_LENGTHS:
+        raise InvalidArgument("INVALID NOTE LENGTH")
+    return length
+
+def optional(convert):
+    """ convert, letting None through. """
+    return lambda value: None if value is None else convert(value)
+
+class Operation:
+    """ An update clients can make to a project. The function of the
+        same name in musicFuns (or arrayScore) makes it, with the
+        arguments the schema pulls out of the update. schema lists,
+        in order, either MUSIC, or (index into the update's arguments,
+        conversion). affects takes the converted arguments and says
+        which offsets the update could touch, as [start, end], where
+        an end of None means the end of the part. """
+    def __init__(self, name, schema, cost, affects):
+        self.name = name
+        self.cost = cost
+        self.__schema = schema
+        self.__affects = affects
+
+    def arguments(self, args, musicObject):
+        """ The arguments to call the update's function with. Raises
+            GenericError if args don't fit the schema, and
+            InvalidArgument if they fit but don't make sense. """
+        try:
+            return [ musicObject if slot is MUSIC else slot[1](args[slot[0]])
+                     for slot in self.__schema ]
+        except (ValueError, TypeError, IndexError) as e:
+            raise GenericError from e
+
+    def affects(self, arguments):
+        """ [start, end] of what the update could change, given the
+            arguments its function will be called with. An open end
+            becomes infinity. """
+        (start, end) = self.__affects(*arguments)
+        return [start, float("inf") if end is None else end]
+
+    def span(self, reach, changed):
+        """ [start, end] of what clients should redraw after an update
+            that could change reach reported changing changed.
+            Functions only report what they touched directly, so
+            anything further the operation could have moved is
+            included. Offsets music21 keeps as Fractions come out as
+            floats, so that the span can go over the wire. """
+        return [float(min(reach[0], changed[0])),
+                float(max(reach[1], changed[1]))]
+
+def _at(offset, *rest):
+    return [offset, offset]
+
+def _onwards(offset, *rest):
+    return [offset, None]
+
+def _operations(*operations):
+    return { operation.name: operation for operation in operations }
+
+OPERATIONS = _operations(
+    Operation("insertNote", [(0, float), MUSIC, (2, str), (3, noteLength)],
+              POINT, lambda offset, part, pitch, length:
+                  [offset, offset + length]),
+    Operation("removeNote", [(0, float), MUSIC, (2, str)], POINT, _at),
+    Operation("addLyric", [(0, float), MUSIC, (2, str)], POINT, _at),
+    Operation("changeKeySignature", [(0, float), MUSIC, (2, int)], RANGE,
+              _onwards),
+    Operation("transpose", [MUSIC, (1, int), (2, optional(float)),
+                            (3, optional(float))], RANGE,
+              lambda part, semitones, start, end:
+                  [0.0 if start is None else start, end]),
+    Operation("insertMeasures", [(0, float), MUSIC, (2, float)], SHIFT,
+              _onwards),
+    Operation("insertMetronomeMark", [(0, float), MUSIC, (1, int)], POINT,
+              _at),
+    Operation("removeMetronomeMark", [(0, float), MUSIC], POINT, _at),
+    Operation("insertClef", [(0, float), MUSIC, (2, str)], POINT, _at),
+    Operation("removeClef", [(0, float), MUSIC], POINT, _at),
+    Operation("addInstrument", [(0, float), MUSIC, (2, str)], POINT, _at),
+    Operation("removeInstrument", [(0, float), MUSIC], POINT, _at),
+    Operation("addDynamic", [(0, float), MUSIC, (2, str)], POINT, _at),
+    Operation("removeDynamic", [(0, float), MUSIC], POINT, _at),
+    Operation("deleteRange", [(0, float), MUSIC, (2, float)], RANGE,
+              lambda start, part, end: [start, end]),
+    Operation("copyRange", [(0, float), MUSIC, (2, float), (3, float)],
+              RANGE, lambda start, part, end, destination:
+                  [destination, destination + end - start]),
+    Operation("moveRange", [(0, float), MUSIC, (2, float), (3, float)],
+              RANGE, lambda start, part, end, destination:
+                  [min(start, destination),
+                   max(end, destination + end - start)]),
+    Operation("duplicateRange", [(0, float), MUSIC, (2, float)], SHIFT,
+              lambda start, part, end: [end, None]),
+)
+
+def operation(fname):
+    """ The Operation called fname, if there is one. """
+    return OPERATIONS.get(fname, None)
+
 def performMusicFun(projectID, fname, args, partIndex=None, offset=None,
         fetchProject=None):
     """ Wrapper for all music functions, where the
@@ -23,82 +156,40 @@ def performMusicFun(projectID, fname, args, partIndex=None, offset=None,
     args = json.loads(args)
     if fname == "chat": return ("ok", "") # Why not make a chat server too?
 
-    def unpackFun(fname, args):
-        """ Determines which function to call and
-            casts all arguments to the correct types. """
-        try:
-            if partIndex is not None and partIndex != "None":
-                musicObject = project.parts[int(partIndex)]
-            else:
-                musicObject = project.parts
-
-            if fname == 'changeKeySignature':
-                return (musicFuns.changeKeySignature, [float(args[0]),
-                        musicObject, int(args[2])])
-            elif fname == 'insertNote':
-                return (musicFuns.insertNote, [float(args[0]),
-                        musicObject, args[2], float(args[3])])
-            elif fname == 'removeNote':
-                return (musicFuns.removeNote, [float(args[0]),
-                        musicObject, args[2]])
-            elif fname == 'insertMetronomeMark':
-                return (musicFuns.insertMetronomeMark, [float(args[0]),
-                        musicObject, int(args[1])])
-            elif fname == 'removeMetronomeMark':
-                return (musicFuns.removeMetronomeMark, [float(args[0]),
-                        musicObject])
-            elif fname == 'transpose':
-                return (musicFuns.transpose, [musicObject,
-                        int(args[1])])
-            elif fname == 'insertClef':
-                return (musicFuns.insertClef, [float(args[0]),
-                        musicObject, args[2]])
-            elif fname == 'removeClef':
-                return (musicFuns.removeClef, [float(args[0]),
-                        musicObject])
-            elif fname == 'insertMeasures':
-                return (musicFuns.insertMeasures, [float(args[0]),
-                        musicObject, float(args[2])])
-            elif fname == 'addInstrument':
-                return (musicFuns.addInstrument, [float(args[0]),
-                        musicObject, args[2]])
-            elif fname == 'removeInstrument':
-                return (musicFuns.removeInstrument, [float(args[0]),
-                        musicObject])
-            elif fname == 'addDynamic':
-                return (musicFuns.addDynamic, [float(args[0]),
-                        musicObject, args[2]])
-            elif fname == 'removeDynamic':
-                return (musicFuns.removeDynamic, [float(args[0]),
-                        musicObject])
-            elif fname == 'addLyric':
-                return (musicFuns.addLyric, [float(args[0]),
-                        musicObject, args[2]])
-            else:
-                return (None, None)
-        except ValueError as e:
-            raise GenericError from e
-
-    (function, arguments) = unpackFun(fname, args)
-    # Begin error handling
-    if (function, arguments) == (None, None):
+    op = OPERATIONS.get(fname, None)
+    if op is None:
         return ("fail", "INVALID OPERATION")
 
+    try:
+        if partIndex is not None and partIndex != "None":
+            index = int(partIndex)
+            # Counting from the end would give parts two names, and the
+            # server locks parts by name
+            if index < 0:
+                raise GenericError
+            musicObject = project.parts[index]
+        else:
+            musicObject = project.parts
+    except (ValueError, IndexError) as e:
+        raise GenericError from e
+
+    try:
+        arguments = op.arguments(args, musicObject)
+    except InvalidArgument as e:
+        return ("fail", str(e))
+
     if offset is not None and offset != 'None':
         if float(offset) < 0.0:
             raise GenericError
 
-    # Last-minute note length validation hack
-    legalLengths = [4.0, 3.0, 2.0, 1.5, 1.0, 0.75, 0.5, 0.375, 0.25]    
-    if fname == "insertNote": 
-        if arguments[3] not in legalLengths: 
-            return ("fail", "INVALID NOTE LENGTH")
+    # Before the edit, so that nothing is left to go wrong once the
+    # project has changed
+    reach = op.affects(arguments)
 
+    function = getattr(engineFor(musicObject), op.name)
     try:
         updateOffsets = function(*arguments)
     except music21.exceptions21.Music21Exception:
         raise GenericError
 
-    # End error handling
-    return ("ok", updateOffsets)
-
+    return ("ok", op.span(reach, updateOffsets))
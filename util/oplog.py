@@ -0,0 +1,135 @@
+import os
+import json
+from threading import Lock
+
+class OperationLog:
+    """
+    Append-only log of the operations applied to a project since its last
+    snapshot, one JSON document per line:
+        [ sequence number, operation ]
+    Sequence numbers only ever go up, so a snapshot that remembers the last
+    sequence number it covers tells us which entries to skip on replay.
+    """
+
+    def __init__(self, path, base = 0):
+        """
+        Open (or create) the log at path. base is the sequence number of the
+        most recent snapshot. A torn entry at the end of the log, left by a
+        crash halfway through a write, is discarded.
+        """
+        self.__path = path
+        self.__lock = Lock()
+        self.__sequence = base
+        self.__base = base
+        self.__unsynced = False
+        self.__closed = False
+
+        good = 0
+        try:
+            with open(self.__path, "rb") as f:
+                for line in f:
+                    try:
+                        (seq, _) = json.loads(line.decode())
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    good += len(line)
+                    self.__sequence = max(self.__sequence, seq)
+        except FileNotFoundError as e:
+            pass
+
+        self.__file = open(self.__path, "ab")
+        if self.__file.tell() != good:
+            self.__file.truncate(good)
+        self.__size = good
+
+    def append(self, operation, then = None):
+        """
+        Record an operation, returning its sequence number. The entry is
+        handed to the OS immediately, but only reaches the disk for sure on
+        the next sync(). If given, then is called with the sequence number
+        before anything else can be appended, so whatever it does happens in
+        sequence order
+        """
+        with self.__lock:
+            self.__sequence += 1
+            line = (json.dumps([self.__sequence, operation]) + "\n").encode()
+            self.__file.write(line)
+            self.__file.flush()
+            self.__size += len(line)
+            self.__unsynced = True
+            if then is not None:
+                then(self.__sequence)
+            return self.__sequence
+
+    def entries(self, since = 0):
+        """
+        List the operations with sequence numbers greater than since, in
+        order, as (sequence number, operation)
+        """
+        with self.__lock:
+            self.__file.flush()
+            found = []
+            with open(self.__path, "rb") as f:
+                for line in f:
+                    # Anything past a torn entry isn't trustworthy
+                    if not line.endswith(b"\n"):
+                        break
+                    (seq, operation) = json.loads(line.decode())
+                    if seq > since:
+                        found.append((seq, operation))
+            return found
+
+    def sequence(self):
+        """
+        Sequence number of the most recent entry
+        """
+        with self.__lock:
+            return self.__sequence
+
+    def base(self):
+        """
+        Sequence number of the snapshot the log starts from. Entries from
+        before then are gone
+        """
+        with self.__lock:
+            return self.__base
+
+    def size(self):
+        """
+        Size of the log in bytes
+        """
+        with self.__lock:
+            return self.__size
+
+    def sync(self):
+        """
+        Make sure everything appended so far has reached the disk
+        """
+        with self.__lock:
+            if self.__closed or not self.__unsynced: return
+            os.fsync(self.__file.fileno())
+            self.__unsynced = False
+
+    def truncate(self):
+        """
+        Throw away every entry, usually because a snapshot now covers them.
+        Sequence numbers carry on from where they were
+        """
+        with self.__lock:
+            self.__file.truncate(0)
+            self.__file.seek(0)
+            os.fsync(self.__file.fileno())
+            self.__size = 0
+            self.__base = self.__sequence
+            self.__unsynced = False
+
+    def close(self):
+        """
+        Sync and close the log. Closing it again does nothing
+        """
+        self.sync()
+        with self.__lock:
+            self.__file.close()
+            self.__closed = True
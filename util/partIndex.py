@@ -0,0 +1,559 @@
+# Indexes over the notes in a part, so that musicFuns can find the handful of
+# notes an update cares about without walking every note in the part, and
+# the GUI can find what to draw in a few measures without walking the score.
+#
+# Indexes live in the part's own cache, which music21 throws away whenever
+# the elements of the part change. An index can therefore never go stale
+# behind our backs: anything that changes a part without going through
+# insert() and remove() here just costs a rebuild the next time somebody
+# asks. The one thing music21 doesn't notice is a note changing pitch in
+# place, which is what forget() is for.
+#
+# Keeping the cache and the offsets in step means reaching into Stream
+# internals (_cache, _elements, _offsetDict, coreElementsChanged),
+# which do move between music21 releases. This is written against the
+# version pinned in requirements.txt.
+
+import music21
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+# music21 caches the end of the part under this name, and works it out again
+# from scratch on every insert if it isn't there. Which is every insert,
+# because every insert empties the cache
+_HIGHEST_TIME = "HighestTime"
+
+# What Stream.offsetMap() hands out, give or take the class
+OffsetMapEntry = namedtuple("OffsetMapEntry",
+        [ "element", "offset", "endTime", "voiceIndex" ])
+
+# Offsets in the indexes are kept the way music21 keeps them, as floats where
+# they can be represented exactly and as Fractions otherwise, so that they
+# compare equal to what the part hands out
+_exactly = music21.common.opFrac
+
+def _later(offset, amount):
+    """
+    offset + amount, kept exactly
+    """
+    if type(offset) is float and type(amount) is float:
+        # Adding floats opFrac let through gives another one it would let
+        # through
+        return offset + amount
+    return _exactly(offset + amount)
+
+def _allLater(offsets, amount):
+    """
+    _later for a whole list of offsets
+    """
+    if type(amount) is not float:
+        return [ _exactly(offset + amount) for offset in offsets ]
+    return [ offset + amount if type(offset) is float
+            else _exactly(offset + amount) for offset in offsets ]
+
+class Elements:
+    """
+    Everything in a part sorted by offset, in the same order as the part
+    itself, for finding what starts during a span of time in O(log n + k)
+    """
+    KEY = "composteElements"
+
+    def __init__(self, part):
+        # part.elements is already in order, so no need to sort
+        elements = [ element for element in part.elements
+                if not isinstance(element, music21.bar.Barline) ]
+        self.__offsets = [ part.elementOffset(element)
+                for element in elements ]
+        self.__elements = elements
+        self.__part = part
+
+    def __len__(self):
+        return len(self.__elements)
+
+    def within(self, start, end):
+        """
+        Everything that starts somewhere in [start, end), in order, as
+        OffsetMapEntry
+        """
+        lo = bisect_left(self.__offsets, start)
+        hi = bisect_left(self.__offsets, end, lo)
+        return [ OffsetMapEntry(element, offset,
+                    offset + element.duration.quarterLength, None)
+                for (offset, element) in
+                zip(self.__offsets[lo:hi], self.__elements[lo:hi]) ]
+
+    def shift(self, start, amount):
+        """
+        Account for every note from start on, and everything else after
+        start, moving later by amount
+        """
+        lo = bisect_left(self.__offsets, start)
+        hi = bisect_right(self.__offsets, start, lo)
+        here = self.__elements[lo:hi]
+        stay = [ element for element in here
+                if not isinstance(element, music21.note.GeneralNote) ]
+        move = [ element for element in here
+                if isinstance(element, music21.note.GeneralNote) ]
+        self.__elements[lo:hi] = stay + move
+        self.__offsets[lo + len(stay):] = _allLater(
+                self.__offsets[lo + len(stay):], amount)
+
+    def add(self, offset, element):
+        """
+        Account for an element inserted into the part at offset
+        """
+        offset = _exactly(offset)
+        lo = bisect_left(self.__offsets, offset)
+        hi = bisect_right(self.__offsets, offset, lo)
+        # Break ties at the same offset the way the part does
+        key = element.sortTuple(self.__part)
+        while lo < hi and not key < self.__elements[lo].sortTuple(self.__part):
+            lo += 1
+        self.__offsets.insert(lo, offset)
+        self.__elements.insert(lo, element)
+
+    def discard(self, offset, element):
+        """
+        Account for an element at offset removed from the part
+        """
+        lo = bisect_left(self.__offsets, offset)
+        hi = bisect_right(self.__offsets, offset, lo)
+        for i in range(lo, hi):
+            if self.__elements[i] is element:
+                del self.__offsets[i]
+                del self.__elements[i]
+                return
+
+class NoteIntervals:
+    """
+    The notes of a part sorted by offset, for finding the ones that sound
+    during a span of time in O(log n + k)
+    """
+    KEY = "composteNoteIntervals"
+
+    def __init__(self, part):
+        notes = sorted(((part.elementOffset(note), i, note)
+            for (i, note) in enumerate(part.notes)), key = lambda x: x[:2])
+        self.__starts = [ offset for (offset, _, _) in notes ]
+        self.__notes = [ note for (_, _, note) in notes ]
+        # Nothing that starts further back than this can reach a given offset
+        self.__longest = max([ note.duration.quarterLength
+            for note in self.__notes ], default = 0.0)
+
+    def __len__(self):
+        return len(self.__notes)
+
+    def startingAt(self, offset):
+        """
+        Notes that start exactly at offset
+        """
+        offset = _exactly(offset)
+        lo = bisect_left(self.__starts, offset)
+        hi = bisect_right(self.__starts, offset, lo)
+        return self.__notes[lo:hi]
+
+    def startingWithin(self, start, end):
+        """
+        Notes that start somewhere in [start, end), in order, as
+        (offset, note)
+        """
+        lo = bisect_left(self.__starts, start)
+        hi = bisect_left(self.__starts, end, lo)
+        return list(zip(self.__starts[lo:hi], self.__notes[lo:hi]))
+
+    def overlapping(self, start, end):
+        """
+        Notes that sound at some point in [start, end), in order
+        """
+        lo = bisect_right(self.__starts, start - self.__longest)
+        hi = bisect_left(self.__starts, end, lo)
+        return [ note for (offset, note) in
+                zip(self.__starts[lo:hi], self.__notes[lo:hi])
+                if start < offset + note.duration.quarterLength ]
+
+    def reaching(self, offset):
+        """
+        Notes that are still sounding at offset, or end right at it, in order
+        """
+        lo = bisect_left(self.__starts, offset - self.__longest)
+        return [ note for (start, note) in
+                zip(self.__starts[lo:], self.__notes[lo:])
+                if offset <= start + note.duration.quarterLength ]
+
+    def shift(self, start, amount):
+        """
+        Account for every note from start on moving later by amount
+        """
+        i = bisect_left(self.__starts, start)
+        self.__starts[i:] = _allLater(self.__starts[i:], amount)
+
+    def add(self, offset, element):
+        """
+        Account for an element inserted into the part at offset
+        """
+        if not isinstance(element, music21.note.NotRest):
+            return
+        i = bisect_right(self.__starts, offset)
+        self.__starts.insert(i, _exactly(offset))
+        self.__notes.insert(i, element)
+        self.__longest = max(self.__longest, element.duration.quarterLength)
+
+    def discard(self, offset, element):
+        """
+        Account for an element at offset removed from the part
+        """
+        lo = bisect_left(self.__starts, offset)
+        hi = bisect_right(self.__starts, offset, lo)
+        for i in range(lo, hi):
+            if self.__notes[i] is element:
+                del self.__starts[i]
+                del self.__notes[i]
+                return
+
+class NoteLookup:
+    """
+    The notes of a part by offset and pitch name, for finding a particular
+    note in constant time
+    """
+    KEY = "composteNoteLookup"
+
+    def __init__(self, part):
+        self.__notes = {}
+        for note in part.notes:
+            self.add(part.elementOffset(note), note)
+
+    def find(self, offset, pitchName):
+        """
+        Every note at offset named pitchName (with octave), in order
+        """
+        return list(self.__notes.get((_exactly(offset), pitchName), []))
+
+    def shift(self, start, amount):
+        """
+        Account for every note from start on moving later by amount
+        """
+        self.__notes = { ((_later(offset, amount) if start <= offset
+            else offset),
+            name): notes for ((offset, name), notes) in self.__notes.items() }
+
+    def add(self, offset, element):
+        """
+        Account for an element inserted into the part at offset
+        """
+        if not isinstance(element, music21.note.Note):
+            return
+        key = (_exactly(offset), element.pitch.nameWithOctave)
+        self.__notes.setdefault(key, []).append(element)
+
+    def discard(self, offset, element):
+        """
+        Account for an element at offset removed from the part
+        """
+        if not isinstance(element, music21.note.Note):
+            return
+        key = (_exactly(offset), element.pitch.nameWithOctave)
+        notes = self.__notes.get(key, [])
+        for i in range(len(notes)):
+            if notes[i] is element:
+                del notes[i]
+                break
+        if len(notes) == 0:
+            self.__notes.pop(key, None)
+
+class _Markings:
+    """
+    The markings of one class in a part in order, like key signatures or
+    metronome marks, for finding the one in effect at an offset
+    """
+    CLASS = music21.base.Music21Object
+
+    def __init__(self, part):
+        markings = sorted(((part.elementOffset(marking), i, marking)
+            for (i, marking) in
+            enumerate(part.getElementsByClass(self.CLASS))),
+            key = lambda x: x[:2])
+        self._offsets = [ offset for (offset, _, _) in markings ]
+        self._markings = [ marking for (_, _, marking) in markings ]
+
+    def __len__(self):
+        return len(self._markings)
+
+    def at(self, offset):
+        """
+        The marking right at offset, if there is one
+        """
+        offset = _exactly(offset)
+        i = bisect_left(self._offsets, offset)
+        if i < len(self._offsets) and self._offsets[i] == offset:
+            return self._markings[i]
+        return None
+
+    def inEffectAt(self, offset):
+        """
+        The last marking at or before offset, if there is one
+        """
+        i = bisect_right(self._offsets, offset)
+        return None if i == 0 else self._markings[i - 1]
+
+    def after(self, offset):
+        """
+        Offset of the first marking after offset, if there is one
+        """
+        i = bisect_right(self._offsets, offset)
+        return self._offsets[i] if i < len(self._offsets) else None
+
+    def shift(self, start, amount):
+        """
+        Account for every marking after start moving later by amount
+        """
+        i = bisect_right(self._offsets, start)
+        self._offsets[i:] = _allLater(self._offsets[i:], amount)
+
+    def add(self, offset, element):
+        """
+        Account for an element inserted into the part at offset
+        """
+        if not isinstance(element, self.CLASS):
+            return
+        i = bisect_right(self._offsets, offset)
+        self._offsets.insert(i, _exactly(offset))
+        self._markings.insert(i, element)
+
+    def discard(self, offset, element):
+        """
+        Account for an element at offset removed from the part
+        """
+        for i in range(len(self._markings)):
+            if self._markings[i] is element:
+                del self._offsets[i]
+                del self._markings[i]
+                return
+
+class KeySignatures(_Markings):
+    """
+    The key signatures of a part in order
+    """
+    KEY = "composteKeySignatures"
+    CLASS = music21.key.KeySignature
+
+    def sharpsAt(self, offset):
+        """
+        Number of sharps (negative for flats) in the key signature in effect
+        at offset. Parts without one are in C
+        """
+        keySig = self.inEffectAt(offset)
+        return 0 if keySig is None else keySig.sharps
+
+class TempoMap(_Markings):
+    """
+    The metronome marks of a part in order
+    """
+    KEY = "composteTempoMap"
+    CLASS = music21.tempo.MetronomeMark
+
+    # What music21 assumes when a part doesn't start with a metronome mark
+    DEFAULT_BPM = 120
+
+    def bpmAt(self, offset):
+        """
+        Quarter notes per minute at offset
+        """
+        mark = self.inEffectAt(offset)
+        if mark is None:
+            return self.DEFAULT_BPM
+        return mark.getQuarterBPM()
+
+    def boundaries(self, end):
+        """
+        The stretches of the part up to end that each mark covers, as
+        (start, end, mark), like music21's metronomeMarkBoundaries
+        """
+        found = []
+        if len(self._offsets) == 0 or self._offsets[0] > 0.0:
+            found.append((0.0, self._offsets[0] if len(self._offsets) else end,
+                music21.tempo.MetronomeMark(number = self.DEFAULT_BPM)))
+        for i in range(len(self._markings)):
+            stop = self._offsets[i + 1] if i + 1 < len(self._offsets) else end
+            found.append((self._offsets[i], stop, self._markings[i]))
+        return found
+
+_KINDS = [ Elements, NoteIntervals, NoteLookup, KeySignatures, TempoMap ]
+
+def _fetch(part, kind):
+    """
+    The index of kind kind over a part, building it if need be
+    """
+    index = part._cache.get(kind.KEY, None)
+    if index is None:
+        index = kind(part)
+        part._cache[kind.KEY] = index
+    return index
+
+def _survivors(part):
+    """
+    Whatever indexes the part has right now, which would otherwise be lost
+    to the next change
+    """
+    return [ index for index in
+            (part._cache.get(kind.KEY, None) for kind in _KINDS)
+            if index is not None ]
+
+def elements(part):
+    """
+    The Elements of a part
+    """
+    return _fetch(part, Elements)
+
+def intervals(part):
+    """
+    The NoteIntervals of a part
+    """
+    return _fetch(part, NoteIntervals)
+
+def lookup(part):
+    """
+    The NoteLookup of a part. Changing the pitch of a note in place goes
+    unnoticed by music21, so whoever does that has to forget() the part
+    """
+    return _fetch(part, NoteLookup)
+
+def keySignatures(part):
+    """
+    The KeySignatures of a part
+    """
+    return _fetch(part, KeySignatures)
+
+def tempos(part):
+    """
+    The TempoMap of a part
+    """
+    return _fetch(part, TempoMap)
+
+def forget(part):
+    """
+    Throw away every index over a part, usually because its notes changed in
+    a way music21 doesn't notice
+    """
+    for kind in _KINDS:
+        part._cache.pop(kind.KEY, None)
+
+def _settle(part, element):
+    """
+    Move an element that part.insert just tacked onto the end of the part to
+    where it belongs. Otherwise music21 sorts the whole part the next time
+    anybody looks at it, which also empties its cache, indexes and all
+    """
+    elements = part._elements
+    if len(elements) == 0 or elements[-1] is not element:
+        return
+    key = element.sortTuple(part)
+    (lo, hi) = (0, len(elements) - 1)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key < elements[mid].sortTuple(part):
+            hi = mid
+        else:
+            lo = mid + 1
+    elements.insert(lo, elements.pop())
+    part.isSorted = True
+
+def insert(part, offset, element):
+    """
+    part.insert(offset, element), keeping the part's indexes
+    """
+    indexes = _survivors(part)
+    highestTime = part.highestTime
+    wasSorted = part.isSorted
+
+    part.insert(offset, element)
+    if wasSorted and not part.isSorted:
+        _settle(part, element)
+
+    for index in indexes:
+        index.add(offset, element)
+        part._cache[index.KEY] = index
+    part._cache[_HIGHEST_TIME] = max(highestTime, music21.common.opFrac(
+        offset + element.duration.quarterLength))
+
+def shift(part, start, amount):
+    """
+    Move everything in a part from start on later by amount, in one pass,
+    keeping the part's indexes. Notes and rests at start move with the rest,
+    but anything else right at start, like a clef or a key signature, stays
+    where it is
+    """
+    indexes = _survivors(part)
+    highestTime = part.highestTime
+
+    # Straight through the part's own table of offsets, because asking the
+    # part for each offset and then setting it again costs several times
+    # as much as the move itself
+    part.sort()
+    offsets = part._offsetDict
+    amount = _exactly(amount)
+    moved = False
+    inOrder = True
+    # How far whatever stays put reaches
+    reach = 0.0
+    for element in part._elements:
+        offset = offsets[id(element)][0]
+        if offset > start or (offset == start and
+                isinstance(element, music21.note.GeneralNote)):
+            offset = _later(offset, amount)
+            offsets[id(element)] = (offset, element)
+            moved = True
+        else:
+            if offset == start:
+                # Staying behind something that moved breaks the order
+                inOrder = inOrder and not moved
+            reach = max(reach, offset + element.duration.quarterLength)
+
+    # Moving everything past a point by the same amount keeps it sorted
+    part.coreElementsChanged(clearIsSorted = not inOrder)
+    if not moved:
+        part._cache[_HIGHEST_TIME] = highestTime
+    elif reach < highestTime:
+        # Then whatever reached the end moved, and the end with it
+        part._cache[_HIGHEST_TIME] = music21.common.opFrac(highestTime +
+                amount)
+    # Otherwise something that stayed put reaches the old end, and the new
+    # one is for music21 to work out
+
+    for index in indexes:
+        index.shift(start, amount)
+        part._cache[index.KEY] = index
+
+def removeAll(part, elements):
+    """
+    part.remove(elements), for a whole list of elements at once, keeping the
+    part's indexes
+    """
+    if len(elements) == 0:
+        return
+    indexes = _survivors(part)
+    offsets = [ part.elementOffset(element) for element in elements ]
+
+    part.remove(elements)
+
+    for index in indexes:
+        for (offset, element) in zip(offsets, elements):
+            index.discard(offset, element)
+        part._cache[index.KEY] = index
+
+def remove(part, element):
+    """
+    part.remove(element), keeping the part's indexes
+    """
+    indexes = _survivors(part)
+    highestTime = part._cache.get(_HIGHEST_TIME, None)
+    offset = part.elementOffset(element)
+
+    part.remove(element)
+
+    for index in indexes:
+        index.discard(offset, element)
+        part._cache[index.KEY] = index
+    # Something else still reaches the end unless this was it
+    if highestTime is not None and \
+            offset + element.duration.quarterLength < highestTime:
+        part._cache[_HIGHEST_TIME] = highestTime
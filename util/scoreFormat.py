@@ -0,0 +1,351 @@
+# Compact binary storage for the parts of a Composte project.
+#
+# music21 can pickle a stream for us, but the pickles are large and slow to
+# thaw, and we only ever put a handful of kinds of things in a part. So
+# instead, each kind of thing gets a table of parallel typed arrays, and
+# anything that needs a string refers to a shared string table.
+#
+# Layout, all little-endian:
+#   magic "CPST", format version (uint16)
+#   string table
+#   stream class
+#   notes:       offset, quarterLength, midi, step, alter, flags,
+#                previous tie partner, next tie partner (as note indexes)
+#   lyrics:      note index, text
+#   clefs:       offset, class
+#   keys:        offset, sharps
+#   times:       offset, ratio
+#   tempos:      offset, bpm, referent quarterLength, text
+#   dynamics:    offset, value
+#   instruments: offset, class, name
+# Every array is preceded by its length (uint32). Tie partners that don't
+# exist are stored as NO_PARTNER, and missing strings as NO_STRING.
+#
+# Version 1 stored tie partners as offsets (float64, NaN for none) instead.
+
+import music21
+import math
+import struct
+import sys
+from array import array
+
+from util import flyweight
+from util import tieGraph
+
+MAGIC = b"CPST"
+VERSION = 2
+
+NO_STRING = 0xffffffff
+NO_PARTNER = -1
+
+# Note flags
+SPELLING_INFERRED = 0x01
+HAS_TIE_PARTNERS  = 0x02
+TIE_SHIFT         = 2
+TIE_MASK          = 0x0c
+
+TIE_TYPES = [ None, "start", "stop", "continue" ]
+STEPS = "CDEFGAB"
+STEP_CLASSES = [ 0, 2, 4, 5, 7, 9, 11 ]
+
+class FormatError(Exception): pass
+
+class _Strings:
+    """
+    Intern strings while packing, so each is stored once
+    """
+    def __init__(self):
+        self.table = []
+        self.__index = {}
+
+    def __call__(self, string):
+        if string is None:
+            return NO_STRING
+        index = self.__index.get(string, None)
+        if index is None:
+            index = len(self.table)
+            self.table.append(string)
+            self.__index[string] = index
+        return index
+
+def _pack_array(out, typecode, values):
+    # Copy even arrays if they need swapping, since they're somebody else's
+    if not isinstance(values, array) or sys.byteorder != "little":
+        values = array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    out.append(struct.pack("<I", len(values)))
+    out.append(values.tobytes())
+
+class _Reader:
+    """
+    Walk a packed part front to back
+    """
+    def __init__(self, data):
+        self.__data = memoryview(data)
+        self.__at = 0
+
+    def take(self, fmt):
+        values = struct.unpack_from(fmt, self.__data, self.__at)
+        self.__at += struct.calcsize(fmt)
+        return values
+
+    def array(self, typecode):
+        (count,) = self.take("<I")
+        values = array(typecode)
+        end = self.__at + count * values.itemsize
+        values.frombytes(self.__data[self.__at:end])
+        if sys.byteorder != "little":
+            values.byteswap()
+        self.__at = end
+        return values
+
+    def strings(self):
+        (count,) = self.take("<I")
+        table = []
+        for i in range(count):
+            (length,) = self.take("<I")
+            table.append(bytes(self.__data[self.__at:self.__at + length])
+                    .decode())
+            self.__at += length
+        return table
+
+def isPacked(data):
+    """ Whether data looks like a packed part, as opposed to a pickle. """
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+# The note table, column by column
+NOTE_COLUMNS = [ ("offset", "d"), ("ql", "d"), ("midi", "h"), ("step", "B"),
+        ("alter", "b"), ("flags", "B"), ("prev", "i"), ("next", "i") ]
+
+# Every other table, in the order they're stored, with a typecode per column.
+# S columns hold strings, and are stored as indexes into the string table
+TABLES = [ ("lyrics", "IS"), ("clefs", "dS"), ("keys", "db"),
+        ("times", "dS"), ("tempos", "dddS"), ("dynamics", "dS"),
+        ("instruments", "dSS") ]
+
+def _packableNote(note):
+    """ Whether everything about a note fits in the note table. """
+    return (type(note) is music21.note.Note
+            and note.pitch.octave is not None
+            and len(note.articulations) == 0
+            and len(note.expressions) == 0
+            and note.pitch.microtone.cents == 0
+            and note.pitch.alter == int(note.pitch.alter))
+
+def packPart(part):
+    """ Pack a part into bytes. Raises FormatError if the part holds
+        anything the format can't represent exactly, in which case the
+        caller should fall back to pickling. """
+    notes = { column: [] for (column, _) in NOTE_COLUMNS }
+    tables = { table: tuple([] for _ in typecodes)
+               for (table, typecodes) in TABLES }
+    (lyrics, clefs, keys, times, tempos, dynamics, instruments) = [
+            tables[table] for (table, _) in TABLES ]
+    tied = []
+
+    for elem in part.elements:
+        offset = float(part.elementOffset(elem))
+        if isinstance(elem, music21.note.GeneralNote):
+            if not _packableNote(elem):
+                raise FormatError("Can't pack {}".format(elem))
+            pitch = elem.pitch
+            flags = 0
+            if pitch.spellingIsInferred:
+                flags |= SPELLING_INFERRED
+            tie = None if elem.tie is None else elem.tie.type
+            flags |= TIE_TYPES.index(tie) << TIE_SHIFT
+            if hasattr(elem, "tiePartners"):
+                flags |= HAS_TIE_PARTNERS
+            for lyric in elem.lyrics:
+                lyrics[0].append(len(notes["offset"]))
+                lyrics[1].append(lyric.rawText)
+            notes["offset"].append(offset)
+            notes["ql"].append(float(elem.duration.quarterLength))
+            notes["midi"].append(pitch.midi)
+            notes["step"].append(STEPS.index(pitch.step))
+            notes["alter"].append(int(pitch.alter))
+            notes["flags"].append(flags)
+            tied.append(elem)
+        elif isinstance(elem, music21.clef.Clef):
+            if getattr(music21.clef, type(elem).__name__, None) \
+                    is not type(elem):
+                raise FormatError("Can't pack {}".format(elem))
+            clefs[0].append(offset)
+            clefs[1].append(type(elem).__name__)
+        elif type(elem) is music21.key.KeySignature:
+            keys[0].append(offset)
+            keys[1].append(elem.sharps)
+        elif type(elem) is music21.meter.TimeSignature:
+            times[0].append(offset)
+            times[1].append(elem.ratioString)
+        elif type(elem) is music21.tempo.MetronomeMark:
+            # Text-only marks like "Allegro" have no number to store
+            if elem.number is None:
+                raise FormatError("Can't pack {}".format(elem))
+            tempos[0].append(offset)
+            tempos[1].append(float(elem.number))
+            tempos[2].append(float(elem.referent.quarterLength))
+            tempos[3].append(None if elem.textImplicit else elem.text)
+        elif type(elem) is music21.dynamics.Dynamic:
+            dynamics[0].append(offset)
+            dynamics[1].append(elem.value)
+        elif isinstance(elem, music21.instrument.Instrument):
+            # Only stock instruments, which we can rebuild from their class
+            if getattr(music21.instrument, type(elem).__name__, None) \
+                    is not type(elem):
+                raise FormatError("Can't pack {}".format(elem))
+            instruments[0].append(offset)
+            instruments[1].append(type(elem).__name__)
+            instruments[2].append(elem.instrumentName)
+        else:
+            raise FormatError("Can't pack {}".format(elem))
+
+    # Partners can come after the note, so only now do they all have indexes
+    indexes = { id(note): i for (i, note) in enumerate(tied) }
+    def partner(note):
+        if note is None:
+            return NO_PARTNER
+        return indexes.get(id(note), NO_PARTNER)
+    for note in tied:
+        (prev, next_) = tieGraph.partners(note)
+        notes["prev"].append(partner(prev))
+        notes["next"].append(partner(next_))
+
+    return writeColumns(type(part).__name__, notes, tables)
+
+def writeColumns(streamClass, notes, tables):
+    """ Pack a part that is already in columns. notes maps the names in
+        NOTE_COLUMNS to sequences, and tables maps the names in TABLES to
+        tuples of sequences, one per column, with strings as strings.
+        Anything array() takes is fine as a sequence. """
+    strings = _Strings()
+    stringClass = strings(streamClass)
+    packedTables = []
+    for (table, typecodes) in TABLES:
+        for (typecode, column) in zip(typecodes, tables[table]):
+            if typecode == "S":
+                packedTables.append(("I", [ strings(s) for s in column ]))
+            else:
+                packedTables.append((typecode, column))
+
+    out = [ struct.pack("<4sH", MAGIC, VERSION) ]
+
+    out.append(struct.pack("<I", len(strings.table)))
+    for string in strings.table:
+        encoded = string.encode()
+        out.append(struct.pack("<I", len(encoded)))
+        out.append(encoded)
+
+    out.append(struct.pack("<I", stringClass))
+
+    for (column, typecode) in NOTE_COLUMNS:
+        _pack_array(out, typecode, notes[column])
+
+    for (typecode, column) in packedTables:
+        _pack_array(out, typecode, column)
+
+    return b"".join(out)
+
+def readColumns(data):
+    """ The inverse of writeColumns: (stream class, notes, tables), with
+        every column an array. Tie partners in the format version 1 parts
+        are offsets, NaN for none, rather than note indexes, so this also
+        returns the format version. """
+    reader = _Reader(data)
+    (magic, version) = reader.take("<4sH")
+    if magic != MAGIC:
+        raise FormatError("Not a packed part")
+    if version not in (1, VERSION):
+        raise FormatError("Unknown format version {}".format(version))
+
+    strings = reader.strings()
+    def string(index):
+        return None if index == NO_STRING else strings[index]
+
+    (streamClass,) = reader.take("<I")
+
+    notes = {}
+    for (column, typecode) in NOTE_COLUMNS:
+        if version == 1 and column in ("prev", "next"):
+            typecode = "d"
+        notes[column] = reader.array(typecode)
+
+    tables = {}
+    for (table, typecodes) in TABLES:
+        columns = []
+        for typecode in typecodes:
+            if typecode == "S":
+                columns.append([ string(s) for s in reader.array("I") ])
+            else:
+                columns.append(reader.array(typecode))
+        tables[table] = tuple(columns)
+
+    return (version, string(streamClass), notes, tables)
+
+def unpackPart(data):
+    """ Rebuild the music21 stream packed by packPart. """
+    (version, streamClass, columns, tables) = readColumns(data)
+    part = getattr(music21.stream, streamClass)()
+
+    (offsets, qls, midis, steps, alters, flagses, prevs, nexts) = [
+            columns[column] for (column, _) in NOTE_COLUMNS ]
+
+    notes = []
+    for i in range(len(offsets)):
+        (step, alter, flags) = (steps[i], alters[i], flagses[i])
+        octave = (midis[i] - STEP_CLASSES[step] - alter) // 12 - 1
+        pitch = music21.pitch.Pitch(STEPS[step], octave = octave)
+        if alter != 0:
+            pitch.accidental = music21.pitch.Accidental(alter)
+        pitch.spellingIsInferred = bool(flags & SPELLING_INFERRED)
+        note = music21.note.Note(pitch, duration = flyweight.duration(qls[i]))
+        tie = TIE_TYPES[(flags & TIE_MASK) >> TIE_SHIFT]
+        if tie is not None:
+            note.tie = music21.tie.Tie(tie)
+        notes.append(note)
+
+    for i in range(len(notes)):
+        if not flagses[i] & HAS_TIE_PARTNERS:
+            continue
+        if version == 1:
+            # Offsets, which relink() sorts out once the part is built
+            notes[i].tiePartners = [ None if math.isnan(partner) else partner
+                    for partner in (prevs[i], nexts[i]) ]
+        else:
+            notes[i].tiePartners = [ None if partner == NO_PARTNER
+                    else notes[partner] for partner in (prevs[i], nexts[i]) ]
+
+    for (index, text) in zip(*tables["lyrics"]):
+        notes[index].addLyric(text)
+
+    for (offset, note) in zip(offsets, notes):
+        part.coreInsert(offset, note)
+
+    for (offset, cls) in zip(*tables["clefs"]):
+        part.coreInsert(offset, getattr(music21.clef, cls)())
+
+    for (offset, sharp) in zip(*tables["keys"]):
+        part.coreInsert(offset, music21.key.KeySignature(sharp))
+
+    for (offset, ratio) in zip(*tables["times"]):
+        part.coreInsert(offset, flyweight.timeSignature(ratio))
+
+    for (offset, bpm, referent, text) in zip(*tables["tempos"]):
+        # Keep whole numbers whole, like they were when they went in
+        bpm = int(bpm) if bpm == int(bpm) else bpm
+        part.coreInsert(offset,
+                music21.tempo.MetronomeMark(text, bpm, referent))
+
+    for (offset, value) in zip(*tables["dynamics"]):
+        part.coreInsert(offset, music21.dynamics.Dynamic(value))
+
+    for (offset, cls, name) in zip(*tables["instruments"]):
+        instrument = getattr(music21.instrument, cls)()
+        instrument.instrumentName = name
+        part.coreInsert(offset, instrument)
+
+    part.coreElementsChanged()
+    if version == 1:
+        tieGraph.relink(part)
+    return part
@@ -0,0 +1,63 @@
+# Ties between the notes of a part, as a graph with an edge from each note
+# straight to the note it's tied to and back. Every note made by musicFuns
+# carries its edges in note.tiePartners, as [ previous note, next note ], so
+# following or cutting a tie never has to go looking for the other end.
+#
+# Older projects remember tie partners by offset instead. relink() turns
+# those into edges when such a part is thawed.
+
+import music21
+
+from util import partIndex
+
+def partners(note):
+    """
+    The notes tied into and out of note, as (previous, next)
+    """
+    (previous, next_) = getattr(note, "tiePartners", (None, None))
+    return (previous, next_)
+
+def link(first, second):
+    """
+    Record that first is tied to second
+    """
+    _edges(first)[1] = second
+    _edges(second)[0] = first
+
+def unlink(first, second):
+    """
+    Forget the tie from first to second
+    """
+    if _edges(first)[1] is second:
+        first.tiePartners[1] = None
+    if _edges(second)[0] is first:
+        second.tiePartners[0] = None
+
+def _edges(note):
+    if getattr(note, "tiePartners", None) is None:
+        note.tiePartners = [None, None]
+    return note.tiePartners
+
+def _isOffset(partner):
+    return partner is not None and \
+            not isinstance(partner, music21.base.Music21Object)
+
+def relink(part):
+    """
+    Replace tie partners remembered by offset with the notes at those
+    offsets. Partners that can't be found are dropped. Returns the part
+    """
+    notes = [ note for note in part.notes
+            if any(_isOffset(partner) for partner in partners(note)) ]
+    if len(notes) == 0:
+        return part
+    lookup = partIndex.lookup(part)
+    for note in notes:
+        name = note.pitch.nameWithOctave
+        edges = note.tiePartners
+        for side in [0, 1]:
+            if not _isOffset(edges[side]):
+                continue
+            found = lookup.find(edges[side], name)
+            edges[side] = found[0] if len(found) else None
+    return part